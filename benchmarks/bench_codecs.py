@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the JSON codecs on realistic text message frames.
+
+Usage: python benchmarks/bench_codecs.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+import django
+
+django.setup()
+
+from django_private_chat2.consumers.codecs import JSON_CODECS, load_json_codec
+from django_private_chat2.consumers.message_types import MessageTypes
+
+NUMBER = 100000
+TEXT = "Привет! Are we still on for tomorrow? Let's meet at 10:30 near the main entrance 🙂 " * 3
+
+incoming = {"msg_type": MessageTypes.TextMessage, "text": TEXT, "user_pk": "1042", "random_id": -1637012345678}
+outgoing = {"msg_type": MessageTypes.TextMessage, "random_id": -1637012345678, "text": TEXT,
+            "sender": "1041", "receiver": "1042", "sender_username": "user_1041"}
+
+
+def main():
+    print(f"{'codec':<8} {'decode, us':>12} {'encode, us':>12}")
+    for name in JSON_CODECS:
+        try:
+            codec = load_json_codec(name)
+        except ImportError:
+            print(f"{name:<8} {'not installed':>25}")
+            continue
+        frame = codec.dumps(incoming)
+        decode = timeit.timeit(lambda: codec.loads(frame), number=NUMBER) / NUMBER * 1e6
+        encode = timeit.timeit(lambda: codec.dumps(outgoing), number=NUMBER) / NUMBER * 1e6
+        print(f"{name:<8} {decode:>12.2f} {encode:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
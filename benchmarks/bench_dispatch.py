@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of incoming frame validation & dispatch: the table-driven path
+(MESSAGE_VALIDATORS + ChatConsumer.handlers) against the previous if/elif chain.
+Handlers are no-ops, only the validation and the lookup are measured.
+
+Usage: python benchmarks/bench_dispatch.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+import django
+
+django.setup()
+
+from django_private_chat2.consumers import ChatConsumer
+from django_private_chat2.consumers.errors import ErrorTypes
+from django_private_chat2.consumers.message_types import MessageTypes, MESSAGE_VALIDATORS, TEXT_MAX_LENGTH
+
+NUMBER = 200000
+SELF_PK = "1041"
+
+frames = {
+    "text": {"msg_type": MessageTypes.TextMessage, "text": "Are we still on for tomorrow?", "user_pk": "1042",
+             "random_id": -1637012345678},
+    "file": {"msg_type": MessageTypes.FileMessage, "file_id": "1d2b2c35-7c3d-4b1e-9e1f-0a3a1f2e9d11",
+             "user_pk": "1042", "random_id": -1637012345678},
+    "read": {"msg_type": MessageTypes.MessageRead, "user_pk": "1042", "message_id": 1500},
+    "typing": {"msg_type": MessageTypes.IsTyping},
+    "typing stopped": {"msg_type": MessageTypes.TypingStopped},
+    "invalid text": {"msg_type": MessageTypes.TextMessage, "text": "", "user_pk": "1042", "random_id": -1},
+}
+
+
+def noop(*args):
+    return None
+
+
+handlers = {msg_type: noop for msg_type in ChatConsumer.handlers}
+
+
+def table_driven(msg_type, data):
+    validator = MESSAGE_VALIDATORS.get(msg_type)
+    if validator is not None:
+        error = validator(data)
+        if error is not None:
+            return error
+    return handlers[msg_type](data)
+
+
+def legacy_chain(msg_type, data):
+    # Validation part of ChatConsumer.handle_received_message before the dispatch table
+    if msg_type == MessageTypes.WentOffline \
+        or msg_type == MessageTypes.WentOnline \
+        or msg_type == MessageTypes.MessageIdCreated \
+        or msg_type == MessageTypes.ErrorOccurred:
+        return None
+    else:
+        if msg_type == MessageTypes.IsTyping:
+            return noop(data)
+        elif msg_type == MessageTypes.TypingStopped:
+            return noop(data)
+        elif msg_type == MessageTypes.MessageRead:
+            if 'user_pk' not in data:
+                return ErrorTypes.MessageParsingError, "'user_pk' not present in data"
+            elif 'message_id' not in data:
+                return ErrorTypes.MessageParsingError, "'message_id' not present in data"
+            elif not isinstance(data['user_pk'], str):
+                return ErrorTypes.InvalidUserPk, "'user_pk' should be a string"
+            elif not isinstance(data['message_id'], int):
+                return ErrorTypes.InvalidRandomId, "'message_id' should be an int"
+            elif data['message_id'] <= 0:
+                return ErrorTypes.InvalidMessageReadId, "'message_id' should be > 0"
+            elif data['user_pk'] == SELF_PK:
+                return ErrorTypes.InvalidUserPk, "'user_pk' can't be self  (you can't mark self messages as read)"
+            else:
+                return noop(data)
+        elif msg_type == MessageTypes.FileMessage:
+            if 'file_id' not in data:
+                return ErrorTypes.MessageParsingError, "'file_id' not present in data"
+            elif 'user_pk' not in data:
+                return ErrorTypes.MessageParsingError, "'user_pk' not present in data"
+            elif 'random_id' not in data:
+                return ErrorTypes.MessageParsingError, "'random_id' not present in data"
+            elif data['file_id'] == '':
+                return ErrorTypes.FileMessageInvalid, "'file_id' should not be blank"
+            elif not isinstance(data['file_id'], str):
+                return ErrorTypes.FileMessageInvalid, "'file_id' should be a string"
+            elif not isinstance(data['user_pk'], str):
+                return ErrorTypes.InvalidUserPk, "'user_pk' should be a string"
+            elif not isinstance(data['random_id'], int):
+                return ErrorTypes.InvalidRandomId, "'random_id' should be an int"
+            elif data['random_id'] > 0:
+                return ErrorTypes.InvalidRandomId, "'random_id' should be negative"
+            else:
+                return noop(data)
+        elif msg_type == MessageTypes.TextMessage:
+            if 'text' not in data:
+                return ErrorTypes.MessageParsingError, "'text' not present in data"
+            elif 'user_pk' not in data:
+                return ErrorTypes.MessageParsingError, "'user_pk' not present in data"
+            elif 'random_id' not in data:
+                return ErrorTypes.MessageParsingError, "'random_id' not present in data"
+            elif data['text'] == '':
+                return ErrorTypes.TextMessageInvalid, "'text' should not be blank"
+            elif len(data['text']) > TEXT_MAX_LENGTH:
+                return ErrorTypes.TextMessageInvalid, "'text' is too long"
+            elif not isinstance(data['text'], str):
+                return ErrorTypes.TextMessageInvalid, "'text' should be a string"
+            elif not isinstance(data['user_pk'], str):
+                return ErrorTypes.InvalidUserPk, "'user_pk' should be a string"
+            elif not isinstance(data['random_id'], int):
+                return ErrorTypes.InvalidRandomId, "'random_id' should be an int"
+            elif data['random_id'] > 0:
+                return ErrorTypes.InvalidRandomId, "'random_id' should be negative"
+            else:
+                return noop(data)
+
+
+def main():
+    print(f"{'frame':<16} {'if/elif chain, ns':>18} {'table, ns':>12}")
+    for name, frame in frames.items():
+        msg_type = MessageTypes(frame['msg_type'])
+        assert legacy_chain(msg_type, frame) == table_driven(msg_type, frame), name
+        legacy = timeit.timeit(lambda: legacy_chain(msg_type, frame), number=NUMBER) / NUMBER * 1e9
+        table = timeit.timeit(lambda: table_driven(msg_type, frame), number=NUMBER) / NUMBER * 1e9
+        print(f"{name:<16} {legacy:>18.0f} {table:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
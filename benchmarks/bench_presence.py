@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the PRESENCE_TOPOLOGY options on the in-memory channel layer, for a user with
+10, 100 and 1000 dialog partners of which every 10th is online:
+'per_partner' - nothing to do on connect, a broadcast is a presence lookup and one send per online partner,
+'subscription' - one group_add per partner on connect, a broadcast is a single send to the presence group.
+
+Usage: python benchmarks/bench_presence.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+import django
+
+django.setup()
+
+from channels.layers import InMemoryChannelLayer
+
+from django_private_chat2.consumers.fan_out import group_send_many, group_add_many
+from django_private_chat2.consumers.presence import InMemoryPresenceBackend, presence_group
+
+ROUNDS = 100
+SELF_PK = "1"
+EVENT = {"type": "user_went_online", "user_pk": SELF_PK}
+
+
+async def setup(partner_count: int):
+    layer = InMemoryChannelLayer(capacity=ROUNDS * 2)
+    presence = InMemoryPresenceBackend()
+    partners = [str(pk) for pk in range(2, partner_count + 2)]
+    for pk in partners[::10]:
+        channel = f"channel_{pk}"
+        await presence.add(pk, channel)
+        await layer.group_add(pk, channel)
+        await layer.group_add(presence_group(SELF_PK), channel)
+    return layer, presence, partners
+
+
+async def timed(coro_factory) -> float:
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        await coro_factory()
+    return (time.perf_counter() - started) / ROUNDS * 1e6
+
+
+async def bench(partner_count: int):
+    layer, presence, partners = await setup(partner_count)
+
+    async def per_partner_broadcast():
+        await group_send_many(layer, await presence.get_online(partners), EVENT)
+
+    async def subscription_connect():
+        await group_add_many(layer, [presence_group(pk) for pk in partners], "channel_1")
+
+    async def subscription_broadcast():
+        await layer.group_send(presence_group(SELF_PK), EVENT)
+
+    return (await timed(per_partner_broadcast), await timed(subscription_connect),
+            await timed(subscription_broadcast))
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    print(f"{'partners':<9} {'per_partner broadcast, us':>26} {'subscription connect, us':>25} "
+          f"{'subscription broadcast, us':>27}")
+    for partner_count in (10, 100, 1000):
+        per_partner, connect, broadcast = loop.run_until_complete(bench(partner_count))
+        print(f"{partner_count:<9} {per_partner:>26.1f} {connect:>25.1f} {broadcast:>27.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,3 @@
-
 from .chat_consumer import ChatConsumer
-
-
-
+from .fan_out import fan_out, fan_out_in_order, group_send_many, FanOutResult
+from .outbound import get_outbound_metrics
@@ -1,279 +1,573 @@
+import asyncio
 import json
-from typing import Optional, Dict, Tuple
+from urllib.parse import parse_qs
+import random
+import time
+from typing import Optional, Dict, Tuple, Set, NamedTuple, Type, List, Any, Hashable, Union, Callable, Awaitable
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth.models import AbstractBaseUser
 
-from .db_operations import get_groups_to_add, get_unread_count, get_user_by_pk, get_file_by_id, get_message_by_id, \
-    save_file_message, save_text_message, mark_message_as_read
+from .db_operations import get_groups_to_add, get_user_by_pk, get_file_by_id, mark_messages_as_read_up_to, \
+    mark_messages_as_read_batch, save_message_and_get_unread_count, save_messages_batch, get_dialogs_snapshot, \
+    append_updates, get_updates_since
 from .message_types import MessageTypes, MessageTypeMessageRead, MessageTypeFileMessage, MessageTypeTextMessage, \
+    MessageTypeBatch, MessageTypeResume, MESSAGE_VALIDATORS, \
     OutgoingEventMessageRead, OutgoingEventNewTextMessage, OutgoingEventNewUnreadCount, OutgoingEventMessageIdCreated,\
-    OutgoingEventNewFileMessage, OutgoingEventIsTyping, OutgoingEventStoppedTyping, OutgoingEventWentOnline, OutgoingEventWentOffline
+    OutgoingEventNewFileMessage, OutgoingEventInitialSnapshot, OutgoingEventIsTyping, OutgoingEventStoppedTyping, \
+    OutgoingEventWentOnline, OutgoingEventWentOffline
 
 from .errors import ErrorTypes, ErrorDescription
+from .codecs import get_codec_for_subprotocols
+from .fan_out import fan_out_in_order, group_send_many, group_add_many, group_discard_many
+from .presence import get_presence_backend, presence_group, sees_all_connections, PresenceLockTimeout, \
+    PRESENCE_TTL, PRESENCE_TOPOLOGY
+from .rate_limit import ConnectionRateLimiter
+from .outbound import OutboundQueue, OUTBOUND_QUEUE_SIZE, SLOW_CONSUMER_CLOSE_CODE
+from .write_behind import get_message_buffer, MESSAGE_WRITE_BEHIND
 from django_private_chat2.models import MessageModel, UploadedFile
 from django_private_chat2.serializers import serialize_file_model
 from django.conf import settings
 import logging
 
 logger = logging.getLogger('django_private_chat2.chat_consumer')
-TEXT_MAX_LENGTH = getattr(settings, 'TEXT_MAX_LENGTH', 65535)
 UNAUTH_REJECT_CODE: int = 4001
+# Encode outgoing events once on the sending side and ship the frame inside the channel layer event,
+# receivers with the default (JSON) wire format forward it as is
+PREENCODE_EVENTS: bool = getattr(settings, 'PREENCODE_EVENTS', False)
+# Window (in ms) in which repeated 'is_typing' frames are collapsed into one outgoing event, 0 disables coalescing
+TYPING_COALESCE_MS: int = getattr(settings, 'TYPING_COALESCE_MS', 0)
+# Fraction of received frames that get the per-frame summary line and debug logs, 1.0 logs every frame
+LOG_SAMPLE_RATE: float = getattr(settings, 'LOG_SAMPLE_RATE', 1.0)
+# Maximum number of operations in one 'Batch' frame
+MAX_BATCH_OPERATIONS: int = getattr(settings, 'MAX_BATCH_OPERATIONS', 100)
+# Number of dialogs in the connect-time snapshot, same as the first page of the dialogs endpoint
+SNAPSHOT_DIALOGS: int = getattr(settings, 'DIALOGS_PAGINATION', 20)
+# Stamp message events with per-user sequence numbers and store them, so that clients can resume after reconnecting
+UPDATE_LOG_ENABLED: bool = getattr(settings, 'UPDATE_LOG_ENABLED', False)
+
+
+def to_event(ev: NamedTuple) -> dict:
+    """
+    Builds the channel layer event for an OutgoingEvent*, adding the pre-encoded frame if PREENCODE_EVENTS is on.
+    """
+    event = ev._asdict()
+    if PREENCODE_EVENTS:
+        event['frame'] = ev.to_json()
+    return event
+
+
+def sample_frame() -> bool:
+    """
+    Decides whether the frame being handled is logged, according to LOG_SAMPLE_RATE.
+    """
+    if LOG_SAMPLE_RATE >= 1:
+        return True
+    return LOG_SAMPLE_RATE > 0 and random.random() < LOG_SAMPLE_RATE
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
-    async def _after_message_save(self, msg: MessageModel, rid: int, user_pk: str):
-        ev = OutgoingEventMessageIdCreated(random_id=rid, db_id=msg.id)._asdict()
-        logger.info(f"Message with id {msg.id} saved, firing events to {user_pk} & {self.group_name}")
-        await self.channel_layer.group_send(user_pk, ev)
-        await self.channel_layer.group_send(self.group_name, ev)
-        new_unreads = await get_unread_count(self.group_name, user_pk)
-        await self.channel_layer.group_send(user_pk, OutgoingEventNewUnreadCount(sender=self.group_name, unread_count=new_unreads)._asdict())
+    # Sampling decision for the frame currently being handled, channel layer events outside of it are logged
+    _log_frame: bool = True
+
+    def _debug(self, msg: str, *args):
+        # Hot path logging, arguments are only formatted if the frame is sampled and DEBUG is enabled
+        if self._log_frame and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(msg, *args)
+
+    async def _stamp(self, sends: List[Tuple[str, NamedTuple]]) -> List[Tuple[str, dict]]:
+        # Builds the channel layer events, with UPDATE_LOG_ENABLED every event gets the receiver's next sequence number
+        if UPDATE_LOG_ENABLED and sends:
+            seqs = await append_updates([(group, ev.to_dict()) for group, ev in sends])
+            sends = [(group, ev._replace(seq=seq)) for (group, ev), seq in zip(sends, seqs)]
+        return [(group, to_event(ev)) for group, ev in sends]
+
+    async def _after_message_save(self, msg: MessageModel, rid: int, user_pk: str, new_unreads: int):
+        ev = OutgoingEventMessageIdCreated(random_id=rid, db_id=msg.id)
+        self._debug("Message with id %s saved, firing events to %s & %s", msg.id, user_pk, self.group_name)
+        # Stamped events to the same group (both are ours for a message to oneself) have to arrive in 'seq' order
+        await fan_out_in_order(self.channel_layer, await self._stamp([
+            (user_pk, ev), (self.group_name, ev),
+            (user_pk, OutgoingEventNewUnreadCount(sender=self.group_name, unread_count=new_unreads))
+        ]))
+
+    async def _save_message(self, user_pk: str, text: str = '',
+                            file: Optional[UploadedFile] = None) -> Optional[Tuple[MessageModel, int]]:
+        if MESSAGE_WRITE_BEHIND:
+            return await get_message_buffer().save(self.user, user_pk, text=text, file=file)
+        return await save_message_and_get_unread_count(self.user, user_pk, text=text, file=file)
+
+    async def _save_text_messages(self, messages: List[Tuple[str, str]]) -> List[Optional[Tuple[MessageModel, int]]]:
+        # (user_pk, text) pairs, saved with shared DB round trips
+        if MESSAGE_WRITE_BEHIND:
+            buffer = get_message_buffer()
+            return list(await asyncio.gather(*(buffer.save(self.user, user_pk, text=text)
+                                               for user_pk, text in messages)))
+        return await save_messages_batch([(self.user, user_pk, text, None) for user_pk, text in messages])
+
+    def _new_text_message_event(self, user_pk: str, text: str, rid: int) -> Tuple[str, NamedTuple]:
+        return user_pk, OutgoingEventNewTextMessage(random_id=rid, text=text, sender=self.group_name,
+                                                    receiver=user_pk, sender_username=self.sender_username)
+
+    def _message_read_events(self, user_pk: str, mid: int, new_unreads: int) -> List[Tuple[str, NamedTuple]]:
+        # message_id is the high-water mark, every message up to it is read
+        return [
+            (user_pk, OutgoingEventMessageRead(message_id=mid, sender=user_pk, receiver=self.group_name)),
+            (self.group_name, OutgoingEventNewUnreadCount(sender=user_pk, unread_count=new_unreads))
+        ]
+
+    async def _check_rate_limit(self, msg_type: MessageTypes) -> Optional[ErrorDescription]:
+        if await self.rate_limiter.allow(msg_type):
+            return None
+        return ErrorTypes.RateLimitExceeded, f"Rate limit exceeded for {msg_type.name}"
+
+    async def _message_read_error(self, user_pk: str, mid: int) -> ErrorDescription:
+        recipient: Optional[AbstractBaseUser] = await get_user_by_pk(user_pk)
+        if not recipient:
+            return ErrorTypes.InvalidUserPk, f"User with pk {user_pk} does not exist"
+        return ErrorTypes.InvalidMessageReadId, f"Message with id {mid} was not sent by {user_pk} to {self.group_name}"
+
+    async def _online_partners(self) -> Set[str]:
+        # Partners without open connections have nobody to deliver presence & typing events to.
+        # The set is kept up to date by the partners' online/offline events and re-read from the presence backend
+        # every PRESENCE_TTL seconds, so that typing frames don't query the backend
+        backend = get_presence_backend()
+        if not sees_all_connections(backend, self.channel_layer):
+            return self.dialog_partners
+        now = time.monotonic()
+        if self._online is None or now - self._online_read_at >= PRESENCE_TTL:
+            self._online = await backend.get_online(self.dialog_partners)
+            self._online_read_at = now
+        return set(self._online)
+
+    def _track_partner_presence(self, user_pk: str, online: bool):
+        if self._online is not None and user_pk in self.dialog_partners:
+            if online:
+                self._online.add(user_pk)
+            else:
+                self._online.discard(user_pk)
+
+    async def _broadcast_to_partners(self, ev: dict):
+        if PRESENCE_TOPOLOGY == 'subscription':
+            # Partners' connections are subscribed to our presence group, a single send reaches all of them
+            await self.channel_layer.group_send(presence_group(self.group_name), ev)
+        else:
+            await group_send_many(self.channel_layer, await self._online_partners(), ev)
+
+    async def _typing_started(self):
+        if TYPING_COALESCE_MS <= 0:
+            await self._broadcast_to_partners(to_event(OutgoingEventIsTyping(user_pk=self.group_name)))
+            return
+        if self._typing_task is not None:
+            # 'is_typing' is already pending, this frame is collapsed into it
+            return
+        loop = asyncio.get_event_loop()
+        if self._typing_sent_at is not None and loop.time() - self._typing_sent_at < TYPING_COALESCE_MS / 1000:
+            return
+        self._typing_task = asyncio.ensure_future(self._send_typing_after_window())
+
+    async def _send_typing_after_window(self):
+        await asyncio.sleep(TYPING_COALESCE_MS / 1000)
+        self._typing_task = None
+        self._typing_sent_at = asyncio.get_event_loop().time()
+        await self._broadcast_to_partners(to_event(OutgoingEventIsTyping(user_pk=self.group_name)))
+
+    async def _typing_stopped(self):
+        if TYPING_COALESCE_MS <= 0:
+            await self._broadcast_to_partners(to_event(OutgoingEventStoppedTyping(user_pk=self.group_name)))
+            return
+        if self._typing_task is not None:
+            # A pending 'is_typing' is cancelled, partners only need 'stopped_typing' if they saw an earlier one
+            self._typing_task.cancel()
+            self._typing_task = None
+        if self._typing_sent_at is not None:
+            self._typing_sent_at = None
+            await self._broadcast_to_partners(to_event(OutgoingEventStoppedTyping(user_pk=self.group_name)))
+
+    async def _send_snapshot(self):
+        # Requested with '?snapshot=1', replaces the 'self/' and 'dialogs/' requests a client makes after connecting
+        online = await get_presence_backend().get_online(self.dialog_partners)
+        ev = OutgoingEventInitialSnapshot(self_info={"username": self.sender_username, "pk": self.group_name},
+                                          dialogs=await get_dialogs_snapshot(self.user, SNAPSHOT_DIALOGS),
+                                          online=sorted(online))
+        await self.send_payload(ev.to_dict())
+
+    async def _presence_heartbeat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_TTL / 2)
+            try:
+                await get_presence_backend().heartbeat(self.group_name, self.channel_name)
+            except PresenceLockTimeout:
+                # Retried with the next heartbeat, before the connection expires
+                logger.warning("Presence heartbeat of user %s timed out waiting for the lock", self.group_name)
 
     async def connect(self):
         # TODO:
-        # 1. Set user online
-        # 2. Notify other users that the user went online
-        # 3. Add the user to all groups where he has dialogs
+        # Add the user to all groups where he has dialogs
         # Call self.scope["session"].save() on any changes to User
         if self.scope["user"].is_authenticated:
             self.user: AbstractBaseUser = self.scope['user']
             self.group_name: str = str(self.user.pk)
             self.sender_username: str = self.user.get_username()
-            logger.info(f"User {self.user.pk} connected, adding {self.channel_name} to {self.group_name}")
+            self._typing_task: Optional[asyncio.Future] = None
+            self._typing_sent_at: Optional[float] = None
+            self.rate_limiter = ConnectionRateLimiter(self.group_name)
+            # Wire format is negotiated via the WebSocket subprotocol, JSON by default
+            self.codec, subprotocol = get_codec_for_subprotocols(self.scope.get('subprotocols', []))
+            self.outbound: Optional[OutboundQueue] = None
+            if OUTBOUND_QUEUE_SIZE > 0:
+                self.outbound = OutboundQueue(self._send_frame, size=OUTBOUND_QUEUE_SIZE)
+            logger.info("User %s connected, adding %s to %s", self.user.pk, self.channel_name, self.group_name)
             await self.channel_layer.group_add(self.group_name, self.channel_name)
-            await self.accept()
-            dialogs = await get_groups_to_add(self.user)
-            logger.info(f"User {self.user.pk} connected, sending 'user_went_online' to {dialogs} dialog groups")
-            for d in dialogs:  # type: int
-                if str(d) != self.group_name:
-                    await self.channel_layer.group_send(str(d), OutgoingEventWentOnline(user_pk=str(self.user.pk))._asdict())
+            await self.accept(subprotocol=subprotocol)
+            # Dialog partners are loaded once per connection and kept fresh by 'dialog_created' events
+            self.dialog_partners: Set[str] = {str(d) for d in await get_groups_to_add(self.user)} - {self.group_name}
+            self._online: Optional[Set[str]] = None
+            self._online_read_at: float = 0.0
+            if PRESENCE_TOPOLOGY == 'subscription':
+                await group_add_many(self.channel_layer, [presence_group(p) for p in self.dialog_partners],
+                                     self.channel_name)
+            connections = await get_presence_backend().add(self.group_name, self.channel_name)
+            self._heartbeat_task: asyncio.Future = asyncio.ensure_future(self._presence_heartbeat())
+            query = parse_qs(self.scope.get('query_string', b'').decode())
+            if query.get('snapshot', [''])[0] in ('1', 'true'):
+                await self._send_snapshot()
+            if connections > 1:
+                logger.info("User %s already has %d open connection(s), already online", self.user.pk, connections - 1)
+                return
+            logger.info("User %s connected, sending 'user_went_online' to %d dialog partners",
+                        self.user.pk, len(self.dialog_partners))
+            await self._broadcast_to_partners(to_event(OutgoingEventWentOnline(user_pk=str(self.user.pk))))
         else:
-            logger.info(f"Rejecting unauthenticated user with code {UNAUTH_REJECT_CODE}")
+            logger.info("Rejecting unauthenticated user with code %d", UNAUTH_REJECT_CODE)
             await self.close(code=UNAUTH_REJECT_CODE)
 
     async def disconnect(self, close_code):
         # TODO:
-        # Set user offline
         # Save user was_online
-        # Notify other users that the user went offline
         if close_code != UNAUTH_REJECT_CODE and getattr(self, 'user', None) is not None:
-            logger.info(
-                f"User {self.user.pk} disconnected, removing channel {self.channel_name} from group {self.group_name}")
+            logger.info("User %s disconnected, removing channel %s from group %s",
+                        self.user.pk, self.channel_name, self.group_name)
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
-            dialogs = await get_groups_to_add(self.user)
-            logger.info(f"User {self.user.pk} disconnected, sending 'user_went_offline' to {dialogs} dialog groups")
-            for d in dialogs:
-                await self.channel_layer.group_send(str(d), OutgoingEventWentOffline(user_pk=str(self.user.pk))._asdict())
-
-    async def handle_received_message(self, msg_type: MessageTypes, data: Dict[str, str]) -> Optional[ErrorDescription]:
-        logger.info(f"Received message type {msg_type.name} from user {self.group_name} with data {data}")
-        if msg_type == MessageTypes.WentOffline \
-            or msg_type == MessageTypes.WentOnline \
-            or msg_type == MessageTypes.MessageIdCreated \
-            or msg_type == MessageTypes.ErrorOccurred:
-            logger.info(f"Ignoring message {msg_type.name}")
-        else:
-            if msg_type == MessageTypes.IsTyping:
-                dialogs = await get_groups_to_add(self.user)
-                logger.info(f"User {self.user.pk} is typing, sending 'is_typing' to {dialogs} dialog groups")
-                for d in dialogs:
-                    if str(d) != self.group_name:
-                        await self.channel_layer.group_send(str(d), OutgoingEventIsTyping(user_pk=str(self.user.pk))._asdict())
-                return None
-            elif msg_type == MessageTypes.TypingStopped:
-                dialogs = await get_groups_to_add(self.user)
-                logger.info(
-                    f"User {self.user.pk} has stopped typing, sending 'stopped_typing' to {dialogs} dialog groups")
-                for d in dialogs:
-                    if str(d) != self.group_name:
-                        await self.channel_layer.group_send(str(d), OutgoingEventStoppedTyping(user_pk=str(self.user.pk))._asdict())
-                return None
-            elif msg_type == MessageTypes.MessageRead:
-                data: MessageTypeMessageRead
-                if 'user_pk' not in data:
-                    return ErrorTypes.MessageParsingError, "'user_pk' not present in data"
-                elif 'message_id' not in data:
-                    return ErrorTypes.MessageParsingError, "'message_id' not present in data"
-                elif not isinstance(data['user_pk'], str):
-                    return ErrorTypes.InvalidUserPk, "'user_pk' should be a string"
-                elif not isinstance(data['message_id'], int):
-                    return ErrorTypes.InvalidRandomId, "'message_id' should be an int"
-                elif data['message_id'] <= 0:
-                    return ErrorTypes.InvalidMessageReadId, "'message_id' should be > 0"
-                elif data['user_pk'] == self.group_name:
-                    return ErrorTypes.InvalidUserPk, "'user_pk' can't be self  (you can't mark self messages as read)"
-                else:
-                    user_pk = data['user_pk']
-                    mid = data['message_id']
-                    logger.info(
-                        f"Validation passed, marking msg from {user_pk} to {self.group_name} with id {mid} as read")
-
-                    await self.channel_layer.group_send(user_pk,
-                                                        OutgoingEventMessageRead(message_id=mid, sender=user_pk,
-                                                                                 receiver=self.group_name)._asdict())
-                    recipient: Optional[AbstractBaseUser] = await get_user_by_pk(user_pk)
-                    logger.info(f"DB check if user {user_pk} exists resulted in {recipient}")
-                    if not recipient:
-                        return ErrorTypes.InvalidUserPk, f"User with pk {user_pk} does not exist"
-                    else:
-                        msg_res: Optional[Tuple[str, str]] = await get_message_by_id(mid)
-                        if not msg_res:
-                            return ErrorTypes.InvalidMessageReadId, f"Message with id {mid} does not exist"
-                        elif msg_res[0] != self.group_name or msg_res[1] != user_pk:
-                            return ErrorTypes.InvalidMessageReadId, f"Message with id {mid} was not sent by {user_pk} to {self.group_name}"
-                        else:
-                            await mark_message_as_read(mid)
-                            new_unreads = await get_unread_count(user_pk, self.group_name)
-                            await self.channel_layer.group_send(self.group_name,
-                                                                OutgoingEventNewUnreadCount(sender=user_pk,
-                                                                                            unread_count=new_unreads)._asdict())
-                            # await mark_message_as_read(mid, sender_pk=user_pk, recipient_pk=self.group_name)
-
-                return None
-            elif msg_type == MessageTypes.FileMessage:
-                data: MessageTypeFileMessage
-                if 'file_id' not in data:
-                    return ErrorTypes.MessageParsingError, "'file_id' not present in data"
-                elif 'user_pk' not in data:
-                    return ErrorTypes.MessageParsingError, "'user_pk' not present in data"
-                elif 'random_id' not in data:
-                    return ErrorTypes.MessageParsingError, "'random_id' not present in data"
-                elif data['file_id'] == '':
-                    return ErrorTypes.FileMessageInvalid, "'file_id' should not be blank"
-                elif not isinstance(data['file_id'], str):
-                    return ErrorTypes.FileMessageInvalid, "'file_id' should be a string"
-                elif not isinstance(data['user_pk'], str):
-                    return ErrorTypes.InvalidUserPk, "'user_pk' should be a string"
-                elif not isinstance(data['random_id'], int):
-                    return ErrorTypes.InvalidRandomId, "'random_id' should be an int"
-                elif data['random_id'] > 0:
-                    return ErrorTypes.InvalidRandomId, "'random_id' should be negative"
+            if self._typing_task is not None:
+                self._typing_task.cancel()
+            self._heartbeat_task.cancel()
+            if self.outbound is not None:
+                self.outbound.close()
+            if PRESENCE_TOPOLOGY == 'subscription':
+                await group_discard_many(self.channel_layer, [presence_group(p) for p in self.dialog_partners],
+                                         self.channel_name)
+            connections = await get_presence_backend().remove(self.group_name, self.channel_name)
+            if connections > 0:
+                logger.info("User %s still has %d open connection(s), staying online", self.user.pk, connections)
+                return
+            logger.info("User %s disconnected, sending 'user_went_offline' to %d dialog partners",
+                        self.user.pk, len(self.dialog_partners))
+            self._online = None
+            await self._broadcast_to_partners(to_event(OutgoingEventWentOffline(user_pk=str(self.user.pk))))
+
+    async def handle_received_message(self, msg_type: MessageTypes,
+                                      data: Dict[str, Any]) -> Optional[ErrorDescription]:
+        self._debug("Received message type %s from user %s", msg_type.name, self.group_name)
+        validator = MESSAGE_VALIDATORS.get(msg_type)
+        if validator is not None:
+            error = validator(data)
+            if error is not None:
+                return error
+        return await self.handlers[msg_type](self, data)
+
+    async def _ignore(self, data: Dict[str, Any]) -> Optional[ErrorDescription]:
+        self._debug("Ignoring message %s", data['msg_type'])
+        return None
+
+    async def _handle_is_typing(self, data: Dict[str, Any]) -> Optional[ErrorDescription]:
+        self._debug("User %s is typing, sending 'is_typing' to online dialog partners", self.group_name)
+        await self._typing_started()
+        return None
+
+    async def _handle_typing_stopped(self, data: Dict[str, Any]) -> Optional[ErrorDescription]:
+        self._debug("User %s has stopped typing, sending 'stopped_typing' to online dialog partners", self.group_name)
+        await self._typing_stopped()
+        return None
+
+    def _check_not_self(self, data: MessageTypeMessageRead) -> Optional[ErrorDescription]:
+        if data['user_pk'] == self.group_name:
+            return ErrorTypes.InvalidUserPk, "'user_pk' can't be self  (you can't mark self messages as read)"
+        return None
+
+    async def _handle_message_read(self, data: MessageTypeMessageRead) -> Optional[ErrorDescription]:
+        error = self._check_not_self(data)
+        if error is not None:
+            return error
+        user_pk = data['user_pk']
+        mid = data['message_id']
+        self._debug("Validation passed, marking msgs from %s to %s up to id %s as read",
+                    user_pk, self.group_name, mid)
+        new_unreads = await mark_messages_as_read_up_to(mid, sender_pk=user_pk, recipient_pk=self.group_name)
+        if new_unreads is None:
+            return await self._message_read_error(user_pk, mid)
+        await fan_out_in_order(self.channel_layer,
+                               await self._stamp(self._message_read_events(user_pk, mid, new_unreads)))
+        return None
+
+    async def _handle_file_message(self, data: MessageTypeFileMessage) -> Optional[ErrorDescription]:
+        file_id = data['file_id']
+        user_pk = data['user_pk']
+        rid = data['random_id']
+        # We can't send the message right away like in the case with text message
+        # because we don't have the file url.
+        file: Optional[UploadedFile] = await get_file_by_id(file_id)
+        self._debug("DB check if file %s exists resulted in %s", file_id, file)
+        if not file:
+            return ErrorTypes.FileDoesNotExist, f"File with id {file_id} does not exist"
+        self._debug("Will save file message from %s to %s", self.group_name, user_pk)
+        saved = await self._save_message(user_pk, file=file)
+        if not saved:
+            return ErrorTypes.InvalidUserPk, f"User with pk {user_pk} does not exist"
+        msg, new_unreads = saved
+        await self._after_message_save(msg, rid=rid, user_pk=user_pk, new_unreads=new_unreads)
+        self._debug("Sending file message for file %s from %s to %s", file_id, self.group_name, user_pk)
+        # We don't need to send random_id here because we've already saved the file to db
+        [new_file_message] = await self._stamp([(user_pk, OutgoingEventNewFileMessage(
+            db_id=msg.id,
+            file=serialize_file_model(file),
+            sender=self.group_name,
+            receiver=user_pk,
+            sender_username=self.sender_username))])
+        await self.channel_layer.group_send(*new_file_message)
+        return None
+
+    async def _handle_resume(self, data: MessageTypeResume) -> Optional[ErrorDescription]:
+        if not UPDATE_LOG_ENABLED:
+            return ErrorTypes.MessageParsingError, "update log is disabled"
+        current, updates = await get_updates_since(self.group_name, data['seq'])
+        if updates is None:
+            self._debug("Updates of %s after %s are no longer available, requesting resync",
+                        self.group_name, data['seq'])
+            await self.send_payload({'msg_type': MessageTypes.ResyncRequired, 'seq': current})
+            return None
+        self._debug("Replaying %d update(s) of %s after %s", len(updates), self.group_name, data['seq'])
+        for payload in updates:
+            if self.codec.binary:
+                await self.send_payload(json.loads(payload))
+            else:
+                await self.write_frame(payload)
+        await self.send_payload({'msg_type': MessageTypes.Resume, 'seq': current})
+        return None
+
+    async def _handle_text_message(self, data: MessageTypeTextMessage) -> Optional[ErrorDescription]:
+        text = data['text']
+        user_pk = data['user_pk']
+        rid = data['random_id']
+        # first we send data to channel layer to not perform any synchronous operations,
+        # and only after we do sync DB stuff
+        # We need to create a 'random id' - a temporary id for the message, which is not yet
+        # saved to the database. I.e. for the client it is 'pending delivery' and can be
+        # considered delivered only when it's saved to database and received a proper id,
+        # which is then broadcast separately both to sender & receiver.
+        self._debug("Validation passed, sending text message from %s to %s", self.group_name, user_pk)
+        [new_text_message] = await self._stamp([self._new_text_message_event(user_pk, text, rid)])
+        await self.channel_layer.group_send(*new_text_message)
+        self._debug("Will save text message from %s to %s", self.group_name, user_pk)
+        saved = await self._save_message(user_pk, text=text)
+        if not saved:
+            return ErrorTypes.InvalidUserPk, f"User with pk {user_pk} does not exist"
+        msg, new_unreads = saved
+        await self._after_message_save(msg, rid=rid, user_pk=user_pk, new_unreads=new_unreads)
+        return None
+
+    async def _handle_batch(self, data: MessageTypeBatch) -> Optional[ErrorDescription]:
+        """
+        Handles several operations sent in one frame and replies with one 'Batch' frame holding
+        the result (null or [error_code, description]) of every operation, in order.
+        Read receipts are collapsed into one read cursor per dialog and text messages are saved together,
+        other operations are handled one by one.
+        """
+        ops = data['ops']
+        if len(ops) > MAX_BATCH_OPERATIONS:
+            return ErrorTypes.MessageParsingError, f"batch can't have more than {MAX_BATCH_OPERATIONS} operations"
+        results: List[Optional[ErrorDescription]] = [None] * len(ops)
+        read_cursors: Dict[str, int] = {}
+        read_ops: Dict[str, List[int]] = {}
+        text_ops: List[Tuple[int, MessageTypeTextMessage]] = []
+        for i, op in enumerate(ops):
+            msg_type, error = self.parse_operation(op)
+            if error is None:
+                error = await self._check_rate_limit(msg_type)
+            if error is None and msg_type == MessageTypes.Batch:
+                error = ErrorTypes.MessageParsingError, "batches can't be nested"
+            elif error is None and msg_type == MessageTypes.MessageRead:
+                error = MESSAGE_VALIDATORS[msg_type](op) or self._check_not_self(op)
+                if error is None:
+                    read_cursors[op['user_pk']] = max(op['message_id'], read_cursors.get(op['user_pk'], 0))
+                    read_ops.setdefault(op['user_pk'], []).append(i)
+            elif error is None and msg_type == MessageTypes.TextMessage:
+                error = MESSAGE_VALIDATORS[msg_type](op)
+                if error is None:
+                    text_ops.append((i, op))
+            elif error is None:
+                error = await self.handle_received_message(msg_type, op)
+            results[i] = error
+
+        if read_cursors:
+            self._debug("Marking msgs from %d dialog(s) to %s as read", len(read_cursors), self.group_name)
+            events: List[Tuple[str, NamedTuple]] = []
+            for user_pk, new_unreads in (await mark_messages_as_read_batch(read_cursors, self.group_name)).items():
+                if new_unreads is None:
+                    error = await self._message_read_error(user_pk, read_cursors[user_pk])
+                    for i in read_ops[user_pk]:
+                        results[i] = error
                 else:
-                    file_id = data['file_id']
-                    user_pk = data['user_pk']
-                    rid = data['random_id']
-                    # We can't send the message right away like in the case with text message
-                    # because we don't have the file url.
-                    file: Optional[UploadedFile] = await get_file_by_id(file_id)
-                    logger.info(f"DB check if file {file_id} exists resulted in {file}")
-                    if not file:
-                        return ErrorTypes.FileDoesNotExist, f"File with id {file_id} does not exist"
-                    else:
-                        recipient: Optional[AbstractBaseUser] = await get_user_by_pk(user_pk)
-                        logger.info(f"DB check if user {user_pk} exists resulted in {recipient}")
-                        if not recipient:
-                            return ErrorTypes.InvalidUserPk, f"User with pk {user_pk} does not exist"
-                        else:
-                            logger.info(f"Will save file message from {self.user} to {recipient}")
-                            msg = await save_file_message(file, from_=self.user, to=recipient)
-                            await self._after_message_save(msg, rid=rid, user_pk=user_pk)
-                            logger.info(f"Sending file message for file {file_id} from {self.user} to {recipient}")
-                            # We don't need to send random_id here because we've already saved the file to db
-
-                            await self.channel_layer.group_send(user_pk,
-                                                                OutgoingEventNewFileMessage(db_id=msg.id,
-                                                                                            file=serialize_file_model(file),
-                                                                                            sender=self.group_name,
-                                                                                            receiver=user_pk,
-                                                                                            sender_username=self.sender_username)._asdict())
-
-            elif msg_type == MessageTypes.TextMessage:
-                data: MessageTypeTextMessage
-                if 'text' not in data:
-                    return ErrorTypes.MessageParsingError, "'text' not present in data"
-                elif 'user_pk' not in data:
-                    return ErrorTypes.MessageParsingError, "'user_pk' not present in data"
-                elif 'random_id' not in data:
-                    return ErrorTypes.MessageParsingError, "'random_id' not present in data"
-                elif data['text'] == '':
-                    return ErrorTypes.TextMessageInvalid, "'text' should not be blank"
-                elif len(data['text']) > TEXT_MAX_LENGTH:
-                    return ErrorTypes.TextMessageInvalid, "'text' is too long"
-                elif not isinstance(data['text'], str):
-                    return ErrorTypes.TextMessageInvalid, "'text' should be a string"
-                elif not isinstance(data['user_pk'], str):
-                    return ErrorTypes.InvalidUserPk, "'user_pk' should be a string"
-                elif not isinstance(data['random_id'], int):
-                    return ErrorTypes.InvalidRandomId, "'random_id' should be an int"
-                elif data['random_id'] > 0:
-                    return ErrorTypes.InvalidRandomId, "'random_id' should be negative"
+                    events.extend(self._message_read_events(user_pk, read_cursors[user_pk], new_unreads))
+            # Several unread counts go to our own group, in 'seq' order
+            await fan_out_in_order(self.channel_layer, await self._stamp(events))
+
+        if text_ops:
+            self._debug("Sending %d text message(s) from %s", len(text_ops), self.group_name)
+            # Messages to the same recipient have to arrive in the order they were sent
+            await fan_out_in_order(self.channel_layer, await self._stamp([
+                self._new_text_message_event(op['user_pk'], op['text'], op['random_id']) for _, op in text_ops]))
+            saved_messages = await self._save_text_messages([(op['user_pk'], op['text']) for _, op in text_ops])
+            for (i, op), saved in zip(text_ops, saved_messages):
+                if not saved:
+                    results[i] = ErrorTypes.InvalidUserPk, f"User with pk {op['user_pk']} does not exist"
                 else:
-                    text = data['text']
-                    user_pk = data['user_pk']
-                    rid = data['random_id']
-                    # first we send data to channel layer to not perform any synchronous operations,
-                    # and only after we do sync DB stuff
-                    # We need to create a 'random id' - a temporary id for the message, which is not yet
-                    # saved to the database. I.e. for the client it is 'pending delivery' and can be
-                    # considered delivered only when it's saved to database and received a proper id,
-                    # which is then broadcast separately both to sender & receiver.
-                    logger.info(f"Validation passed, sending text message from {self.group_name} to {user_pk}")
-                    await self.channel_layer.group_send(user_pk, OutgoingEventNewTextMessage(random_id=rid,
-                                                                                             text=text,
-                                                                                             sender=self.group_name,
-                                                                                             receiver=user_pk,
-                                                                                             sender_username=self.sender_username)._asdict())
-                    recipient: Optional[AbstractBaseUser] = await get_user_by_pk(user_pk)
-                    logger.info(f"DB check if user {user_pk} exists resulted in {recipient}")
-                    if not recipient:
-                        return ErrorTypes.InvalidUserPk, f"User with pk {user_pk} does not exist"
-                    else:
-                        logger.info(f"Will save text message from {self.user} to {recipient}")
-                        msg = await save_text_message(text, from_=self.user, to=recipient)
-                        await self._after_message_save(msg, rid=rid, user_pk=user_pk)
+                    msg, new_unreads = saved
+                    await self._after_message_save(msg, rid=op['random_id'], user_pk=op['user_pk'],
+                                                   new_unreads=new_unreads)
+
+        await self.send_payload({'msg_type': MessageTypes.Batch, 'results': results})
+        return None
+
+    @staticmethod
+    def parse_operation(data: Any) -> Tuple[Optional[MessageTypes], Optional[ErrorDescription]]:
+        if not isinstance(data, dict) or not ('msg_type' in data):
+            return None, (ErrorTypes.MessageParsingError, "msg_type not present in json")
+        msg_type = data['msg_type']
+        if not isinstance(msg_type, int):
+            return None, (ErrorTypes.MessageParsingError, "msg_type is not an int")
+        try:
+            return MessageTypes(msg_type), None
+        except ValueError as e:
+            return None, (ErrorTypes.MessageParsingError, f"msg_type decoding error - {e}")
+
+    # Handler of every incoming MessageTypes value, frames are validated against MESSAGE_SCHEMAS first
+    handlers: Dict[MessageTypes, Callable[['ChatConsumer', Dict[str, Any]], Awaitable[Optional[ErrorDescription]]]] = {
+        MessageTypes.WentOnline: _ignore,
+        MessageTypes.WentOffline: _ignore,
+        MessageTypes.TextMessage: _handle_text_message,
+        MessageTypes.FileMessage: _handle_file_message,
+        MessageTypes.IsTyping: _handle_is_typing,
+        MessageTypes.MessageRead: _handle_message_read,
+        MessageTypes.ErrorOccurred: _ignore,
+        MessageTypes.MessageIdCreated: _ignore,
+        MessageTypes.NewUnreadCount: _ignore,
+        MessageTypes.TypingStopped: _handle_typing_stopped,
+        MessageTypes.Batch: _handle_batch,
+        MessageTypes.InitialSnapshot: _ignore,
+        MessageTypes.Resume: _handle_resume,
+        MessageTypes.ResyncRequired: _ignore,
+    }
 
     # Receive message from WebSocket
     async def receive(self, text_data=None, bytes_data=None):
-        logger.info(f"Receive fired")
+        self._log_frame = sample_frame()
+        started = time.perf_counter()
+        msg_type = None
         error: Optional[ErrorDescription] = None
         try:
-            text_data_json = json.loads(text_data)
-            logger.info(f"From {self.group_name} received '{text_data_json}")
-            if not ('msg_type' in text_data_json):
-                error = (ErrorTypes.MessageParsingError, "msg_type not present in json")
-            else:
-                msg_type = text_data_json['msg_type']
-                if not isinstance(msg_type, int):
-                    error = (ErrorTypes.MessageParsingError, "msg_type is not an int")
-                else:
-                    try:
-                        msg_type_case: MessageTypes = MessageTypes(msg_type)
-                        error = await self.handle_received_message(msg_type_case, text_data_json)
-                    except ValueError as e:
-                        error = (ErrorTypes.MessageParsingError, f"msg_type decoding error - {e}")
-        except json.JSONDecodeError as e:
+            text_data_json = self.codec.loads(text_data if text_data is not None else bytes_data)
+            msg_type, error = self.parse_operation(text_data_json)
+            if error is None:
+                error = await self._check_rate_limit(msg_type)
+            if error is None:
+                error = await self.handle_received_message(msg_type, text_data_json)
+        except self.codec.decode_errors as e:
             error = (ErrorTypes.MessageParsingError, f"jsonDecodeError - {e}")
         if error is not None:
             error_data = {
                 'msg_type': MessageTypes.ErrorOccurred,
                 'error': error
             }
-            logger.info(f"Will send error {error_data} to {self.group_name}")
-            await self.send(text_data=json.dumps(error_data))
+            self._debug("Will send error %s to %s", error[0].name, self.group_name)
+            await self.send_payload(error_data)
+        if self._log_frame:
+            # One summary line per frame, never includes the payload itself
+            logger.info("frame user=%s msg_type=%s size=%d error=%s duration_ms=%.2f",
+                        self.group_name, msg_type.value if msg_type is not None else None,
+                        len(text_data if text_data is not None else bytes_data or b''),
+                        error[0].value if error is not None else None,
+                        (time.perf_counter() - started) * 1000)
+        self._log_frame = True
+
+    async def _send_frame(self, frame: Union[str, bytes]):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def write_frame(self, frame: Union[str, bytes], ephemeral: bool = False,
+                          coalesce_key: Optional[Hashable] = None):
+        """
+        Writes the frame directly or through the outbound queue (OUTBOUND_QUEUE_SIZE), ephemeral frames
+        may be dropped and queued frames with the same coalesce key are replaced by the latest one.
+        """
+        if self.outbound is None:
+            await self._send_frame(frame)
+        elif not self.outbound.put(frame, ephemeral=ephemeral, coalesce_key=coalesce_key):
+            logger.info("Outbound queue of user %s overflowed, closing %s with code %d",
+                        self.group_name, self.channel_name, SLOW_CONSUMER_CLOSE_CODE)
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def send_payload(self, payload: dict):
+        await self.write_frame(self.codec.dumps(payload))
+
+    async def forward_event(self, event: dict, event_cls: Type[NamedTuple], ephemeral: bool = False,
+                            coalesce_key: Optional[Hashable] = None):
+        frame = event.pop('frame', None)
+        if frame is None or self.codec.binary:
+            frame = self.codec.dumps(event_cls(**event).to_dict())
+        await self.write_frame(frame, ephemeral=ephemeral, coalesce_key=coalesce_key)
+
+    async def dialog_created(self, event: dict):
+        # Internal event, not forwarded to the client
+        partners = {event['user1'], event['user2']} - {self.group_name} - self.dialog_partners
+        if partners:
+            logger.debug("Dialog created for user %s, adding %s to cached dialog partners", self.group_name, partners)
+            self.dialog_partners.update(partners)
+            # Whether the new partners are online is unknown, re-read on the next broadcast
+            self._online = None
+            if PRESENCE_TOPOLOGY == 'subscription':
+                await group_add_many(self.channel_layer, [presence_group(p) for p in partners], self.channel_name)
 
     async def new_unread_count(self, event: dict):
-        await self.send(text_data=OutgoingEventNewUnreadCount(**event).to_json())
+        # Only the latest unread count of a dialog matters, unless the frame carries a 'seq' -
+        # a dropped one would look like a gap in the update log to the client
+        coalesce_key = ('new_unread_count', event['sender']) if event.get('seq') is None else None
+        await self.forward_event(event, OutgoingEventNewUnreadCount, coalesce_key=coalesce_key)
 
     async def message_read(self, event: dict):
-        await self.send(text_data=OutgoingEventMessageRead(**event).to_json())
+        await self.forward_event(event, OutgoingEventMessageRead)
 
     async def message_id_created(self, event: dict):
-        await self.send(text_data=OutgoingEventMessageIdCreated(**event).to_json())
+        await self.forward_event(event, OutgoingEventMessageIdCreated)
 
     async def new_text_message(self, event: dict):
-        await self.send(text_data=OutgoingEventNewTextMessage(**event).to_json())
+        await self.forward_event(event, OutgoingEventNewTextMessage)
 
     async def new_file_message(self, event: dict):
-        await self.send(text_data=OutgoingEventNewFileMessage(**event).to_json())
+        await self.forward_event(event, OutgoingEventNewFileMessage)
 
     async def is_typing(self, event: dict):
-        await self.send(text_data=OutgoingEventIsTyping(**event).to_json())
+        await self.forward_event(event, OutgoingEventIsTyping, ephemeral=True)
 
     async def stopped_typing(self, event: dict):
-        await self.send(text_data=OutgoingEventStoppedTyping(**event).to_json())
+        await self.forward_event(event, OutgoingEventStoppedTyping, ephemeral=True)
 
     async def user_went_online(self, event):
-        await self.send(text_data=OutgoingEventWentOnline(**event).to_json())
+        self._track_partner_presence(event['user_pk'], online=True)
+        await self.forward_event(event, OutgoingEventWentOnline)
 
     async def user_went_offline(self, event):
-        await self.send(text_data=OutgoingEventWentOffline(**event).to_json())
+        self._track_partner_presence(event['user_pk'], online=False)
+        await self.forward_event(event, OutgoingEventWentOffline)
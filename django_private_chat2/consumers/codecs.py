@@ -0,0 +1,124 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 'auto' picks the fastest installed codec (orjson, then ujson, then the standard library),
+# also accepts 'json', 'orjson', 'ujson' or a dotted path to a JsonCodec subclass
+JSON_CODEC: str = getattr(settings, 'JSON_CODEC', 'auto')
+
+
+# WebSocket subprotocols a client can request to choose the wire format, JSON is used when none is requested
+JSON_SUBPROTOCOL = 'json'
+MSGPACK_SUBPROTOCOL = 'msgpack'
+
+
+class JsonCodec:
+    """
+    Encodes outgoing events to text frames and decodes incoming text frames.
+    `decode_errors` lists the exceptions `loads` raises for malformed input.
+    """
+    name: str = 'json'
+    binary: bool = False
+    decode_errors = (ValueError,)
+
+    def dumps(self, obj: Any) -> str:
+        return json.dumps(obj)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def dumps(self, obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+    name = 'ujson'
+
+    def dumps(self, obj: Any) -> str:
+        return ujson.dumps(obj)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return ujson.loads(data)
+
+
+class MsgpackCodec:
+    """
+    MessagePack wire format, frames are sent and received as bytes.
+    """
+    name: str = 'msgpack'
+    binary: bool = True
+    decode_errors = (ValueError, TypeError, msgpack.UnpackException) if msgpack else (ValueError,)
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+JSON_CODECS: Dict[str, Type[JsonCodec]] = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+    'ujson': UjsonCodec,
+}
+
+
+def _available(name: str) -> bool:
+    return {'orjson': orjson, 'ujson': ujson}.get(name, json) is not None
+
+
+def load_json_codec(name: str) -> JsonCodec:
+    if name == 'auto':
+        name = next(n for n in ('orjson', 'ujson', 'json') if _available(n))
+    if name in JSON_CODECS:
+        if not _available(name):
+            raise ImportError(f"JSON_CODEC is set to '{name}', but {name} is not installed")
+        return JSON_CODECS[name]()
+    return import_string(name)()
+
+
+_codec: Optional[JsonCodec] = None
+
+
+def get_json_codec() -> JsonCodec:
+    global _codec
+    if _codec is None:
+        _codec = load_json_codec(JSON_CODEC)
+    return _codec
+
+
+def get_codec_for_subprotocols(subprotocols: List[str]) -> Tuple[Union[JsonCodec, MsgpackCodec], Optional[str]]:
+    """
+    Picks the wire format from the subprotocols requested by the client.
+    Returns the codec and the subprotocol to accept (None if the client didn't request a supported one).
+    """
+    for subprotocol in subprotocols:
+        if subprotocol == MSGPACK_SUBPROTOCOL and msgpack is not None:
+            return MsgpackCodec(), MSGPACK_SUBPROTOCOL
+        if subprotocol == JSON_SUBPROTOCOL:
+            return get_json_codec(), JSON_SUBPROTOCOL
+    return get_json_codec(), None
@@ -1,8 +1,11 @@
 from channels.db import database_sync_to_async
-from django_private_chat2.models import MessageModel, DialogsModel, UserModel, UploadedFile
-from typing import Set, Awaitable, Optional, Tuple
+from django_private_chat2.models import MessageModel, DialogsModel, UserModel, UploadedFile, UpdateLogModel
+from typing import Set, Awaitable, Optional, Tuple, Any, List, Dict
 from django.contrib.auth.models import AbstractBaseUser
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+from django_private_chat2.serializers import serialize_dialog_model
 
 
 @database_sync_to_async
@@ -13,7 +16,10 @@ def get_groups_to_add(u: AbstractBaseUser) -> Awaitable[Set[int]]:
 
 @database_sync_to_async
 def get_user_by_pk(pk: str) -> Awaitable[Optional[AbstractBaseUser]]:
-    return UserModel.objects.filter(pk=pk).first()
+    try:
+        return UserModel.objects.filter(pk=pk).first()
+    except (ValueError, ValidationError):
+        return None
 
 
 @database_sync_to_async
@@ -34,13 +40,48 @@ def get_message_by_id(mid: int) -> Awaitable[Optional[Tuple[str, str]]]:
         return None
 
 
-# @database_sync_to_async
-# def mark_message_as_read(mid: int, sender_pk: str, recipient_pk: str):
-#     return MessageModel.objects.filter(id__lte=mid,sender_id=sender_pk, recipient_id=recipient_pk).update(read=True)
-
 @database_sync_to_async
 def mark_message_as_read(mid: int) -> Awaitable[None]:
-    return MessageModel.objects.filter(id=mid).update(read=True)
+    with transaction.atomic():
+        msg = MessageModel.objects.filter(id=mid, read=False).values_list('sender_id', 'recipient_id').first()
+        if msg:
+            MessageModel.objects.filter(id=mid).update(read=True)
+            DialogsModel.update_unread_count(*msg, -1)
+
+
+def _mark_messages_as_read_up_to(mid: int, sender_pk: str, recipient_pk: str) -> Optional[int]:
+    try:
+        with transaction.atomic():
+            if not MessageModel.objects.filter(id=mid, sender_id=sender_pk, recipient_id=recipient_pk).exists():
+                return None
+            marked = MessageModel.objects.filter(id__lte=mid, sender_id=sender_pk, recipient_id=recipient_pk,
+                                                 read=False).update(read=True)
+            if marked:
+                DialogsModel.update_unread_count(sender_pk, recipient_pk, -marked)
+            return MessageModel.get_unread_count_for_dialog_with_user(sender_pk, recipient_pk)
+    except (ValueError, ValidationError):
+        return None
+
+
+@database_sync_to_async
+def mark_messages_as_read_up_to(mid: int, sender_pk: str, recipient_pk: str) -> Awaitable[Optional[int]]:
+    """
+    Read cursor: marks every message sent by sender to recipient with id <= mid as read
+    and returns the recipient's new unread count for the dialog.
+    Returns None if message `mid` was not sent by sender to recipient.
+    """
+    return _mark_messages_as_read_up_to(mid, sender_pk, recipient_pk)
+
+
+@database_sync_to_async
+def mark_messages_as_read_batch(cursors: Dict[str, int], recipient_pk: str) -> Awaitable[Dict[str, Optional[int]]]:
+    """
+    Batched version of mark_messages_as_read_up_to, `cursors` maps sender pks to the highest read message id.
+    Returns the new unread count for every sender - None if the cursor can't be applied.
+    """
+    with transaction.atomic():
+        return {sender_pk: _mark_messages_as_read_up_to(mid, sender_pk, recipient_pk)
+                for sender_pk, mid in cursors.items()}
 
 
 @database_sync_to_async
@@ -56,3 +97,95 @@ def save_text_message(text: str, from_: AbstractBaseUser, to: AbstractBaseUser)
 @database_sync_to_async
 def save_file_message(file: UploadedFile, from_: AbstractBaseUser, to: AbstractBaseUser) -> Awaitable[MessageModel]:
     return MessageModel.objects.create(file=file, sender=from_, recipient=to)
+
+
+def _get_user_pk(pk: str) -> Optional[Any]:
+    # Returns the primary key converted to the field's type, or None if there's no such user
+    try:
+        return UserModel.objects.filter(pk=pk).values_list('pk', flat=True).first()
+    except (ValueError, ValidationError):
+        return None
+
+
+@database_sync_to_async
+def save_message_and_get_unread_count(
+        from_: AbstractBaseUser, to_pk: str, text: str = '',
+        file: Optional[UploadedFile] = None) -> Awaitable[Optional[Tuple[MessageModel, int]]]:
+    """
+    Validates the recipient, saves the message (creating the dialog if needed) and counts
+    the recipient's unread messages from the sender in a single transaction.
+    Returns None if the recipient does not exist.
+    """
+    with transaction.atomic():
+        recipient_pk = _get_user_pk(to_pk)
+        if recipient_pk is None:
+            return None
+        msg = MessageModel.objects.create(text=text, file=file, sender=from_, recipient_id=recipient_pk)
+        unread_count = MessageModel.get_unread_count_for_dialog_with_user(from_.pk, recipient_pk)
+        return msg, unread_count
+
+
+@database_sync_to_async
+def save_messages_batch(
+        messages: List[Tuple[AbstractBaseUser, str, str, Optional[UploadedFile]]]
+) -> Awaitable[List[Optional[Tuple[MessageModel, int]]]]:
+    """
+    Batched version of save_message_and_get_unread_count for (from_, to_pk, text, file) tuples.
+    Returns a result for every tuple, in order - None if the recipient does not exist.
+    """
+    pk_field = UserModel._meta.pk
+    to_pks: Dict[str, Any] = {}
+    for _, to_pk, _, _ in messages:
+        try:
+            to_pks[to_pk] = pk_field.to_python(to_pk)
+        except ValidationError:
+            pass
+    with transaction.atomic():
+        existing = set(UserModel.objects.filter(pk__in=to_pks.values()).values_list('pk', flat=True))
+        to_save: List[MessageModel] = []
+        for from_, to_pk, text, file in messages:
+            if to_pks.get(to_pk) in existing:
+                to_save.append(MessageModel(text=text, file=file, sender=from_, recipient_id=to_pks[to_pk]))
+        MessageModel.bulk_create_messages(to_save)
+
+        pairs = {DialogsModel.canonical_pair(m.sender_id, m.recipient_id) for m in to_save}
+        dialogs: Dict[Tuple[Any, Any], DialogsModel] = {}
+        if pairs:
+            lookup = Q()
+            for user1, user2 in pairs:
+                lookup |= Q(user1_id=user1, user2_id=user2)
+            dialogs = {(d.user1_id, d.user2_id): d for d in DialogsModel.objects.filter(lookup)}
+
+    saved = iter(to_save)
+    res: List[Optional[Tuple[MessageModel, int]]] = []
+    for _, to_pk, _, _ in messages:
+        if to_pks.get(to_pk) in existing:
+            msg = next(saved)
+            dialog = dialogs.get(DialogsModel.canonical_pair(msg.sender_id, msg.recipient_id))
+            res.append((msg, dialog.unread_count_for(msg.recipient_id) if dialog else 0))
+        else:
+            res.append(None)
+    return res
+
+
+@database_sync_to_async
+def get_dialogs_snapshot(user: AbstractBaseUser, limit: int) -> Awaitable[List[Dict[str, Any]]]:
+    """
+    First page of the user's dialogs (same as the dialogs endpoint) in one query.
+    """
+    return [serialize_dialog_model(d, user.pk) for d in DialogsModel.get_dialogs_list_for_user(user.pk)[:limit]]
+
+
+@database_sync_to_async
+def append_updates(updates: List[Tuple[str, Dict[str, Any]]]) -> Awaitable[List[Optional[int]]]:
+    """
+    Stores (user_pk, payload) pairs in the users' update logs in one transaction.
+    Returns the sequence number of every update - None if the user does not exist.
+    """
+    with transaction.atomic():
+        return [UpdateLogModel.append(user_pk, payload) for user_pk, payload in updates]
+
+
+@database_sync_to_async
+def get_updates_since(user_pk: str, pts: int) -> Awaitable[Tuple[int, Optional[List[str]]]]:
+    return UpdateLogModel.get_updates_since(user_pk, pts)
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from functools import partial
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger('django_private_chat2.fan_out')
+# Maximum number of channel layer sends in flight for a single fan-out
+FAN_OUT_CONCURRENCY: int = getattr(settings, 'FAN_OUT_CONCURRENCY', 50)
+
+
+class FanOutResult(NamedTuple):
+    sent: int
+    failed: List[Tuple[str, BaseException]]
+
+
+async def _gather_bounded(calls: List[Tuple[str, Callable[[], Awaitable[None]]]], concurrency: int,
+                          action: str) -> List[Tuple[str, BaseException]]:
+    # Runs (group, call) pairs with at most `concurrency` of them in flight, returns the failed ones
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run_one(call: Callable[[], Awaitable[None]]):
+        async with semaphore:
+            await call()
+
+    results = await asyncio.gather(*(run_one(call) for _, call in calls), return_exceptions=True)
+    failed = [(group, res) for (group, _), res in zip(calls, results) if isinstance(res, BaseException)]
+    for group, exc in failed:
+        logger.warning("%s group %s failed: %r", action, group, exc)
+    return failed
+
+
+async def fan_out(channel_layer, sends: Iterable[Tuple[str, dict]],
+                  concurrency: int = FAN_OUT_CONCURRENCY) -> FanOutResult:
+    """
+    Sends each (group, message) pair to the channel layer concurrently, keeping at most `concurrency`
+    sends in flight. A failed send doesn't stop the others, failures are logged and returned.
+    """
+    sends = list(sends)
+    if not sends:
+        return FanOutResult(sent=0, failed=[])
+    failed = await _gather_bounded([(group, partial(channel_layer.group_send, group, message))
+                                    for group, message in sends], concurrency, "Fan-out to")
+    return FanOutResult(sent=len(sends) - len(failed), failed=failed)
+
+
+async def fan_out_in_order(channel_layer, sends: Iterable[Tuple[str, dict]],
+                           concurrency: int = FAN_OUT_CONCURRENCY) -> FanOutResult:
+    """
+    Like `fan_out`, but messages to the same group are sent one after another in the given order,
+    only different groups are sent to concurrently. A failed send skips the rest of the group's messages.
+    """
+    by_group: Dict[str, List[dict]] = {}
+    for group, message in sends:
+        by_group.setdefault(group, []).append(message)
+    if not by_group:
+        return FanOutResult(sent=0, failed=[])
+
+    async def send_all(group: str, messages: List[dict]):
+        for message in messages:
+            await channel_layer.group_send(group, message)
+
+    failed = await _gather_bounded([(group, partial(send_all, group, messages))
+                                    for group, messages in by_group.items()], concurrency, "Fan-out to")
+    total = sum(len(messages) for messages in by_group.values())
+    return FanOutResult(sent=total - sum(len(by_group[group]) for group, _ in failed), failed=failed)
+
+
+async def group_send_many(channel_layer, groups: Iterable[str], message: dict,
+                          concurrency: int = FAN_OUT_CONCURRENCY) -> FanOutResult:
+    """
+    Sends the same message to every group, see `fan_out`.
+    """
+    return await fan_out(channel_layer, ((group, message) for group in groups), concurrency=concurrency)
+
+
+async def group_add_many(channel_layer, groups: Iterable[str], channel_name: str,
+                         concurrency: int = FAN_OUT_CONCURRENCY) -> List[Tuple[str, BaseException]]:
+    """
+    Adds the channel to every group concurrently, returns the groups that failed.
+    """
+    return await _gather_bounded([(group, partial(channel_layer.group_add, group, channel_name)) for group in groups],
+                                 concurrency, "Adding to")
+
+
+async def group_discard_many(channel_layer, groups: Iterable[str], channel_name: str,
+                             concurrency: int = FAN_OUT_CONCURRENCY) -> List[Tuple[str, BaseException]]:
+    """
+    Removes the channel from every group concurrently, returns the groups that failed.
+    """
+    return await _gather_bounded([(group, partial(channel_layer.group_discard, group, channel_name))
+                                  for group in groups], concurrency, "Removing from")
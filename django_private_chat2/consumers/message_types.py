@@ -1,8 +1,14 @@
 import enum
-import json
+
+from django.conf import settings
+
+from .codecs import get_json_codec
+from .errors import ErrorTypes, ErrorDescription
 
 # TODO: add tx_id to distinguish errors for different transactions
-from typing import NamedTuple, Optional, Dict
+from typing import NamedTuple, Optional, Dict, Any, List, Tuple, Callable
+
+TEXT_MAX_LENGTH = getattr(settings, 'TEXT_MAX_LENGTH', 65535)
 
 try:
     from typing import TypedDict
@@ -27,6 +33,14 @@ class MessageTypeFileMessage(TypedDict):
     random_id: int
 
 
+class MessageTypeResume(TypedDict):
+    seq: int
+
+
+class MessageTypeBatch(TypedDict):
+    ops: List[Dict[str, Any]]
+
+
 class MessageTypes(enum.IntEnum):
     WentOnline = 1
     WentOffline = 2
@@ -38,6 +52,99 @@ class MessageTypes(enum.IntEnum):
     MessageIdCreated = 8
     NewUnreadCount = 9
     TypingStopped = 10
+    Batch = 11
+    InitialSnapshot = 12
+    Resume = 13
+    ResyncRequired = 14
+
+
+class FieldRule(NamedTuple):
+    """
+    Validation rule of one field: it has to be present and an instance of `type` (`type_error` otherwise),
+    then every (predicate, error type, description) check has to pass.
+    """
+    name: str
+    type: type
+    type_error: ErrorTypes
+    checks: Tuple[Tuple[Callable[[Any], bool], ErrorTypes, str], ...] = ()
+
+
+Validator = Callable[[Dict[str, Any]], Optional[ErrorDescription]]
+
+_TYPE_NAMES = {str: 'a string', int: 'an int', list: 'a list'}
+
+
+def compile_schema(rules: Tuple[FieldRule, ...]) -> Validator:
+    """
+    Builds a validator for the rules, returning the first error or None. Error descriptions are
+    created once here, so validating a frame is one pass over the fields.
+    """
+    required = tuple((rule.name, (ErrorTypes.MessageParsingError, f"'{rule.name}' not present in data"))
+                     for rule in rules)
+    fields = tuple((rule.name, rule.type,
+                    (rule.type_error, f"'{rule.name}' should be {_TYPE_NAMES.get(rule.type, rule.type.__name__)}"),
+                    tuple((check, (error_type, description)) for check, error_type, description in rule.checks))
+                   for rule in rules)
+
+    def validate(data: Dict[str, Any]) -> Optional[ErrorDescription]:
+        for name, missing in required:
+            if name not in data:
+                return missing
+        for name, type_, type_error, checks in fields:
+            value = data[name]
+            if not isinstance(value, type_):
+                return type_error
+            for check, error in checks:
+                if not check(value):
+                    return error
+        return None
+
+    return validate
+
+
+_USER_PK = FieldRule('user_pk', str, ErrorTypes.InvalidUserPk)
+_RANDOM_ID = FieldRule('random_id', int, ErrorTypes.InvalidRandomId,
+                       ((lambda rid: rid <= 0, ErrorTypes.InvalidRandomId, "'random_id' should be negative"),))
+
+MESSAGE_SCHEMAS: Dict[MessageTypes, Tuple[FieldRule, ...]] = {
+    # MessageTypeTextMessage
+    MessageTypes.TextMessage: (
+        FieldRule('text', str, ErrorTypes.TextMessageInvalid, (
+            (bool, ErrorTypes.TextMessageInvalid, "'text' should not be blank"),
+            (lambda text: len(text) <= TEXT_MAX_LENGTH, ErrorTypes.TextMessageInvalid, "'text' is too long"),
+        )),
+        _USER_PK,
+        _RANDOM_ID,
+    ),
+    # MessageTypeFileMessage
+    MessageTypes.FileMessage: (
+        FieldRule('file_id', str, ErrorTypes.FileMessageInvalid, (
+            (bool, ErrorTypes.FileMessageInvalid, "'file_id' should not be blank"),
+        )),
+        _USER_PK,
+        _RANDOM_ID,
+    ),
+    # MessageTypeMessageRead
+    MessageTypes.MessageRead: (
+        _USER_PK,
+        FieldRule('message_id', int, ErrorTypes.InvalidRandomId, (
+            (lambda mid: mid > 0, ErrorTypes.InvalidMessageReadId, "'message_id' should be > 0"),
+        )),
+    ),
+    # MessageTypeResume
+    MessageTypes.Resume: (
+        FieldRule('seq', int, ErrorTypes.MessageParsingError, (
+            (lambda seq: seq >= 0, ErrorTypes.MessageParsingError, "'seq' should be >= 0"),
+        )),
+    ),
+    # MessageTypeBatch
+    MessageTypes.Batch: (
+        FieldRule('ops', list, ErrorTypes.MessageParsingError),
+    ),
+}
+
+MESSAGE_VALIDATORS: Dict[MessageTypes, Validator] = {msg_type: compile_schema(rules)
+                                                     for msg_type, rules in MESSAGE_SCHEMAS.items()}
 
 
 # class OutgoingEventBase(TypedDict):
@@ -48,14 +155,22 @@ class OutgoingEventMessageRead(NamedTuple):
     sender: str
     receiver: str
     type: str = "message_read"
+    # Sequence number of the update in the receiver's update log (UPDATE_LOG_ENABLED), see UpdateLogModel
+    seq: Optional[int] = None
 
-    def to_json(self) -> str:
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        d = {
             "msg_type": MessageTypes.MessageRead,
             "message_id": self.message_id,
             "sender": self.sender,
             "receiver": self.receiver
-        })
+        }
+        if self.seq is not None:
+            d["seq"] = self.seq
+        return d
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
 
 
 class OutgoingEventNewTextMessage(NamedTuple):
@@ -65,16 +180,23 @@ class OutgoingEventNewTextMessage(NamedTuple):
     receiver: str
     sender_username: str
     type: str = "new_text_message"
+    seq: Optional[int] = None
 
-    def to_json(self) -> str:
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        d = {
             "msg_type": MessageTypes.TextMessage,
             "random_id": self.random_id,
             "text": self.text,
             "sender": self.sender,
             "receiver": self.receiver,
             "sender_username": self.sender_username,
-        })
+        }
+        if self.seq is not None:
+            d["seq"] = self.seq
+        return d
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
 
 
 class OutgoingEventNewFileMessage(NamedTuple):
@@ -84,83 +206,134 @@ class OutgoingEventNewFileMessage(NamedTuple):
     receiver: str
     sender_username: str
     type: str = "new_file_message"
+    seq: Optional[int] = None
 
-    def to_json(self) -> str:
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        d = {
             "msg_type": MessageTypes.FileMessage,
             "db_id": self.db_id,
             "file": self.file,
             "sender": self.sender,
             "receiver": self.receiver,
             "sender_username": self.sender_username,
-        })
+        }
+        if self.seq is not None:
+            d["seq"] = self.seq
+        return d
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
 
 
 class OutgoingEventNewUnreadCount(NamedTuple):
     sender: str
     unread_count: int
     type: str = "new_unread_count"
+    seq: Optional[int] = None
 
-    def to_json(self) -> str:
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        d = {
             "msg_type": MessageTypes.NewUnreadCount,
             "sender": self.sender,
             "unread_count": self.unread_count,
-        })
+        }
+        if self.seq is not None:
+            d["seq"] = self.seq
+        return d
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
 
 
 class OutgoingEventMessageIdCreated(NamedTuple):
     random_id: int
     db_id: int
     type: str = "message_id_created"
+    seq: Optional[int] = None
 
-    def to_json(self) -> str:
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        d = {
             "msg_type": MessageTypes.MessageIdCreated,
             "random_id": self.random_id,
             "db_id": self.db_id,
-        })
+        }
+        if self.seq is not None:
+            d["seq"] = self.seq
+        return d
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
 
 
 class OutgoingEventIsTyping(NamedTuple):
     user_pk: str
     type: str = "is_typing"
 
-    def to_json(self) -> str:
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             "msg_type": MessageTypes.IsTyping,
             "user_pk": self.user_pk
-        })
+        }
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
 
 
 class OutgoingEventStoppedTyping(NamedTuple):
     user_pk: str
     type: str = "stopped_typing"
 
-    def to_json(self) -> str:
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             "msg_type": MessageTypes.TypingStopped,
             "user_pk": self.user_pk
-        })
+        }
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
 
 
 class OutgoingEventWentOnline(NamedTuple):
     user_pk: str
     type: str = "user_went_online"
 
-    def to_json(self) -> str:
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             "msg_type": MessageTypes.WentOnline,
             "user_pk": self.user_pk
-        })
+        }
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
 
 
 class OutgoingEventWentOffline(NamedTuple):
     user_pk: str
     type: str = "user_went_offline"
 
-    def to_json(self) -> str:
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             "msg_type": MessageTypes.WentOffline,
             "user_pk": self.user_pk
-        })
+        }
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
+
+
+class OutgoingEventInitialSnapshot(NamedTuple):
+    self_info: Dict[str, str]
+    dialogs: List[Dict[str, Any]]
+    online: List[str]
+    type: str = "initial_snapshot"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "msg_type": MessageTypes.InitialSnapshot,
+            "self": self.self_info,
+            "dialogs": self.dialogs,
+            "online": self.online
+        }
+
+    def to_json(self) -> str:
+        return get_json_codec().dumps(self.to_dict())
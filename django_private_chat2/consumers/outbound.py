@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import weakref
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional, Union
+
+from django.conf import settings
+
+logger = logging.getLogger('django_private_chat2.outbound')
+
+# Maximum number of frames waiting to be written to one websocket, 0 writes frames directly
+OUTBOUND_QUEUE_SIZE: int = getattr(settings, 'OUTBOUND_QUEUE_SIZE', 0)
+# Queue depth above which ephemeral frames (typing) are dropped, defaults to 3/4 of OUTBOUND_QUEUE_SIZE
+OUTBOUND_HIGH_WATER_MARK: Optional[int] = getattr(settings, 'OUTBOUND_HIGH_WATER_MARK', None)
+# A connection staying above the high-water mark for this long (in seconds) is closed
+OUTBOUND_SLOW_CLOSE_SECONDS: float = getattr(settings, 'OUTBOUND_SLOW_CLOSE_SECONDS', 10)
+SLOW_CONSUMER_CLOSE_CODE: int = 4008
+
+Frame = Union[str, bytes]
+
+_queues: 'weakref.WeakSet[OutboundQueue]' = weakref.WeakSet()
+_totals: Dict[str, int] = {'sent': 0, 'dropped': 0, 'coalesced': 0, 'slow_closed': 0}
+
+
+class _Entry:
+    __slots__ = ('frame', 'key')
+
+    def __init__(self, frame: Frame, key: Optional[Hashable]):
+        self.frame = frame
+        self.key = key
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames for one websocket, written by a background task so that
+    a slow client doesn't hold up the consumer. Above the high-water mark ephemeral frames are dropped,
+    frames with the same coalesce key are replaced in place while they wait, and `put` returns False
+    when the queue is full or stayed above the high-water mark for `slow_close_seconds`,
+    i.e. the connection should be closed.
+    """
+
+    def __init__(self, send: Callable[[Frame], Awaitable[None]], size: Optional[int] = None,
+                 high_water_mark: Optional[int] = None, slow_close_seconds: Optional[float] = None):
+        self.size = size if size is not None else OUTBOUND_QUEUE_SIZE
+        if high_water_mark is None:
+            high_water_mark = OUTBOUND_HIGH_WATER_MARK
+        self.high_water_mark = high_water_mark if high_water_mark is not None else self.size * 3 // 4
+        self.slow_close_seconds = slow_close_seconds if slow_close_seconds is not None else OUTBOUND_SLOW_CLOSE_SECONDS
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.overflowed = False
+        self._send = send
+        self._queue: Deque[_Entry] = deque()
+        self._pending: Dict[Hashable, _Entry] = {}
+        self._over_since: Optional[float] = None
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+        _queues.add(self)
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def put(self, frame: Frame, ephemeral: bool = False, coalesce_key: Optional[Hashable] = None) -> bool:
+        if self.overflowed:
+            return True
+        if coalesce_key is not None and coalesce_key in self._pending:
+            self._pending[coalesce_key].frame = frame
+            self.coalesced += 1
+            _totals['coalesced'] += 1
+            return True
+        depth = len(self._queue)
+        if depth >= self.high_water_mark:
+            now = asyncio.get_event_loop().time()
+            if self._over_since is None:
+                self._over_since = now
+            if ephemeral:
+                self.dropped += 1
+                _totals['dropped'] += 1
+                return True
+            if depth >= self.size or now - self._over_since >= self.slow_close_seconds:
+                self.overflowed = True
+                self.dropped += depth + 1
+                _totals['dropped'] += depth + 1
+                _totals['slow_closed'] += 1
+                self._queue.clear()
+                self._pending.clear()
+                return False
+        entry = _Entry(frame, coalesce_key)
+        self._queue.append(entry)
+        if coalesce_key is not None:
+            self._pending[coalesce_key] = entry
+        self.max_depth = max(self.max_depth, depth + 1)
+        self._ready.set()
+        return True
+
+    async def _run(self):
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            entry = self._queue.popleft()
+            if entry.key is not None:
+                self._pending.pop(entry.key, None)
+            if len(self._queue) < self.high_water_mark:
+                self._over_since = None
+            try:
+                await self._send(entry.frame)
+            except Exception:
+                logger.debug("Failed to write frame, stopping outbound queue", exc_info=True)
+                return
+            self.sent += 1
+            _totals['sent'] += 1
+
+    def close(self):
+        """Stops the writer, frames still waiting are discarded."""
+        self._task.cancel()
+        _queues.discard(self)
+
+
+def get_outbound_metrics() -> Dict[str, int]:
+    """
+    Process-wide outbound queue metrics: total frames sent, dropped and coalesced, connections closed
+    for being too slow, and the current number of queues, their total and maximum depth.
+    """
+    depths = [q.depth for q in _queues]
+    return dict(_totals, queues=len(depths), depth=sum(depths), max_depth=max(depths, default=0))
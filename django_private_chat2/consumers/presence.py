@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+# Seconds after which a connection that stopped sending heartbeats is considered gone
+PRESENCE_TTL: int = getattr(settings, 'PRESENCE_TTL', 60)
+PRESENCE_BACKEND: str = getattr(settings, 'PRESENCE_BACKEND',
+                                'django_private_chat2.consumers.presence.InMemoryPresenceBackend')
+PRESENCE_CACHE: str = getattr(settings, 'PRESENCE_CACHE', 'default')
+# How online/offline & typing events reach dialog partners:
+# 'per_partner' - one send to the personal group of every online partner,
+# 'subscription' - connections subscribe to the 'presence_<pk>' groups of their partners, an event is a single send
+PRESENCE_TOPOLOGY: str = getattr(settings, 'PRESENCE_TOPOLOGY', 'per_partner')
+
+logger = logging.getLogger('django_private_chat2.presence')
+
+
+def presence_group(user_pk: str) -> str:
+    return f"presence_{user_pk}"
+
+
+class BasePresenceBackend:
+    """
+    Keeps track of live channel names for every user, so that online/offline
+    transitions are only emitted for the first and the last connection of a user.
+    `per_process` backends only see the connections of the current process.
+    """
+    per_process = False
+
+    def __init__(self, ttl: int = PRESENCE_TTL):
+        self.ttl = ttl
+
+    async def add(self, user_pk: str, channel_name: str) -> int:
+        """Registers the connection and returns the number of live connections of the user."""
+        raise NotImplementedError
+
+    async def remove(self, user_pk: str, channel_name: str) -> int:
+        """Unregisters the connection and returns the number of live connections left."""
+        raise NotImplementedError
+
+    async def heartbeat(self, user_pk: str, channel_name: str) -> None:
+        """Extends the lifetime of the connection by `ttl` seconds."""
+        raise NotImplementedError
+
+    async def get_online(self, user_pks: Iterable[str]) -> Set[str]:
+        """Returns the subset of `user_pks` having at least one live connection."""
+        raise NotImplementedError
+
+
+class InMemoryPresenceBackend(BasePresenceBackend):
+    """
+    Per-process registry, suitable for a single worker process.
+    """
+    per_process = True
+
+    def __init__(self, ttl: int = PRESENCE_TTL):
+        super().__init__(ttl)
+        self._channels: Dict[str, Dict[str, float]] = {}
+
+    def _live(self, user_pk: str) -> Dict[str, float]:
+        channels = self._channels.get(user_pk)
+        if channels is None:
+            return {}
+        now = time.monotonic()
+        for channel_name in [c for c, expires in channels.items() if expires <= now]:
+            del channels[channel_name]
+        if not channels:
+            del self._channels[user_pk]
+        return channels
+
+    async def add(self, user_pk: str, channel_name: str) -> int:
+        channels = self._live(user_pk)
+        channels[channel_name] = time.monotonic() + self.ttl
+        self._channels[user_pk] = channels
+        return len(channels)
+
+    async def remove(self, user_pk: str, channel_name: str) -> int:
+        channels = self._live(user_pk)
+        channels.pop(channel_name, None)
+        if not channels:
+            self._channels.pop(user_pk, None)
+        return len(channels)
+
+    async def heartbeat(self, user_pk: str, channel_name: str) -> None:
+        await self.add(user_pk, channel_name)
+
+    async def get_online(self, user_pks: Iterable[str]) -> Set[str]:
+        user_pks = user_pks if isinstance(user_pks, (set, frozenset)) else set(user_pks)
+        if len(self._channels) < len(user_pks):
+            # Fewer users are online than asked about, intersect from the registry's side
+            return {pk for pk in list(self._channels) if pk in user_pks and self._live(pk)}
+        return {pk for pk in user_pks if self._live(pk)}
+
+
+class PresenceLockTimeout(Exception):
+    """Raised when the lock of a user's presence key couldn't be taken within `lock_timeout` seconds."""
+
+
+class CachePresenceBackend(BasePresenceBackend):
+    """
+    Registry shared between processes through Django's cache framework (PRESENCE_CACHE alias),
+    i.e. Redis or Memcached. Every user has one cache key holding their channel names and expiry
+    timestamps, the key itself expires `ttl` seconds after the last heartbeat.
+    Updates of the key are serialized with a lock key, taken by the atomic `cache.add` of a unique token,
+    so that connections of a user opening or closing at the same time in different processes don't overwrite
+    each other. A lock left by a crashed process expires after `lock_timeout` seconds, waiting longer than that
+    raises PresenceLockTimeout.
+    Cache calls run outside of the thread shared by `database_sync_to_async`, waiting for the lock happens
+    in the event loop.
+    """
+    key_prefix = 'django_private_chat2:presence:'
+    lock_timeout = 1
+
+    def __init__(self, ttl: int = PRESENCE_TTL, cache_alias: str = PRESENCE_CACHE):
+        super().__init__(ttl)
+        self.cache = caches[cache_alias]
+
+    def _key(self, user_pk: str) -> str:
+        return f"{self.key_prefix}{user_pk}"
+
+    def _live(self, user_pk: str) -> Dict[str, float]:
+        now = time.time()
+        channels: Dict[str, float] = self.cache.get(self._key(user_pk)) or {}
+        return {c: expires for c, expires in channels.items() if expires > now}
+
+    def _store(self, user_pk: str, channels: Dict[str, float]):
+        if channels:
+            self.cache.set(self._key(user_pk), channels, timeout=self.ttl)
+        else:
+            self.cache.delete(self._key(user_pk))
+
+    def _release(self, lock_key: str, token: str):
+        # Another process may hold the lock if ours expired, only our own token is deleted
+        if self.cache.get(lock_key) == token:
+            self.cache.delete(lock_key)
+
+    async def _locked(self, user_pk: str, func: Callable[..., int], *args) -> int:
+        # Runs func under the user's lock
+        lock_key = f"{self._key(user_pk)}:lock"
+        token = uuid.uuid4().hex
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.lock_timeout
+        delay = 0.005
+        while not await sync_to_async(self.cache.add, thread_sensitive=False)(lock_key, token, self.lock_timeout):
+            if loop.time() >= deadline:
+                raise PresenceLockTimeout(f"Presence lock of user {user_pk} is still taken after "
+                                          f"{self.lock_timeout}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        try:
+            return await sync_to_async(func, thread_sensitive=False)(*args)
+        finally:
+            await sync_to_async(self._release, thread_sensitive=False)(lock_key, token)
+
+    def _add(self, user_pk: str, channel_name: str) -> int:
+        channels = self._live(user_pk)
+        channels[channel_name] = time.time() + self.ttl
+        self._store(user_pk, channels)
+        return len(channels)
+
+    def _remove(self, user_pk: str, channel_name: str) -> int:
+        channels = self._live(user_pk)
+        channels.pop(channel_name, None)
+        self._store(user_pk, channels)
+        return len(channels)
+
+    def _get_online(self, user_pks: Iterable[str]) -> Set[str]:
+        user_pks = list(user_pks)
+        now = time.time()
+        found = self.cache.get_many([self._key(pk) for pk in user_pks])
+        return {pk for pk in user_pks
+                if any(expires > now for expires in (found.get(self._key(pk)) or {}).values())}
+
+    async def add(self, user_pk: str, channel_name: str) -> int:
+        return await self._locked(user_pk, self._add, user_pk, channel_name)
+
+    async def remove(self, user_pk: str, channel_name: str) -> int:
+        return await self._locked(user_pk, self._remove, user_pk, channel_name)
+
+    async def heartbeat(self, user_pk: str, channel_name: str) -> None:
+        await self.add(user_pk, channel_name)
+
+    async def get_online(self, user_pks: Iterable[str]) -> Set[str]:
+        return await sync_to_async(self._get_online, thread_sensitive=False)(user_pks)
+
+
+_backend: Optional[BasePresenceBackend] = None
+_warned_per_process: bool = False
+
+
+def get_presence_backend() -> BasePresenceBackend:
+    global _backend
+    if _backend is None:
+        _backend = import_string(PRESENCE_BACKEND)()
+    return _backend
+
+
+def sees_all_connections(backend: BasePresenceBackend, channel_layer) -> bool:
+    """
+    False when a per-process backend is used with a channel layer shared between processes: users connected
+    to other processes would look offline, so presence & typing events have to go to all dialog partners.
+    """
+    global _warned_per_process
+    if not backend.per_process or isinstance(channel_layer, InMemoryChannelLayer):
+        return True
+    if not _warned_per_process:
+        _warned_per_process = True
+        logger.warning("%s only sees connections of the current process but %s is shared between processes, "
+                       "presence & typing events are sent to all dialog partners. Set PRESENCE_BACKEND to "
+                       "a shared backend, i.e. CachePresenceBackend",
+                       type(backend).__name__, type(channel_layer).__name__)
+    return False
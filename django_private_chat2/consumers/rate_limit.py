@@ -0,0 +1,144 @@
+import math
+import time
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .message_types import MessageTypes
+
+# Token bucket limits per message type, {msg_type: (tokens per second, burst)}
+# RATE_LIMITS are tracked per connection, USER_RATE_LIMITS per user through RATE_LIMIT_BACKEND
+RATE_LIMITS: Dict[int, Tuple[float, int]] = getattr(settings, 'RATE_LIMITS', {})
+USER_RATE_LIMITS: Dict[int, Tuple[float, int]] = getattr(settings, 'USER_RATE_LIMITS', {})
+RATE_LIMIT_BACKEND: str = getattr(settings, 'RATE_LIMIT_BACKEND',
+                                  'django_private_chat2.consumers.rate_limit.InMemoryRateLimitBackend')
+RATE_LIMIT_CACHE: str = getattr(settings, 'RATE_LIMIT_CACHE', 'default')
+
+
+class TokenBucket:
+    """
+    Holds up to `capacity` tokens, refilled at `rate` tokens per second.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: int, tokens: Optional[float] = None, updated: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity if tokens is None else tokens
+        self.updated = time.monotonic() if updated is None else updated
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now: float, tokens: float = 1) -> bool:
+        """Takes `tokens` out of the bucket, returns False if there's not enough of them."""
+        self.refill(now)
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    @property
+    def refill_time(self) -> float:
+        """Seconds it takes for an empty bucket to become full."""
+        return self.capacity / self.rate if self.rate > 0 else math.inf
+
+
+class BaseRateLimitBackend:
+    """
+    Token buckets shared by all connections of a user.
+    """
+
+    async def consume(self, key: str, rate: float, burst: int) -> bool:
+        """Takes a token from the bucket `key`, returns False if the bucket is empty."""
+        raise NotImplementedError
+
+
+class InMemoryRateLimitBackend(BaseRateLimitBackend):
+    """
+    Per-process buckets, suitable for a single worker process.
+    """
+    # Full buckets are dropped once the number of tracked buckets exceeds this
+    max_buckets = 10000
+
+    def __init__(self):
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def _prune(self, now: float):
+        for key in [k for k, b in self._buckets.items() if now - b.updated >= b.refill_time]:
+            del self._buckets[key]
+
+    async def consume(self, key: str, rate: float, burst: int) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            bucket = self._buckets[key] = TokenBucket(rate, burst, updated=now)
+        return bucket.consume(now)
+
+
+class CacheRateLimitBackend(BaseRateLimitBackend):
+    """
+    Buckets shared between processes through Django's cache framework (RATE_LIMIT_CACHE alias).
+    Every bucket is one cache key holding (tokens, timestamp), which expires once the bucket would be full again.
+    Read-modify-write isn't atomic, so concurrent frames of one user in different processes
+    may slightly exceed the limit.
+    """
+    key_prefix = 'django_private_chat2:rate_limit:'
+
+    def __init__(self, cache_alias: str = RATE_LIMIT_CACHE):
+        self.cache = caches[cache_alias]
+
+    def _consume(self, key: str, rate: float, burst: int) -> bool:
+        now = time.time()
+        cache_key = f"{self.key_prefix}{key}"
+        state: Optional[Tuple[float, float]] = self.cache.get(cache_key)
+        bucket = TokenBucket(rate, burst, updated=now) if state is None else TokenBucket(rate, burst, *state)
+        allowed = bucket.consume(now)
+        refill_time = bucket.refill_time
+        self.cache.set(cache_key, (bucket.tokens, bucket.updated),
+                       timeout=math.ceil(refill_time) + 1 if refill_time != math.inf else None)
+        return allowed
+
+    async def consume(self, key: str, rate: float, burst: int) -> bool:
+        return await sync_to_async(self._consume)(key, rate, burst)
+
+
+_backend: Optional[BaseRateLimitBackend] = None
+
+
+def get_rate_limit_backend() -> BaseRateLimitBackend:
+    global _backend
+    if _backend is None:
+        _backend = import_string(RATE_LIMIT_BACKEND)()
+    return _backend
+
+
+class ConnectionRateLimiter:
+    """
+    Enforces RATE_LIMITS for one connection and USER_RATE_LIMITS for its user.
+    """
+
+    def __init__(self, user_pk: str):
+        self.user_pk = user_pk
+        self.limits = RATE_LIMITS
+        self.user_limits = USER_RATE_LIMITS
+        self._buckets: Dict[int, TokenBucket] = {}
+
+    async def allow(self, msg_type: MessageTypes) -> bool:
+        limit = self.limits.get(msg_type)
+        if limit is not None:
+            bucket = self._buckets.get(msg_type)
+            if bucket is None:
+                bucket = self._buckets[msg_type] = TokenBucket(*limit)
+            if not bucket.consume(time.monotonic()):
+                return False
+        limit = self.user_limits.get(msg_type)
+        if limit is not None:
+            return await get_rate_limit_backend().consume(f"{self.user_pk}:{msg_type.value}", *limit)
+        return True
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import weakref
+from typing import List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.auth.models import AbstractBaseUser
+
+from django_private_chat2.models import MessageModel, UploadedFile
+from .db_operations import save_messages_batch
+
+logger = logging.getLogger('django_private_chat2.write_behind')
+# Opt-in: buffer messages in-process and persist them in batches with bulk_create
+MESSAGE_WRITE_BEHIND: bool = getattr(settings, 'MESSAGE_WRITE_BEHIND', False)
+WRITE_BEHIND_FLUSH_INTERVAL_MS: int = getattr(settings, 'WRITE_BEHIND_FLUSH_INTERVAL_MS', 5)
+WRITE_BEHIND_BATCH_SIZE: int = getattr(settings, 'WRITE_BEHIND_BATCH_SIZE', 100)
+# When the buffer is full, callers wait until there's room for their message (backpressure)
+WRITE_BEHIND_MAX_QUEUE_SIZE: int = getattr(settings, 'WRITE_BEHIND_MAX_QUEUE_SIZE', 1000)
+
+
+class PendingMessage(NamedTuple):
+    from_: AbstractBaseUser
+    to_pk: str
+    text: str
+    file: Optional[UploadedFile]
+    future: asyncio.Future
+
+
+class MessageWriteBuffer:
+    """
+    Collects messages from all consumers of an event loop and flushes them to the database
+    every `flush_interval_ms` or as soon as `batch_size` messages are buffered, whichever comes first.
+    Every caller waits for its own message to be flushed, so the message id is known when `save` returns.
+    """
+    _stop = object()
+
+    def __init__(self, batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval_ms: int = WRITE_BEHIND_FLUSH_INTERVAL_MS,
+                 max_queue_size: int = WRITE_BEHIND_MAX_QUEUE_SIZE):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._task: Optional[asyncio.Future] = None
+        self._closed = False
+
+    async def save(self, from_: AbstractBaseUser, to_pk: str, text: str = '',
+                   file: Optional[UploadedFile] = None) -> Optional[Tuple[MessageModel, int]]:
+        """
+        Same contract as db_operations.save_message_and_get_unread_count.
+        """
+        if self._closed:
+            raise RuntimeError("MessageWriteBuffer is closed")
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put(PendingMessage(from_=from_, to_pk=to_pk, text=text, file=file, future=future))
+        return await future
+
+    async def close(self):
+        """
+        Stops accepting messages and flushes everything that's buffered.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is not None:
+            await self._queue.put(self._stop)
+            await self._task
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is self._stop:
+                break
+            batch: List[PendingMessage] = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if not self._queue.empty():
+                    item = self._queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is self._stop:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[PendingMessage]):
+        logger.debug("Flushing %d buffered message(s)", len(batch))
+        try:
+            results = await save_messages_batch([(p.from_, p.to_pk, p.text, p.file) for p in batch])
+        except Exception as e:
+            logger.exception("Failed to flush %d buffered message(s)", len(batch))
+            for p in batch:
+                if not p.future.done():
+                    p.future.set_exception(e)
+            return
+        for p, res in zip(batch, results):
+            if not p.future.done():
+                p.future.set_result(res)
+
+
+_buffers: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, MessageWriteBuffer]' = weakref.WeakKeyDictionary()
+
+
+def get_message_buffer() -> MessageWriteBuffer:
+    """
+    Returns the buffer of the current event loop, creating it on first use.
+    """
+    loop = asyncio.get_event_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None or buffer._closed:
+        buffer = _buffers[loop] = MessageWriteBuffer()
+    return buffer
+
+
+async def flush_message_buffer():
+    """
+    Flushes and closes the buffer of the current event loop, call it on server shutdown
+    (i.e. from the ASGI lifespan shutdown handler) so that no buffered message is lost.
+    """
+    buffer = _buffers.pop(asyncio.get_event_loop(), None)
+    if buffer is not None:
+        await buffer.close()
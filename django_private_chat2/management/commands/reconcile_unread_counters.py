@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from django_private_chat2.models import DialogsModel
+
+
+class Command(BaseCommand):
+    help = "Recomputes the dialogs' denormalized unread counters from the messages table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of dialogs updated per query")
+
+    def handle(self, *args, **options):
+        fixed = DialogsModel.reconcile_unread_counts(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Reconciled unread counters, {fixed} dialog(s) fixed"))
@@ -0,0 +1,39 @@
+# Generated by Django 4.0.10 on 2026-10-18 17:58
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_unread_counters(apps, schema_editor):
+    # We can't import the models directly as they may be a newer
+    # version than this migration expects. We use the historical versions.
+    dm = apps.get_model('django_private_chat2', 'DialogsModel')
+    mm = apps.get_model('django_private_chat2', 'MessageModel')
+    unread = {(row['sender_id'], row['recipient_id']): row['count'] for row in
+              mm.all_objects.filter(read=False, is_removed=False).values('sender_id', 'recipient_id')
+                  .annotate(count=Count('id')).order_by()}
+    for dialog in dm.objects.all().iterator():
+        dialog.user1_unread_count = unread.get((dialog.user2_id, dialog.user1_id), 0)
+        dialog.user2_unread_count = unread.get((dialog.user1_id, dialog.user2_id), 0)
+        dialog.save(update_fields=['user1_unread_count', 'user2_unread_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_private_chat2', '0002_auto_20210329_2217'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dialogsmodel',
+            name='user1_unread_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='User1 unread count'),
+        ),
+        migrations.AddField(
+            model_name='dialogsmodel',
+            name='user2_unread_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='User2 unread count'),
+        ),
+        migrations.RunPython(fill_unread_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.0.10 on 2026-10-18 18:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_private_chat2', '0003_unread_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpdateSequenceModel',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+                ('pts', models.BigIntegerField(default=0, verbose_name='Pts')),
+            ],
+            options={
+                'verbose_name': 'Update sequence',
+                'verbose_name_plural': 'Update sequences',
+            },
+        ),
+        migrations.CreateModel(
+            name='UpdateLogModel',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False, verbose_name='Id')),
+                ('pts', models.BigIntegerField(verbose_name='Pts')),
+                ('payload', models.TextField(verbose_name='Payload')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Update',
+                'verbose_name_plural': 'Updates',
+                'unique_together': {('user', 'pts')},
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.10 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_private_chat2', '0005a_canonicalize_data'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='dialogsmodel',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='dialogsmodel',
+            constraint=models.UniqueConstraint(fields=('user1', 'user2'), name='unique_dialog_users'),
+        ),
+    ]
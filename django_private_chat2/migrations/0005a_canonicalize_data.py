@@ -0,0 +1,41 @@
+# Generated by Django 4.0.10 on 2026-10-18 19:02
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def canonicalize_dialogs(apps, schema_editor):
+    # Stores every dialog as (smaller pk, bigger pk), merging dialogs which exist in both directions
+    dm = apps.get_model('django_private_chat2', 'DialogsModel')
+    mm = apps.get_model('django_private_chat2', 'MessageModel')
+    merged = set()
+    for dialog in list(dm.objects.filter(user1_id__gt=F('user2_id'))):
+        twin = dm.objects.filter(user1_id=dialog.user2_id, user2_id=dialog.user1_id).first()
+        if twin is None:
+            dialog.user1_id, dialog.user2_id = dialog.user2_id, dialog.user1_id
+            dialog.user1_unread_count, dialog.user2_unread_count = dialog.user2_unread_count, dialog.user1_unread_count
+            dialog.save(update_fields=['user1', 'user2', 'user1_unread_count', 'user2_unread_count'])
+        else:
+            if dialog.created < twin.created:
+                twin.created = dialog.created
+                twin.save(update_fields=['created'])
+            dialog.delete()
+            merged.add(twin.pk)
+    unread = mm.all_objects.filter(read=False, is_removed=False)
+    for dialog in dm.objects.filter(pk__in=merged):
+        dialog.user1_unread_count = unread.filter(sender_id=dialog.user2_id, recipient_id=dialog.user1_id).count()
+        dialog.user2_unread_count = unread.filter(sender_id=dialog.user1_id, recipient_id=dialog.user2_id).count()
+        dialog.save(update_fields=['user1_unread_count', 'user2_unread_count'])
+
+
+class Migration(migrations.Migration):
+    # Rewriting the deferrable user1/user2 foreign keys leaves pending trigger events on PostgreSQL,
+    # so the constraints are changed in a separate migration (transaction)
+
+    dependencies = [
+        ('django_private_chat2', '0004_update_log'),
+    ]
+
+    operations = [
+        migrations.RunPython(canonicalize_dialogs, migrations.RunPython.noop),
+    ]
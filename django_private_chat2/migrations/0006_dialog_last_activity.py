@@ -0,0 +1,50 @@
+# Generated by Django 4.0.10 on 2026-10-18 18:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.db.models import Q
+
+
+def fill_last_message(apps, schema_editor):
+    # We can't import the models directly as they may be a newer
+    # version than this migration expects. We use the historical versions.
+    dm = apps.get_model('django_private_chat2', 'DialogsModel')
+    mm = apps.get_model('django_private_chat2', 'MessageModel')
+    for dialog in dm.objects.all().iterator():
+        last_message = mm.all_objects.filter(
+            Q(sender_id=dialog.user1_id, recipient_id=dialog.user2_id) |
+            Q(sender_id=dialog.user2_id, recipient_id=dialog.user1_id), is_removed=False) \
+            .order_by('-created', '-id').first()
+        dialog.last_message = last_message
+        dialog.last_activity = last_message.created if last_message else dialog.created
+        dialog.save(update_fields=['last_message', 'last_activity'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_private_chat2', '0005_canonical_dialogs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dialogsmodel',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Last activity'),
+        ),
+        migrations.AddField(
+            model_name='dialogsmodel',
+            name='last_message',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='django_private_chat2.messagemodel', verbose_name='Last message'),
+        ),
+        migrations.AddIndex(
+            model_name='dialogsmodel',
+            index=models.Index(fields=['user1', '-last_activity'], name='dialog_user1_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dialogsmodel',
+            index=models.Index(fields=['user2', '-last_activity'], name='dialog_user2_activity_idx'),
+        ),
+        migrations.RunPython(fill_last_message, migrations.RunPython.noop),
+    ]
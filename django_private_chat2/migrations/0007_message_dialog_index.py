@@ -0,0 +1,17 @@
+# Generated by Django 4.0.10 on 2026-10-18 18:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_private_chat2', '0006_dialog_last_activity'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messagemodel',
+            index=models.Index(fields=['sender', 'recipient', '-id'], name='message_dialog_id_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.10 on 2026-10-18 18:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_private_chat2', '0007_message_dialog_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messagemodel',
+            index=models.Index(fields=['sender', '-id'], name='message_sender_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagemodel',
+            index=models.Index(fields=['recipient', '-id'], name='message_recipient_id_idx'),
+        ),
+    ]
@@ -3,15 +3,117 @@
 from django.db import models
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
-from django.utils.timezone import localtime
+from django.utils.timezone import localtime, now
 from model_utils.models import TimeStampedModel, SoftDeletableModel, SoftDeletableManager
 from django.contrib.auth.models import AbstractBaseUser
 from django.contrib.auth import get_user_model
-from typing import Optional, Any
-from django.db.models import Q
+from typing import Optional, Any, Iterable, List, Tuple, Dict
+from collections import OrderedDict
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Q, F, Case, Count, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+import functools
+import json
+import logging
+import threading
 import uuid
 
 UserModel: AbstractBaseUser = get_user_model()
+logger = logging.getLogger('django_private_chat2.models')
+# Number of latest updates kept per user in UpdateLogModel, older ones are trimmed
+UPDATE_LOG_MAX_ENTRIES: int = getattr(settings, 'UPDATE_LOG_MAX_ENTRIES', 1000)
+# Number of existing dialogs remembered per process, so that saving a message doesn't query them, 0 disables it
+KNOWN_DIALOGS_CACHE_SIZE: int = getattr(settings, 'KNOWN_DIALOGS_CACHE_SIZE', 10000)
+
+
+def _pk(u: Any) -> Any:
+    # Accepts either a user instance or its primary key
+    return getattr(u, 'pk', u)
+
+
+def notify_dialog_created(u1_pk: Any, u2_pk: Any):
+    """
+    Lets every open connection of both participants know about the new dialog,
+    so that consumers can update their cached dialog partners without querying the DB.
+    Called once the transaction creating the dialog is committed.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    event = {"type": "dialog_created", "user1": str(u1_pk), "user2": str(u2_pk)}
+    for group in {str(u1_pk), str(u2_pk)}:
+        try:
+            async_to_sync(channel_layer.group_send)(group, event)
+        except Exception:
+            logger.exception("Failed to send 'dialog_created' to group %s", group)
+
+
+class KnownDialogsCache:
+    """
+    Bounded LRU set of (user1_pk, user2_pk) pairs known to have a dialog, in canonical order.
+    Pairs are only added once the transaction creating (or finding) the dialog is committed,
+    and dropped when the dialog is deleted in this process or found missing by DialogsModel.add_messages.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size if max_size is not None else KNOWN_DIALOGS_CACHE_SIZE
+        self.hits = 0
+        self.misses = 0
+        self._pairs: 'OrderedDict[Tuple[Any, Any], None]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pairs)
+
+    def check(self, pair: Tuple[Any, Any]) -> bool:
+        """Returns True if the dialog is known to exist, counting hits & misses."""
+        with self._lock:
+            if pair in self._pairs:
+                self._pairs.move_to_end(pair)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, pairs: Iterable[Tuple[Any, Any]]):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            for pair in pairs:
+                self._pairs[pair] = None
+                self._pairs.move_to_end(pair)
+            while len(self._pairs) > self.max_size:
+                self._pairs.popitem(last=False)
+
+    def add_on_commit(self, pairs: Iterable[Tuple[Any, Any]]):
+        """Adds the pairs once the current transaction is committed, right away outside of a transaction."""
+        pairs = list(pairs)
+        transaction.on_commit(lambda: self.add(pairs))
+
+    def discard(self, pair: Tuple[Any, Any]):
+        with self._lock:
+            self._pairs.pop(pair, None)
+
+    def clear(self):
+        with self._lock:
+            self._pairs.clear()
+            self.hits = self.misses = 0
+
+
+known_dialogs = KnownDialogsCache()
+
+
+def get_known_dialogs_metrics() -> Dict[str, int]:
+    """
+    Known dialogs cache metrics of this process: hits, misses, current and maximum size.
+    """
+    return {'hits': known_dialogs.hits, 'misses': known_dialogs.misses, 'size': len(known_dialogs),
+            'max_size': known_dialogs.max_size}
 
 
 def user_directory_path(instance, filename):
@@ -36,29 +138,175 @@ class DialogsModel(TimeStampedModel):
                               related_name="+", db_index=True)
     user2 = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_("User2"),
                               related_name="+", db_index=True)
+    # Denormalized unread counters: messages from user2 to user1 and vice versa, which were not read yet
+    user1_unread_count = models.PositiveIntegerField(verbose_name=_("User1 unread count"), default=0, editable=False)
+    user2_unread_count = models.PositiveIntegerField(verbose_name=_("User2 unread count"), default=0, editable=False)
+    # Denormalized newest message of the dialog and its time (creation time for dialogs without messages),
+    # kept up to date by MessageModel.save & bulk_create_messages
+    last_message = models.ForeignKey('MessageModel', on_delete=models.SET_NULL, verbose_name=_("Last message"),
+                                     related_name='+', null=True, blank=True, editable=False)
+    last_activity = models.DateTimeField(verbose_name=_("Last activity"), default=now, editable=False)
 
     class Meta:
-        unique_together = (('user1', 'user2'), ('user2', 'user1'))
+        # Dialogs are stored with user1 < user2 (see save), so one index covers both directions
+        constraints = [models.UniqueConstraint(fields=['user1', 'user2'], name='unique_dialog_users')]
+        # Dialogs list of a user, most recently active first
+        indexes = [models.Index(fields=['user1', '-last_activity'], name='dialog_user1_activity_idx'),
+                   models.Index(fields=['user2', '-last_activity'], name='dialog_user2_activity_idx')]
         verbose_name = _("Dialog")
         verbose_name_plural = _("Dialogs")
 
     def __str__(self):
         return _("Dialog between ") + f"{self.user1_id}, {self.user2_id}"
 
+    def save(self, *args, **kwargs):
+        if self.user1_id is not None and self.user2_id is not None:
+            user1_id, user2_id = DialogsModel.canonical_pair(self.user1_id, self.user2_id)
+            if user1_id != self.user1_id:
+                self.user1_id, self.user2_id = user1_id, user2_id
+                self.user1_unread_count, self.user2_unread_count = self.user2_unread_count, self.user1_unread_count
+        super(DialogsModel, self).save(*args, **kwargs)
+
+    @staticmethod
+    def canonical_pair(u1: Any, u2: Any) -> Tuple[Any, Any]:
+        """
+        Primary keys of both users (or the keys themselves) in the order dialogs are stored: smaller one first.
+        """
+        to_python = UserModel._meta.pk.to_python
+        u1, u2 = to_python(_pk(u1)), to_python(_pk(u2))
+        return (u1, u2) if u1 <= u2 else (u2, u1)
+
     @staticmethod
     def dialog_exists(u1: AbstractBaseUser, u2: AbstractBaseUser) -> Optional[Any]:
-        return DialogsModel.objects.filter(Q(user1=u1, user2=u2) | Q(user1=u2, user2=u1)).first()
+        u1, u2 = DialogsModel.canonical_pair(u1, u2)
+        return DialogsModel.objects.filter(user1_id=u1, user2_id=u2).first()
+
+    @staticmethod
+    def create_if_not_exists(u1: AbstractBaseUser, u2: AbstractBaseUser) -> bool:
+        # Both users and their primary keys are accepted
+        # Returns True only if this call created the dialog: get_or_create inserts in a savepoint and fetches
+        # the dialog again on IntegrityError, i.e. when another process created it concurrently
+        u1, u2 = DialogsModel.canonical_pair(u1, u2)
+        _, created = DialogsModel.objects.get_or_create(user1_id=u1, user2_id=u2)
+        if created:
+            transaction.on_commit(lambda: notify_dialog_created(u1, u2))
+        return created
+
+    @staticmethod
+    def create_many_if_not_exist(pairs: Iterable[Tuple[Any, Any]]):
+        """
+        Batched version of create_if_not_exists for (user1_pk, user2_pk) pairs,
+        creates all missing dialogs with one SELECT and one INSERT, dialogs in `known_dialogs` are skipped.
+        """
+        pairs = {pair for pair in (DialogsModel.canonical_pair(u1, u2) for u1, u2 in pairs)
+                 if not known_dialogs.check(pair)}
+        if not pairs:
+            return
+        lookup = Q()
+        for u1, u2 in pairs:
+            lookup |= Q(user1_id=u1, user2_id=u2)
+        missing = pairs - set(DialogsModel.objects.filter(lookup).values_list('user1_id', 'user2_id'))
+        DialogsModel.objects.bulk_create([DialogsModel(user1_id=u1, user2_id=u2) for u1, u2 in missing],
+                                         ignore_conflicts=True)
+        known_dialogs.add_on_commit(pairs)
+        for u1, u2 in missing:
+            transaction.on_commit(functools.partial(notify_dialog_created, u1, u2))
+
+    def unread_count_for(self, user_pk: Any) -> int:
+        """Number of messages in the dialog which were sent to `user_pk` and not read yet."""
+        user_pk = UserModel._meta.pk.to_python(_pk(user_pk))
+        return self.user1_unread_count if self.user1_id == user_pk else self.user2_unread_count
+
+    @staticmethod
+    def update_unread_count(sender: Any, recipient: Any, delta: int):
+        """
+        Atomically adds `delta` to the recipient's unread counter of the dialog, in one UPDATE.
+        """
+        user1, user2 = DialogsModel.canonical_pair(sender, recipient)
+        recipient = UserModel._meta.pk.to_python(_pk(recipient))
+        field = 'user1_unread_count' if recipient == user1 else 'user2_unread_count'
+        DialogsModel.objects.filter(user1_id=user1, user2_id=user2).update(**{field: Greatest(F(field) + delta, 0)})
+
+    @staticmethod
+    def add_messages(sender: Any, recipient: Any, last_message: 'MessageModel', unread: int):
+        """
+        Registers new messages from sender to recipient in one UPDATE: `last_message` (the newest of them)
+        becomes the dialog's last message unless a newer one is already there (concurrent saves may commit
+        in any order), and `unread` is added to the recipient's unread counter.
+        """
+        user1, user2 = DialogsModel.canonical_pair(sender, recipient)
+        newer = Q(last_message__isnull=True) | Q(last_message_id__lt=last_message.id)
+        updates = {'last_message': Case(When(newer, then=Value(last_message.id)), default=F('last_message'),
+                                        output_field=models.BigIntegerField()),
+                   'last_activity': Case(When(newer, then=Value(last_message.created)), default=F('last_activity'),
+                                         output_field=models.DateTimeField())}
+        if unread:
+            field = 'user1_unread_count' if UserModel._meta.pk.to_python(_pk(recipient)) == user1 \
+                else 'user2_unread_count'
+            updates[field] = Greatest(F(field) + unread, 0)
+        if not DialogsModel.objects.filter(user1_id=user1, user2_id=user2).update(**updates):
+            # The dialog was deleted by another process while it was still in this process' known_dialogs
+            known_dialogs.discard((user1, user2))
+            DialogsModel.create_if_not_exists(user1, user2)
+            DialogsModel.objects.filter(user1_id=user1, user2_id=user2).update(**updates)
 
     @staticmethod
-    def create_if_not_exists(u1: AbstractBaseUser, u2: AbstractBaseUser):
-        res = DialogsModel.dialog_exists(u1, u2)
-        if not res:
-            DialogsModel.objects.create(user1=u1, user2=u2)
+    def refresh_last_message(u1: Any, u2: Any):
+        """
+        Recomputes the dialog's last message (and activity) from the messages table, e.g. after a message was deleted.
+        """
+        user1, user2 = DialogsModel.canonical_pair(u1, u2)
+        in_dialog = Q(sender_id=user1, recipient_id=user2) | Q(sender_id=user2, recipient_id=user1)
+        last_message = MessageModel.objects.filter(in_dialog).order_by('-created', '-id')[:1]
+        DialogsModel.objects.filter(user1_id=user1, user2_id=user2) \
+            .update(last_message=Subquery(last_message.values('id')),
+                    last_activity=Coalesce(Subquery(last_message.values('created')), F('created')))
+
+    @staticmethod
+    def reconcile_unread_counts(batch_size: int = 1000) -> int:
+        """
+        Recomputes the unread counters from the messages table, returns the number of dialogs fixed.
+        """
+        rows = MessageModel.objects.filter(read=False).values('sender_id', 'recipient_id') \
+            .annotate(count=Count('id')).order_by()
+        unread = {(row['sender_id'], row['recipient_id']): row['count'] for row in rows}
+        fixed = []
+        for dialog in DialogsModel.objects.all().iterator():
+            user1_unread_count = unread.get((dialog.user2_id, dialog.user1_id), 0)
+            # A dialog with oneself only uses the first counter, see update_unread_count
+            user2_unread_count = unread.get((dialog.user1_id, dialog.user2_id), 0) \
+                if dialog.user1_id != dialog.user2_id else 0
+            if (dialog.user1_unread_count, dialog.user2_unread_count) != (user1_unread_count, user2_unread_count):
+                dialog.user1_unread_count, dialog.user2_unread_count = user1_unread_count, user2_unread_count
+                fixed.append(dialog)
+        DialogsModel.objects.bulk_update(fixed, ['user1_unread_count', 'user2_unread_count'], batch_size=batch_size)
+        return len(fixed)
+
+    @staticmethod
+    def get_unread_count(sender: Any, recipient: Any) -> int:
+        dialog = DialogsModel.dialog_exists(sender, recipient)
+        return dialog.unread_count_for(_pk(recipient)) if dialog else 0
 
     @staticmethod
     def get_dialogs_for_user(user: AbstractBaseUser):
         return DialogsModel.objects.filter(Q(user1=user) | Q(user2=user)).values_list('user1__pk', 'user2__pk')
 
+    @staticmethod
+    def get_dialogs_list_for_user(user_pk: Any):
+        """
+        User's dialogs, most recently active first, joined with everything `serialize_dialog_model` reads,
+        so serializing them doesn't run any queries.
+        """
+        return DialogsModel.objects.filter(Q(user1_id=user_pk) | Q(user2_id=user_pk)) \
+            .select_related('user1', 'user2', 'last_message__sender', 'last_message__recipient',
+                            'last_message__file') \
+            .order_by('-last_activity')
+
+
+@receiver(post_delete, sender=DialogsModel)
+def forget_deleted_dialog(sender, instance: DialogsModel, **kwargs):
+    known_dialogs.discard((instance.user1_id, instance.user2_id))
+
 
 class MessageModel(TimeStampedModel, SoftDeletableModel):
     id = models.BigAutoField(primary_key=True, verbose_name=_("Id"))
@@ -75,7 +323,8 @@ class MessageModel(TimeStampedModel, SoftDeletableModel):
 
     @staticmethod
     def get_unread_count_for_dialog_with_user(sender, recipient):
-        return MessageModel.objects.filter(sender_id=sender, recipient_id=recipient, read=False).count()
+        # Reads the dialog's denormalized counter, see DialogsModel.update_unread_count
+        return DialogsModel.get_unread_count(sender, recipient)
 
     @staticmethod
     def get_last_message_for_dialog(sender, recipient):
@@ -83,19 +332,146 @@ class MessageModel(TimeStampedModel, SoftDeletableModel):
             Q(sender_id=sender, recipient_id=recipient) | Q(sender_id=recipient, recipient_id=sender)) \
             .select_related('sender', 'recipient').first()
 
+    @staticmethod
+    def bulk_create_messages(messages: List['MessageModel']) -> List['MessageModel']:
+        """
+        Inserts the messages in one statement where the database can return their ids.
+        bulk_create bypasses save(), so the dialogs are created here, in one batch as well.
+        """
+        if connection.features.can_return_rows_from_bulk_insert:
+            MessageModel.objects.bulk_create(messages)
+        else:
+            for m in messages:
+                super(MessageModel, m).save()
+        DialogsModel.create_many_if_not_exist((m.sender_id, m.recipient_id) for m in messages)
+        unread: Dict[Tuple[Any, Any], int] = {}
+        last: Dict[Tuple[Any, Any], MessageModel] = {}
+        for m in messages:
+            unread[(m.sender_id, m.recipient_id)] = unread.get((m.sender_id, m.recipient_id), 0) + (not m.read)
+            last[DialogsModel.canonical_pair(m.sender_id, m.recipient_id)] = m
+        for (sender, recipient), count in unread.items():
+            m = last[DialogsModel.canonical_pair(sender, recipient)]
+            DialogsModel.add_messages(sender, recipient, m, count)
+        return messages
+
     def __str__(self):
         return str(self.pk)
 
+    def delete(self, *args, **kwargs):
+        # Removed messages (soft deleted included) don't count as unread, see reconcile_unread_counts
+        counted_as_unread = not self.read and not self.is_removed
+        with transaction.atomic():
+            res = super(MessageModel, self).delete(*args, **kwargs)
+            if counted_as_unread:
+                DialogsModel.update_unread_count(self.sender_id, self.recipient_id, -1)
+            DialogsModel.refresh_last_message(self.sender_id, self.recipient_id)
+        return res
+
     def save(self, *args, **kwargs):
+        adding = self._state.adding
         super(MessageModel, self).save(*args, **kwargs)
-        DialogsModel.create_if_not_exists(self.sender, self.recipient)
+        pair = DialogsModel.canonical_pair(self.sender_id, self.recipient_id)
+        if not known_dialogs.check(pair):
+            DialogsModel.create_if_not_exists(*pair)
+            known_dialogs.add_on_commit([pair])
+        if adding:
+            DialogsModel.add_messages(self.sender_id, self.recipient_id, self, 0 if self.read else 1)
 
     class Meta:
         ordering = ('-created',)
+        # Keyset pagination (MessagesModelList), newest first: of a dialog's messages and of all sent & received ones
+        indexes = [models.Index(fields=['sender', 'recipient', '-id'], name='message_dialog_id_idx'),
+                   models.Index(fields=['sender', '-id'], name='message_sender_id_idx'),
+                   models.Index(fields=['recipient', '-id'], name='message_recipient_id_idx')]
         verbose_name = _("Message")
         verbose_name_plural = _("Messages")
 
+
+class UpdateSequenceModel(models.Model):
+    # Last sequence number (pts) given to an update of the user
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                verbose_name=_("User"), related_name='+')
+    pts = models.BigIntegerField(verbose_name=_("Pts"), default=0)
+
+    class Meta:
+        verbose_name = _("Update sequence")
+        verbose_name_plural = _("Update sequences")
+
+    @staticmethod
+    def next_pts(user_pk: Any) -> Optional[int]:
+        """
+        Increments the user's sequence and returns the new value, None if the user does not exist.
+        The row stays locked until the end of the transaction, so the numbers are gap-free per user.
+        """
+        try:
+            if not UpdateSequenceModel.objects.filter(user_id=user_pk).update(pts=F('pts') + 1):
+                if not UserModel.objects.filter(pk=user_pk).exists():
+                    return None
+                UpdateSequenceModel.objects.get_or_create(user_id=user_pk)
+                UpdateSequenceModel.objects.filter(user_id=user_pk).update(pts=F('pts') + 1)
+            return UpdateSequenceModel.objects.filter(user_id=user_pk).values_list('pts', flat=True).get()
+        except (ValueError, ValidationError):
+            return None
+
+    @staticmethod
+    def current_pts(user_pk: Any) -> int:
+        return UpdateSequenceModel.objects.filter(user_id=user_pk).values_list('pts', flat=True).first() or 0
+
+
+class UpdateLogModel(models.Model):
+    """
+    Latest outgoing events of every user, numbered by UpdateSequenceModel, so that a reconnecting client
+    can get the updates it missed. Payloads are stored as JSON, the way they are sent to the client.
+    """
+    id = models.BigAutoField(primary_key=True, verbose_name=_("Id"))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_("User"),
+                             related_name='+', db_index=False)
+    pts = models.BigIntegerField(verbose_name=_("Pts"))
+    payload = models.TextField(verbose_name=_("Payload"))
+
+    class Meta:
+        unique_together = (('user', 'pts'),)
+        verbose_name = _("Update")
+        verbose_name_plural = _("Updates")
+
+    def __str__(self):
+        return f"{self.user_id}:{self.pts}"
+
+    @staticmethod
+    def append(user_pk: Any, payload: Dict[str, Any]) -> Optional[int]:
+        """
+        Stores the payload as the user's next update, adding its sequence number as 'seq'.
+        Returns the sequence number, None if the user does not exist.
+        """
+        with transaction.atomic():
+            pts = UpdateSequenceModel.next_pts(user_pk)
+            if pts is None:
+                return None
+            payload['seq'] = pts
+            UpdateLogModel.objects.create(user_id=user_pk, pts=pts, payload=json.dumps(payload))
+            # Trimmed every UPDATE_LOG_MAX_ENTRIES / 10 updates, so the log holds up to 110% of the limit
+            if pts % max(UPDATE_LOG_MAX_ENTRIES // 10, 1) == 0:
+                UpdateLogModel.objects.filter(user_id=user_pk, pts__lte=pts - UPDATE_LOG_MAX_ENTRIES).delete()
+        return pts
+
+    @staticmethod
+    def get_updates_since(user_pk: Any, pts: int) -> Tuple[int, Optional[List[str]]]:
+        """
+        Returns the user's current sequence number and the JSON payloads of updates after `pts`, in order.
+        The payloads are None if some of them were already trimmed (or `pts` is unknown),
+        i.e. the client has to resync.
+        """
+        current = UpdateSequenceModel.current_pts(user_pk)
+        if pts > current:
+            return current, None
+        if pts == current:
+            return current, []
+        updates = list(UpdateLogModel.objects.filter(user_id=user_pk, pts__gt=pts).order_by('pts')
+                       .values_list('pts', 'payload'))
+        if not updates or updates[0][0] != pts + 1:
+            return current, None
+        return current, [payload for _, payload in updates]
+
 # TODO:
-# Possible features - update with pts
 # was_online field for User (1to1 model)
 # read_at - timestamp
@@ -1,4 +1,4 @@
-from .models import MessageModel, DialogsModel, UserModel, UploadedFile
+from .models import MessageModel, DialogsModel, UploadedFile
 from typing import Optional, Dict
 import os
 
@@ -29,21 +29,17 @@ def serialize_message_model(m: MessageModel, user_id):
 
 
 def serialize_dialog_model(m: DialogsModel, user_id):
-    username_field = UserModel.USERNAME_FIELD
-    other_user_pk, other_user_username = UserModel.objects.filter(pk=m.user1.pk).values_list('pk',
-                                                                                             username_field).first() \
-        if m.user2.pk == user_id else UserModel.objects.filter(pk=m.user2.pk).values_list('pk', username_field).first()
-    unread_count = MessageModel.get_unread_count_for_dialog_with_user(sender=other_user_pk, recipient=user_id)
-    last_message: Optional[MessageModel] = MessageModel.get_last_message_for_dialog(sender=other_user_pk,
-                                                                                    recipient=user_id)
+    # Doesn't run any queries for dialogs from DialogsModel.get_dialogs_list_for_user
+    other_user = m.user1 if m.user2_id == user_id else m.user2
+    last_message: Optional[MessageModel] = m.last_message
     last_message_ser = serialize_message_model(last_message, user_id) if last_message else None
     obj = {
         "id": m.id,
         "created": int(m.created.timestamp()),
         "modified": int(m.modified.timestamp()),
-        "other_user_id": str(other_user_pk),
-        "unread_count": unread_count,
-        "username": other_user_username,
+        "other_user_id": str(other_user.pk),
+        "unread_count": m.unread_count_for(user_id),
+        "username": other_user.get_username(),
         "last_message": last_message_ser
     }
     return obj
@@ -23,34 +23,78 @@ from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser
 from django.urls import reverse_lazy
 from django.forms import ModelForm
+from typing import Optional
+import heapq
 import json
 
 
 class MessagesModelList(LoginRequiredMixin, ListView):
+    """
+    Messages, newest first, paginated with message id cursors: `?before=<id>` for older messages,
+    `?after=<id>` for newer ones and `?limit=` (up to MESSAGES_PAGINATION). Every page costs two indexed queries,
+    `has_more` tells whether there are more messages in the same direction.
+    """
     http_method_names = ['get', ]
-    paginate_by = getattr(settings, 'MESSAGES_PAGINATION', 500)
+    page_size = getattr(settings, 'MESSAGES_PAGINATION', 500)
+
+    def get_int_param(self, name: str) -> Optional[int]:
+        value = self.request.GET.get(name)
+        if value is None:
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError(f"'{name}' should be an int")
+        if value <= 0:
+            raise ValueError(f"'{name}' should be > 0")
+        return value
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.before, self.after = self.get_int_param('before'), self.get_int_param('after')
+            self.limit = min(self.get_int_param('limit') or self.page_size, self.page_size)
+            if self.before is not None and self.after is not None:
+                raise ValueError("'before' and 'after' can't be used together")
+        except ValueError as e:
+            return HttpResponseBadRequest(content=json.dumps({'errors': str(e)}))
+        return super().get(request, *args, **kwargs)
 
     def get_queryset(self):
-        if self.kwargs.get('dialog_with'):
-            qs = MessageModel.objects \
-                .filter(Q(recipient=self.request.user, sender=self.kwargs['dialog_with']) |
-                        Q(sender=self.request.user, recipient=self.kwargs['dialog_with'])) \
-                .select_related('sender', 'recipient')
+        user = self.request.user
+        dialog_with = self.kwargs.get('dialog_with')
+        if dialog_with:
+            directions = [MessageModel.objects.filter(sender=user, recipient=dialog_with)]
+            if str(dialog_with) != str(user.pk):
+                directions.append(MessageModel.objects.filter(sender=dialog_with, recipient=user))
         else:
-            qs = MessageModel.objects.filter(Q(recipient=self.request.user) |
-                                             Q(sender=self.request.user)).prefetch_related('sender', 'recipient', 'file')
+            directions = [MessageModel.objects.filter(sender=user),
+                          MessageModel.objects.filter(recipient=user).exclude(sender=user)]
 
-        return qs.order_by('-created')
+        if self.after is not None:
+            cursor, order = Q(id__gt=self.after), 'id'
+        elif self.before is not None:
+            cursor, order = Q(id__lt=self.before), '-id'
+        else:
+            cursor, order = Q(), '-id'
+        # Every direction is paged on its own index and the pages are merged, filtering both directions with OR
+        # would sort all matching rows before applying the limit. UNION ALL of sliced querysets isn't supported
+        # on every backend, so one query is run per direction
+        pages = [qs.filter(cursor).select_related('sender', 'recipient', 'file').order_by(order)[:self.limit + 1]
+                 for qs in directions]
+        return list(heapq.merge(*pages, key=lambda m: m.id, reverse=order == '-id'))
 
     def render_to_response(self, context, **response_kwargs):
         user_pk = self.request.user.pk
-        data = [serialize_message_model(i, user_pk) for i in context['object_list']]
-        page: Page = context.pop('page_obj')
-        paginator: Paginator = context.pop('paginator')
+        limit = self.limit
+        # One extra row tells whether there's another page, instead of counting them
+        messages = list(context['object_list'][:limit + 1])
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if self.after is not None:
+            messages.reverse()
         return_data = {
-            'page': page.number,
-            'pages': paginator.num_pages,
-            'data': data
+            'data': [serialize_message_model(i, user_pk) for i in messages],
+            'has_more': has_more
         }
         return JsonResponse(return_data, **response_kwargs)
 
@@ -60,9 +104,7 @@ class DialogsModelList(LoginRequiredMixin, ListView):
     paginate_by = getattr(settings, 'DIALOGS_PAGINATION', 20)
 
     def get_queryset(self):
-        qs = DialogsModel.objects.filter(Q(user1_id=self.request.user.pk) | Q(user2_id=self.request.user.pk)) \
-            .select_related('user1', 'user2')
-        return qs.order_by('-created')
+        return DialogsModel.get_dialogs_list_for_user(self.request.user.pk)
 
     def render_to_response(self, context, **response_kwargs):
         # TODO: add online status
@@ -50,15 +50,13 @@ module AppTypes =
               })
 
     type MessagesResponse =
-        { page: int
-          pages: int
+        { has_more: bool
           data: MessageModel array
           }
         static member Decoder : Decoder<MessagesResponse> =
             Decode.object
                 (fun get ->
-                    { page = get.Required.Field "page" Decode.int
-                      pages = get.Required.Field "pages" Decode.int
+                    { has_more = get.Required.Field "has_more" Decode.bool
                       data = get.Required.Field "data" (Decode.array MessageModel.Decoder)
                     }
                 )
@@ -92,4 +92,4 @@ Thoth.Json.Net only support the folluwing enum types:
 - int
 - uint32
 If you can't use one of these types, please pass an extra encoder.
-                    `))(u);return g=>f(g)}}else if(isGenericType(c))if(isTuple(c)){const s=map_1(u=>x6(t,e,n,u),getTupleElements(c));return u=>R9(mapIndexed((f,g)=>s[f](g),getTupleFields(u)))}else{const s=fullName(getGenericTypeDefinition(c));if(s==="Microsoft.FSharp.Core.FSharpOption`1[System.Object]"){const u=new Lazy(()=>hm(x6(t,e,n,getGenerics(c)[0])));return f=>f==null?Mu:u.Value(f)}else if(s==="Microsoft.FSharp.Collections.FSharpList`1[System.Object]"?!0:s==="Microsoft.FSharp.Collections.FSharpSet`1[System.Object]"){const u=x6(t,e,n,getGenerics(c)[0]);return f=>R9(map_2(u,f))}else if(s==="Microsoft.FSharp.Collections.FSharpMap`2[System.Object,System.Object]"){const u=getGenerics(c)[0],f=x6(t,e,n,getGenerics(c)[1]);if(fullName(u)==="System.String"?!0:fullName(u)==="System.Guid")return g=>fold((_,L)=>{const E=L,R=E[1],U=E[0];return _[U]=f(R),_},{},g);{let g;const _=x6(t,e,n,u);return g=L=>_(L),L=>R9(map_2(E=>{const R=E,U=R[1],W=R[0];return[g(W),f(U)]},L))}}else return yu(t,e,n,c)}else return o==="System.Boolean"?s=>s:o==="Microsoft.FSharp.Core.Unit"?lm:o==="System.String"?s=>s:o==="System.SByte"?s=>fa(s):o==="System.Byte"?s=>va(s):o==="System.Int16"?s=>da(s):o==="System.UInt16"?s=>ga(s):o==="System.Int32"?s=>s:o==="System.UInt32"?s=>s:o==="System.Double"?s=>s:o==="System.Single"?s=>s:o==="System.DateTime"?s=>um(s):o==="System.DateTimeOffset"?s=>om(s):o==="System.TimeSpan"?s=>im(s):o==="System.Guid"?s=>am(s):o==="System.Object"?s=>s:yu(t,e,n,c);else{const s=i;return u=>s.contents(u)}}function Cu(t){if(t!=null){const e=t;return map_3((n,c)=>{const o=c[0];return new FSharpRef(o)},e.Coders)}else return empty()}class fm{constructor(){}}function iX(){return class_type("Thoth.Json.Encode.Auto",void 0,fm)}function lX(t,e,n,c){const o=value_34(c).ResolveType(),i=defaultArg(t,new CaseStrategy(0)),s=defaultArg(n,!0);let u,f;const g=fullName(o);return f=toString_5(i)+g,u=defaultArg(map(_=>_.Hash,e),"")+f,Util_Cache$1__GetOrAdd_43981464(Util_CachedEncoders,u,()=>x6(Cu(e),i,s,o))}function vm(t,e,n,c){const o=defaultArg(t,new CaseStrategy(0)),i=defaultArg(n,!0),s=value_34(c).ResolveType();return x6(Cu(e),o,i,s)}function sX(t,e,n,c,o,i){const s=vm(n,c,o,i);return pa(t,s(e))}function uX(t,e){return pa(t,e)}class xu extends W2{constructor(e,n,c,o){super();this.id=e,this.url=n,this.name=c,this.size=o|0}}function Su(){return record_type("App.AppTypes.MessageModelFile",[],xu,()=>[["id",string_type],["url",string_type],["name",string_type],["size",int32_type]])}function ma(){return t=>e=>i3(n=>new xu(n.Required.Field("id",(c,o)=>k2(c,o)),n.Required.Field("url",(c,o)=>k2(c,o)),n.Required.Field("name",(c,o)=>k2(c,o)),n.Required.Field("size",j1(2,F3))),t,e)}class Iu extends W2{constructor(e,n,c,o,i,s,u,f,g,_){super();this.id=e|0,this.text=n,this.sent=c,this.edited=o,this.read=i,this.file=s,this.sender=u,this.recipient=f,this.sender_username=g,this.out=_}}function Hu(){return record_type("App.AppTypes.MessageModel",[],Iu,()=>[["id",int32_type],["text",string_type],["sent",class_type("System.DateTimeOffset")],["edited",class_type("System.DateTimeOffset")],["read",bool_type],["file",option_type(Su())],["sender",string_type],["recipient",string_type],["sender_username",string_type],["out",bool_type]])}function Fu(){return t=>e=>i3(n=>new Iu(n.Required.Field("id",j1(2,F3)),n.Required.Field("text",(c,o)=>k2(c,o)),Y2(l5(n.Required.Field("sent",j1(2,e0)))*1e3,0),Y2(l5(n.Required.Field("edited",j1(2,e0)))*1e3,0),n.Required.Field("read",(c,o)=>ha(c,o)),n.Optional.Field("file",j1(2,ma())),n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("recipient",(c,o)=>k2(c,o)),n.Required.Field("sender_username",(c,o)=>k2(c,o)),n.Required.Field("out",(c,o)=>ha(c,o))),t,e)}class Vu extends W2{constructor(e,n,c){super();this.page=e|0,this.pages=n|0,this.data=c}}function hX(){return record_type("App.AppTypes.MessagesResponse",[],Vu,()=>[["page",int32_type],["pages",int32_type],["data",array_type(Hu())]])}function dm(){return t=>e=>i3(n=>{let c;return new Vu(n.Required.Field("page",j1(2,F3)),n.Required.Field("pages",j1(2,F3)),n.Required.Field("data",j1(2,(c=Fu(),o=>i=>m7(j1(2,c),o,i)))))},t,e)}class Lu extends W2{constructor(e,n){super();this.pk=e,this.username=n}}function fX(){return record_type("App.AppTypes.UserInfoResponse",[],Lu,()=>[["pk",string_type],["username",string_type]])}function Bu(){return t=>e=>i3(n=>new Lu(n.Required.Field("pk",(c,o)=>k2(c,o)),n.Required.Field("username",(c,o)=>k2(c,o))),t,e)}class Eu extends W2{constructor(e,n,c,o,i,s,u){super();this.id=e|0,this.created=n,this.modified=c,this.other_user_id=o,this.unread_count=i|0,this.username=s,this.last_message=u}}function gm(){return record_type("App.AppTypes.DialogModel",[],Eu,()=>[["id",int32_type],["created",class_type("System.DateTimeOffset")],["modified",class_type("System.DateTimeOffset")],["other_user_id",string_type],["unread_count",int32_type],["username",string_type],["last_message",option_type(Hu())]])}function pm(){return t=>e=>i3(n=>{let c;return new Eu(n.Required.Field("id",j1(2,F3)),Y2(l5(n.Required.Field("created",j1(2,e0)))*1e3,0),Y2(l5(n.Required.Field("modified",j1(2,e0)))*1e3,0),n.Required.Field("other_user_id",(o,i)=>k2(o,i)),n.Required.Field("unread_count",j1(2,F3)),n.Required.Field("username",(o,i)=>k2(o,i)),n.Required.Field("last_message",j1(2,(c=Fu(),o=>i=>su(j1(2,c),o,i)))))},t,e)}class bu extends W2{constructor(e,n,c){super();this.page=e|0,this.pages=n|0,this.data=c}}function vX(){return record_type("App.AppTypes.DialogsResponse",[],bu,()=>[["page",int32_type],["pages",int32_type],["data",array_type(gm())]])}function mm(){return t=>e=>i3(n=>{let c;return new bu(n.Required.Field("page",j1(2,F3)),n.Required.Field("pages",j1(2,F3)),n.Required.Field("data",j1(2,(c=pm(),o=>i=>m7(j1(2,c),o,i)))))},t,e)}class Gu extends W2{constructor(e,n){super();this.sender=e,this.unread_count=n|0}}function dX(){return record_type("App.AppTypes.MessageTypeNewUnreadCount",[],Gu,()=>[["sender",string_type],["unread_count",int32_type]])}function zm(){return t=>e=>i3(n=>new Gu(n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("unread_count",j1(2,F3))),t,e)}class Tu extends W2{constructor(e,n,c){super();this.message_id=e,this.sender=n,this.receiver=c}}function gX(){return record_type("App.AppTypes.MessageTypeMessageRead",[],Tu,()=>[["message_id",class_type("System.Int64")],["sender",string_type],["receiver",string_type]])}function Mm(){return t=>e=>i3(n=>new Tu(n.Required.Field("message_id",j1(2,e0)),n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("receiver",(c,o)=>k2(c,o))),t,e)}class Nu extends W2{constructor(e,n,c,o,i){super();this.random_id=e,this.text=n,this.sender=c,this.receiver=o,this.sender_username=i}}function pX(){return record_type("App.AppTypes.MessageTypeTextMessage",[],Nu,()=>[["random_id",class_type("System.Int64")],["text",string_type],["sender",string_type],["receiver",string_type],["sender_username",string_type]])}function _m(){return t=>e=>i3(n=>new Nu(n.Required.Field("random_id",j1(2,e0)),n.Required.Field("text",(c,o)=>k2(c,o)),n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("receiver",(c,o)=>k2(c,o)),n.Required.Field("sender_username",(c,o)=>k2(c,o))),t,e)}class Au extends W2{constructor(e,n,c,o,i){super();this.db_id=e,this.file=n,this.sender=c,this.receiver=o,this.sender_username=i}}function mX(){return record_type("App.AppTypes.MessageTypeFileMessage",[],Au,()=>[["db_id",class_type("System.Int64")],["file",Su()],["sender",string_type],["receiver",string_type],["sender_username",string_type]])}function wm(){return t=>e=>i3(n=>new Au(n.Required.Field("db_id",j1(2,e0)),n.Required.Field("file",j1(2,ma())),n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("receiver",(c,o)=>k2(c,o)),n.Required.Field("sender_username",(c,o)=>k2(c,o))),t,e)}class ku extends W2{constructor(e,n){super();this.random_id=e,this.db_id=n}}function zX(){return record_type("App.AppTypes.MessageTypeMessageIdCreated",[],ku,()=>[["random_id",class_type("System.Int64")],["db_id",class_type("System.Int64")]])}function ym(){return t=>e=>i3(n=>new ku(n.Required.Field("random_id",j1(2,e0)),n.Required.Field("db_id",j1(2,e0))),t,e)}class Ou extends W2{constructor(e){super();this.error=e}}function MX(){return record_type("App.AppTypes.MessageTypeErrorOccurred",[],Ou,()=>[["error",tuple_type(enum_type("App.AppTypes.ErrorTypes",int32_type,[["MessageParsingError",1],["TextMessageInvalid",2],["InvalidMessageReadId",3],["InvalidUserPk",4],["InvalidRandomId",5],["FileMessageInvalid",6],["FileDoesNotExist",7]]),string_type)]])}function Cm(){return t=>e=>i3(n=>new Ou(n.Required.Field("error",j1(2,vu((c,o)=>d2((i,s,u)=>n0(i,s,u),j1(2,F3),c,o),(c,o)=>k2(c,o))))),t,e)}class Pu extends W2{constructor(e){super();this.user_pk=e}}function _X(){return record_type("App.AppTypes.GenericUserPKMessage",[],Pu,()=>[["user_pk",string_type]])}function za(){return t=>e=>i3(n=>new Pu(n.Required.Field("user_pk",(c,o)=>k2(c,o))),t,e)}function M7(t,e){const n=vv(e,xr(["msg_type",wu(t)]));return pa(0,_u(n))}const xm=t=>e=>i3(n=>n.Required.Field("msg_type",(c,o)=>d2((i,s,u)=>n0(i,s,u),j1(2,F3),c,o)),t,e);class Ru extends W2{constructor(e,n,c){super();this.click=e,this.loading=n,this.download=c}}function Sm(){return record_type("App.AppTypes.MessageBoxDataStatus",[],Ru,()=>[["click",bool_type],["loading",float64_type],["download",bool_type]])}class _7 extends W2{constructor(e,n,c,o,i,s){super();this.dialog_id=e,this.message_id=n,this.out=c,this.size=o,this.uri=i,this.status=s}}function Im(){return record_type("App.AppTypes.MessageBoxData",[],_7,()=>[["dialog_id",string_type],["message_id",class_type("System.Int64")],["out",bool_type],["size",option_type(string_type)],["uri",option_type(string_type)],["status",option_type(Sm())]])}class w7 extends W2{constructor(e,n,c,o,i,s,u,f,g){super();this.position=e,this.type=n,this.text=c,this.title=o,this.status=i,this.avatar=s,this.date=u,this.data=f,this.onDownload=g}}function Hm(){return record_type("App.AppTypes.MessageBox",[],w7,()=>[["position",string_type],["type",string_type],["text",string_type],["title",string_type],["status",string_type],["avatar",string_type],["date",class_type("System.DateTimeOffset")],["data",Im()],["onDownload",option_type(lambda_type(obj_type,unit_type))]])}function Fm(t){return jt(t.data.message_id,c4(0,0,!1))>0}class D9 extends W2{constructor(e,n,c,o,i,s,u,f,g,_){super();this.id=e,this.avatar=n,this.avatarFlexible=c,this.statusColor=o,this.statusColorType=i,this.alt=s,this.title=u,this.date=f,this.subtitle=g,this.unread=_|0}}function Du(){return record_type("App.AppTypes.ChatItem",[],D9,()=>[["id",string_type],["avatar",string_type],["avatarFlexible",bool_type],["statusColor",string_type],["statusColorType",option_type(string_type)],["alt",string_type],["title",string_type],["date",class_type("System.DateTimeOffset")],["subtitle",string_type],["unread",int32_type]])}class Vm extends null{constructor(e,n,c,o,i){super();this.socketConnectionState=e|0,this.messageList=n,this.dialogList=c,this.selectedDialog=o,this.socket=i}}function wX(){return record_type("App.AppTypes.State",[],Vm,()=>[["socketConnectionState",int32_type],["messageList",array_type(Hm())],["dialogList",array_type(Du())],["selectedDialog",Du()],["socket",class_type("Browser.Types.WebSocket")]])}function yX(t){return Promise.reject(t)}function ju(t){return t.then(e=>new G1(0,e),e=>new G1(1,e))}function j9(t,e){return e.then(n=>P3(t,n))}function CX(t,e){return e.then(n=>{if(n.tag===1){const c=n.fields[0];return Promise.resolve(new FSharpResult$2(1,c))}else{const c=n.fields[0];return ju(t(c))}})}function xX(t,e){return e.then(n=>Result_MapError(t,n))}function SX(t,e){return e.then(n=>(t(n),n))}class Uu{constructor(){}}function IX(){return class_type("Promise.PromiseBuilder",void 0,Uu)}function Lm(){return new Uu}function HX(t,e,n){let c=Promise.resolve(void 0);const o=getEnumerator(e);try{for(;o["System.Collections.IEnumerator.MoveNext"]();){const i=o["System.Collections.Generic.IEnumerator`1.get_Current"]();c=c.then(()=>n(i))}}finally{o.Dispose()}return c}function Bm(t,e,n){return e()?n.then(()=>Bm(t,e,n)):Promise.resolve(void 0)}function Em(t,e,n){return e.then(c=>(n(),c),c=>{throw n(),c})}function I5(t,e){return{then:(n,c)=>{try{return e().then(n,c)}catch(o){if(g3(c,null))return Promise.reject(o);try{return Promise.resolve(c(o))}catch(i){return Promise.reject(i)}}},catch:n=>{try{return e().catch(n)}catch(c){try{return Promise.resolve(n(c))}catch(o){return Promise.reject(o)}}}}}function H5(t,e){return new Promise((n,c)=>{try{Promise.resolve(e).then(n,c)}catch(o){c(o)}})}function FX(t,e,n){return Em(t,n(e),()=>{e.Dispose()})}const j3=Lm();class bm extends null{constructor(e,...n){super();this.tag=e|0,this.fields=n}cases(){return["Accept","Accept-Charset","Accept-Encoding","Accept-Language","Accept-Datetime","Authorization","Cache-Control","Connection","Cookie","Content-Length","Content-MD5","Content-Type","Date","Expect","Forwarded","From","Host","If-Match","If-Modified-Since","If-None-Match","If-Range","If-Unmodified-Since","Max-Forwards","Origin","Pragma","Proxy-Authorization","Range","Referer","SOAPAction","TE","User-Agent","Upgrade","Via","Warning","X-Requested-With","DNT","X-Forwarded-For","X-Forwarded-Host","X-Forwarded-Proto","Front-End-Https","X-Http-Method-Override","X-ATT-DeviceId","X-Wap-Profile","Proxy-Connection","X-UIDH","X-Csrf-Token","Custom"]}}function VX(){return union_type("Fetch.Types.HttpRequestHeaders",[],bm,()=>[[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",int32_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["key",string_type],["value",obj_type]]])}class y7 extends Ze{constructor(e,...n){super();this.tag=e|0,this.fields=n}cases(){return["Method","Headers","Body","Mode","Credentials","Cache","Redirect","Referrer","ReferrerPolicy","Integrity","KeepAlive","Signal"]}}function LX(){return union_type("Fetch.Types.RequestProperties",[],y7,()=>[[["Item",string_type]],[["Item",class_type("Fetch.Types.IHttpRequestHeaders")]],[["Item",obj_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",bool_type]],[["Item",class_type("Fetch.Types.AbortSignal")]]])}function Gm(t){return n8(t.status)+" "+t.statusText+" for URL "+t.url}function qu(t,e){return fetch(t,kf(e,1)).then(c=>{if(c.ok)return c;{const o=Gm(c);throw new Error(o)}})}function F5(t,e){return ju(qu(t,e))}function BX(t){return result(qu(t,singleton(new y7(0,"OPTIONS"))))}var Tm=l4(5712);function Wu(t,e,n){let c=(n==null?-2128831035:w4(n))|0;for(let o=0;o<=t.length;o++)c^=t.charCodeAt(o),c=c+(c<<1)+(c<<4)+(c<<7)+(c<<8)+(c<<24);if(e)return("0000000"+(c>>>0).toString(16)).substr(-8);{let o=c>>0|0;return n8(o)}}function Nm(t){let e=Wu(t,!0,void 0);return e+Wu(e+t,!0,void 0)}const Am=Tm;function g8(t,e){const n=h5(e,20)|0,c=Nm(t),o=new Am(c,{margin:0,size:n});return"data:image/png;base64,"+o}function $u(){const t={};return $2(_i(Ch(0,2147483647)),!1,2)}function Ma(t){const e=Math.floor(Math.log(t)/Math.log(1024)),n=t/Math.pow(1024,e),c=["B","kB","MB","GB","TB"][~~e];return j6(D2("%.2f %s"))(n)(c)}const _a=new Ru(!0,0,!1);function wa(t,e,n){j9(o=>{const i=URL.createObjectURL(o),s=document.createElement("a");s.href=i,s.setAttribute("download",e),s.click(),window.setTimeout(u=>{URL.revokeObjectURL(i)},200)},H5(j3,I5(j3,()=>(console.log(O3("running onDownload for "+t)),console.log(O3(n)),F5(t,U6()).then(o=>{const i=o;if(i.tag===1){const s=i.fields[0];return Promise.resolve(new G1(1,s.message))}else return i.fields[0].blob().then(u=>{const f=u;return Promise.resolve(new G1(0,f))})}))))).then()}function km(t){return h5(w3(e=>e.out?"You: "+e.text:e.text,t),"")}function Om(t){return h5(w3(e=>e.data.out?"You: "+e.text:e.text,t),"")}function Pm(t){const e=g8(t.sender,150);return new w7("left","text",t.text,t.sender_username,"waiting",e,jr(new Date),new _7(t.sender,t.random_id,!1,void 0,void 0,void 0),void 0)}function Rm(t){const e=g8(t.sender,150);return new w7("left","file",t.file.name,t.sender_username,"waiting",e,jr(new Date),new _7(t.sender,t.db_id,!1,Ma(t.file.size),t.file.url,_a),n=>{wa(t.file.url,t.file.name,n)})}function Zu(t,e,n,c,o,i){const s=g8(n,150),u=w3(L=>_a,i),f=w3(L=>Ma(L.size),i),g=w3(L=>L.url,i),_=i!=null?"file":"text";return new w7("right",_,t,c,"waiting",s,jr(new Date),new _7(e,o,!0,f,g,u),w3(L=>E=>{wa(L.url,L.name,E)},i))}function Dm(t){return new D9(t.data.dialog_id,g8(t.data.dialog_id,void 0),!0,"lightgreen",void 0,t.title,t.title,t.date,t.text,1)}class jm extends null{constructor(e,n,c,o,i,s){super();this.addMessage=e,this.replaceMessageId=n,this.addPKToTyping=c,this.changePKOnlineStatus=o,this.setMessageIdAsRead=i,this.newUnreadCount=s}}function EX(){return record_type("App.WSHandlingCallbacks",[],jm,()=>[["addMessage",lambda_type(MessageBox$reflection(),unit_type)],["replaceMessageId",lambda_type(class_type("System.Int64"),lambda_type(class_type("System.Int64"),unit_type))],["addPKToTyping",lambda_type(string_type,unit_type)],["changePKOnlineStatus",lambda_type(string_type,lambda_type(bool_type,unit_type))],["setMessageIdAsRead",lambda_type(class_type("System.Int64"),unit_type)],["newUnreadCount",lambda_type(string_type,lambda_type(int32_type,unit_type))]])}function Um(t,e,n){const c=Bf(o=>{switch(o){case 1:return c3(D2("Received MessageTypes.WentOnline - %s"))(e),P3(i=>{n.changePKOnlineStatus(i.user_pk,!0)},p4(j1(2,za()),e));case 2:return c3(D2("Received MessageTypes.WentOffline - %s"))(e),P3(i=>{n.changePKOnlineStatus(i.user_pk,!1)},p4(j1(2,za()),e));case 3:return c3(D2("Received MessageTypes.TextMessage - %s"))(e),P3(n.addMessage,P3(i=>Pm(i),p4(j1(2,_m()),e)));case 4:return c3(D2("Received MessageTypes.FileMessage - %s"))(e),P3(n.addMessage,P3(i=>Rm(i),p4(j1(2,wm()),e)));case 5:return c3(D2("Received MessageTypes.IsTyping - %s"))(e),P3(i=>{n.addPKToTyping(i.user_pk)},p4(j1(2,za()),e));case 6:return c3(D2("Received MessageTypes.MessageRead - %s"))(e),P3(i=>{n.setMessageIdAsRead(i.message_id)},p4(j1(2,Mm()),e));case 7:{c3(D2("Received MessageTypes.ErrorOccurred - %s"))(e);const i=p4(j1(2,Cm()),e);if(i.tag===1){const s=i.fields[0];return new G1(1,s)}else{const s=i.fields[0],u=j6(D2("Error: %A, message %s"))(s.error[0])(s.error[1]);return new G1(1,u)}}case 8:return c3(D2("Received MessageTypes.MessageIdCreated - %s"))(e),P3(i=>{n.replaceMessageId(i.random_id,i.db_id)},p4(j1(2,ym()),e));case 9:return c3(D2("Received MessageTypes.NewUnreadCount - %s"))(e),P3(i=>{n.newUnreadCount(i.sender,i.unread_count)},p4(j1(2,zm()),e));default:{const i=o|0;return c3(D2("Received unhandled MessageType %A"))(i),new G1(0,void 0)}}},p4(j1(2,xm),e));if(c.tag===1){const o=c.fields[0];c3(D2("Error while processing message %s - error: %s"))(e)(o);const i=xr(["error",sm(s=>wu(s),s=>s,1,j6(D2("msg_type decoding error - %s"))(o))]);return t.send(M7(7,i)),j6(D2("Error occured - %s"))(o)}else return}function qm(t,e,n,c){c3(D2("Sending text message: '%A', user_pk:'%A'"))(e)(n);const o=$u(),i=C4([["text",e],["user_pk",n],["random_id",~~_3(o)]]);return t.send(M7(3,i)),w3(s=>Zu(e,n,s.pk,s.username,o,void 0),c)}function Wm(t,e,n,c){c3(D2("Sending file message: '%s', user_pk:'%s'"))(n.id)(e);const o=$u(),i=C4([["file_id",n.id],["user_pk",e],["random_id",~~_3(o)]]);return t.send(M7(4,i)),w3(s=>Zu(n.name,e,s.pk,s.username,o,n),c)}function $m(t){t.send(M7(5,U6()))}function ya(t,e,n){c3(D2("Sending 'read' message for message_id '%i', user_pk:'%A'"))(n)(e);const c=C4([["user_pk",e],["message_id",~~_3(n)]]);t.send(M7(6,c))}const C7="http://127.0.0.1:8000",Zm=j6(D2("%s/messages/"))(C7),Km=j6(D2("%s/dialogs/"))(C7),Qm=j6(D2("%s/self/"))(C7),Ym=j6(D2("%s/users/"))(C7),Xm=j6(D2("%s/upload/"))(C7);function Jm(t,e){return H5(j3,I5(j3,()=>{const n=new FormData;n.append("file",t[0]);const c=new y7(1,{["X-CSRFToken"]:e}),o=C4([new y7(0,"POST"),new y7(2,n),c]);return F5(Xm,o).then(i=>{const s=i;if(s.tag===1){const u=s.fields[0];return Promise.resolve(new G1(1,u.message))}else return s.fields[0].text().then(f=>{const g=f,_=p4(j1(2,ma()),g);return Promise.resolve(_)})})}))}function tz(){return H5(j3,I5(j3,()=>F5(Qm,U6()).then(t=>{const e=t;if(e.tag===1){const n=e.fields[0];return Promise.resolve(new G1(1,n.message))}else return e.fields[0].text().then(c=>{const o=c,i=p4(j1(2,Bu()),o);return Promise.resolve(i)})})))}function ez(t){const e=v5(n=>n.id,t);return j9(n=>v5(c=>new D9(c.pk,g8(c.pk,void 0),!0,"",void 0,c.username,c.username,Yl(),"",0),n.filter(c=>!Wf(c.pk,e,{Equals:(o,i)=>o===i,GetHashCode:o=>Pt(o)}))),H5(j3,I5(j3,()=>F5(Ym,U6()).then(n=>{const c=n;if(c.tag===1){const o=c.fields[0];return Promise.resolve(new G1(1,o.message))}else return c.fields[0].text().then(i=>{let s;const u=i,f=p4(j1(2,(s=Bu(),g=>_=>m7(j1(2,s),g,_))),u);return Promise.resolve(f)})}))))}function nz(){return j9(t=>Xf(e=>e.date,v5(e=>{const n=e.file!=null?"file":"text";let c;const o=[e.out,e.read];c=o[1]?"read":o[0]?"sent":"received";const i=g8(e.sender,150),s=e.out?e.recipient:e.sender,u=w3(E=>_a,e.file),f=w3(E=>Ma(E.size),e.file),g=w3(E=>E.url,e.file);let _;const L=e.file;return L==null?_=e.text:_=L.name,new w7(e.out?"right":"left",n,_,e.sender_username,c,i,e.sent,new _7(s,$2(e.id,!1,2),e.out,f,g,u),w3(E=>R=>{wa(E.url,E.name,R)},e.file))},t.data),{Compare:(e,n)=>Cf(e,n)}),H5(j3,I5(j3,()=>F5(Zm,U6()).then(t=>{const e=t;if(e.tag===1){const n=e.fields[0];return Promise.resolve(new G1(1,n.message))}else return e.fields[0].text().then(c=>{const o=c,i=p4(j1(2,dm()),o);return Promise.resolve(i)})}))))}function Ku(t,e){if(t==null)return new Array(0);{const n=t;return e.filter(c=>c.data.dialog_id===n.id)}}function cz(t,e,n,c){Ku(e,n).filter(o=>(o.status!=="read"?o.data.out===!1:!1)?Fm(o):!1).forEach(o=>{c(o.data.message_id),ya(t,e.id,o.data.message_id)})}function rz(){return j9(t=>v5(e=>new D9(e.other_user_id,g8(e.other_user_id,void 0),!0,"",void 0,e.username,e.username,h5(w3(n=>n.sent,e.last_message),e.created),km(e.last_message),e.unread_count),t.data),H5(j3,I5(j3,()=>F5(Km,U6()).then(t=>{const e=t;if(e.tag===1){const n=e.fields[0];return Promise.resolve(new G1(1,n.message))}else return e.fields[0].text().then(c=>{const o=c,i=p4(j1(2,mm()),o);return Promise.resolve(i)})}))))}var bX=l4(257),GX=l4(9718),Z2=Object.assign;const Qu=5e3,az=(t,e)=>e.date-t.date;function oz(){const t="csrftoken";let e=null;if(document.cookie&&document.cookie!==""){let n=document.cookie.split(";");for(let c=0;c<n.length;c++){let o=n[c].trim();if(o.substring(0,t.length+1)===t+"="){e=decodeURIComponent(o.substring(t.length+1));break}}}return e}class iz extends I.Component{constructor(e){super(e);this.textInput=null,this.setTextInputRef=n=>{this.textInput=n},this.clearTextInput=()=>{this.textInput&&this.textInput.clear()},this.searchInput=null,this.setSearchInputRef=n=>{this.searchInput=n},this.fileInput=null,this.setFileInputRef=n=>{this.fileInput=n},this.clearSearchInput=()=>{this.searchInput&&this.searchInput.clear()},this.state={socketConnectionState:0,showNewChatPopup:!1,newChatChosen:null,usersDataLoading:!1,availableUsers:[],messageList:[],dialogList:[],filteredDialogList:[],typingPKs:[],onlinePKs:[],selfInfo:null,selectedDialog:null,socket:new hh("ws://"+window.location.host+"/chat_ws")},this.performSendingMessage=this.performSendingMessage.bind(this),this.addMessage=this.addMessage.bind(this),this.replaceMessageId=this.replaceMessageId.bind(this),this.addPKToTyping=this.addPKToTyping.bind(this),this.changePKOnlineStatus=this.changePKOnlineStatus.bind(this),this.setMessageIdAsRead=this.setMessageIdAsRead.bind(this),this.newUnreadCount=this.newUnreadCount.bind(this),this.triggerFileRefClick=this.triggerFileRefClick.bind(this),this.handleFileInputChange=this.handleFileInputChange.bind(this),this.isTyping=Y1()(()=>{$m(this.state.socket)},Qu),this.localSearch=Y1()(()=>{let n=this.searchInput.input.value;console.log("localSearch with '"+n+"'"),!n||n.length===0?this.setState(c=>({filteredDialogList:c.dialogList})):this.setState(c=>({filteredDialogList:c.dialogList.filter(function(o){return o.title.toLowerCase().includes(n.toLowerCase())})}))},100)}componentDidMount(){nz().then(o=>{o.tag===0?(console.log("Fetched messages:"),console.log(o.fields[0]),this.setState({messageList:o.fields[0]})):(console.log("Messages error:"),C1.error(o.fields[0]))}),rz().then(o=>{o.tag===0?(console.log("Fetched dialogs:"),console.log(o.fields[0]),this.setState({dialogList:o.fields[0],filteredDialogList:o.fields[0]}),this.selectDialog(o.fields[0][0])):(console.log("Dialogs error:"),C1.error(o.fields[0]))}),tz().then(o=>{o.tag===0?(console.log("Fetched selfInfo:"),console.log(o.fields[0]),this.setState({selfInfo:o.fields[0]})):(console.log("SelfInfo error:"),C1.error(o.fields[0]))}),this.setState({socketConnectionState:this.state.socket.readyState});const e=this;let n=this.state.socket,c={autoClose:1500,hideProgressBar:!0,closeOnClick:!1,pauseOnHover:!1,pauseOnFocusLoss:!1,draggable:!1};n.onopen=function(o){C1.success("Connected!",c),e.setState({socketConnectionState:n.readyState})},n.onmessage=function(o){e.setState({socketConnectionState:n.readyState});let i=Um(n,o.data,{addMessage:e.addMessage,replaceMessageId:e.replaceMessageId,addPKToTyping:e.addPKToTyping,changePKOnlineStatus:e.changePKOnlineStatus,setMessageIdAsRead:e.setMessageIdAsRead,newUnreadCount:e.newUnreadCount});i&&C1.error(i)},n.onclose=function(o){C1.info("Disconnected...",c),e.setState({socketConnectionState:n.readyState}),console.log("websocket closed")}}selectDialog(e){console.log("Selecting dialog "+e.id),this.setState({selectedDialog:e}),this.setState(n=>({dialogList:n.dialogList.map(c=>c.id===e.id?Z2(Z2({},c),{statusColorType:"encircle"}):Z2(Z2({},c),{statusColorType:void 0}))})),this.setState(n=>({filteredDialogList:n.dialogList})),cz(this.state.socket,e,this.state.messageList,this.setMessageIdAsRead)}getSocketState(){if(this.state.socket.readyState===0)return"Connecting...";if(this.state.socket.readyState===1)return"Connected";if(this.state.socket.readyState===2)return"Disconnecting...";if(this.state.socket.readyState===3)return"Disconnected"}addPKToTyping(e){console.log("Adding "+e+" to typing pk-s");let n=this.state.typingPKs;n.push(e),this.setState({typingPKs:n});const c=this;setTimeout(()=>{console.log("Will remove "+e+" from typing pk-s");let o=c.state.typingPKs;const i=o.indexOf(e);i>-1&&o.splice(i,1),c.setState({typingPKs:o})},Qu)}changePKOnlineStatus(e,n){console.log("Setting "+e+" to "+n?"online":0);let c=this.state.onlinePKs;if(n)c.push(e);else{const o=c.indexOf(e);o>-1&&c.splice(o,1)}this.setState({onlinePKs:c}),this.setState(o=>({dialogList:o.dialogList.map(function(i){return i.id===e?n?Z2(Z2({},i),{statusColor:"lightgreen"}):Z2(Z2({},i),{statusColor:""}):i})})),this.setState(o=>({filteredDialogList:o.dialogList}))}addMessage(e){console.log("Calling addMessage for "),!e.data.out&&e.data.message_id>0&&this.state.selectedDialog&&this.state.selectedDialog.id===e.data.dialog_id&&(ya(this.state.socket,e.data.dialog_id,e.data.message_id),e.status="read");let n=this.state.messageList;n.push(e),console.log(e),this.setState({messageList:n});let c=!1;if(!e.data.out){let o=this.state.dialogList;if(!o.some(s=>s.id===e.data.dialog_id)){let s=Dm(e);o.push(s),c=!0,this.setState({dialogList:o})}}c||this.setState(o=>({dialogList:o.dialogList.map(function(i){return i.id===e.data.dialog_id?(console.log("Setting dialog "+e.data.dialog_id+" last message"),Z2(Z2({},i),{subtitle:Om(e)})):i})})),this.setState(o=>({filteredDialogList:o.dialogList}))}replaceMessageId(e,n){console.log("Replacing random id  "+e+" with db_id "+n),this.setState(c=>({messageList:c.messageList.map(function(o){if(o.data.message_id.Equals(e)){let i="";return o.data.out?i="sent":c.selectedDialog&&c.selectedDialog.id===o.data.dialog_id?(ya(c.socket,o.data.dialog_id,n),i="read"):i="received",Z2(Z2({},o),{data:Z2(Z2({},o.data),{dialog_id:o.data.dialog_id,message_id:n,out:o.data.out}),status:i})}else return o})}))}newUnreadCount(e,n){console.log("Got new unread count "+n+" for dialog "+e),this.setState(c=>({dialogList:c.dialogList.map(function(o){return o.id===e?(console.log("Setting new unread count "+n+" for dialog "+e),Z2(Z2({},o),{unread:n})):o})})),this.setState(c=>({selectedDialog:c.selectedDialog&&c.selectedDialog.id===e?Z2(Z2({},c.selectedDialog),{unread:n}):c.selectedDialog})),this.setState(c=>({filteredDialogList:c.dialogList}))}setMessageIdAsRead(e){console.log("Setting msg_id "+e+" as read"),this.setState(n=>({messageList:n.messageList.map(function(c){return c.data.message_id.Equals(e)?Z2(Z2({},c),{status:"read"}):c})}))}performSendingMessage(){if(this.state.selectedDialog){let e=this.textInput.input.value,n=this.state.selectedDialog.id;this.clearTextInput();let c=qm(this.state.socket,e,n,this.state.selfInfo);console.log("sendOutgoingTextMessage result:"),console.log(c),c&&this.addMessage(c)}}handleFileInputChange(e){console.log("Upload starting..."),console.log(e.target.files),Jm(e.target.files,oz()).then(n=>{if(n.tag===0){console.log("Uploaded file :"),console.log(n.fields[0]);let c=this.state.selectedDialog.id,o=n.fields[0],i=Wm(this.state.socket,c,o,this.state.selfInfo);console.log("sendOutgoingFileMessage result:"),console.log(i),i&&this.addMessage(i)}else console.log("File upload error"),C1.error(n.fields[0])})}triggerFileRefClick(){this.fileInput.click()}render(){return I.createElement("div",{className:"container"},I.createElement("div",{className:"chat-list"},I.createElement(R1.SideBar,{type:"light",top:I.createElement("span",{className:"chat-list"},I.createElement(R1.Input,{placeholder:"Search...",ref:this.setSearchInputRef,onKeyPress:e=>{if(e.charCode!==13&&this.localSearch(),e.charCode===13)return this.localSearch(),console.log("search invoke with"+this.searchInput.input.value),e.preventDefault(),!1},rightButtons:I.createElement("div",null,I.createElement(R1.Button,{type:"transparent",color:"black",onClick:()=>{this.localSearch(),console.log("search invoke with"+this.searchInput.input.value)},icon:{component:I.createElement(th,null),size:18}}),I.createElement(R1.Button,{type:"transparent",color:"black",icon:{component:I.createElement(eh,null),size:18},onClick:()=>this.clearSearchInput()}))}),I.createElement(R1.ChatList,{onClick:(e,n,c)=>this.selectDialog(e),dataSource:this.state.filteredDialogList.slice().sort(az)})),bottom:I.createElement(R1.Button,{type:"transparent",color:"black",disabled:!0,text:"Connection state: "+this.getSocketState()})})),I.createElement("div",{className:"right-panel"},I.createElement(c2,null),I.createElement(R1.Popup,{show:this.state.showNewChatPopup,header:"New chat",headerButtons:[{type:"transparent",color:"black",text:"close",icon:{component:I.createElement(nh,null),size:18},onClick:()=>{this.setState({showNewChatPopup:!1})}}],renderContent:()=>this.state.usersDataLoading?I.createElement("div",null,I.createElement("p",null,"Loading data...")):this.state.availableUsers.length===0?I.createElement("div",null,I.createElement("p",null,"No users available")):I.createElement(R1.ChatList,{onClick:(e,n,c)=>{this.setState({showNewChatPopup:!1}),this.selectDialog(e)},dataSource:this.state.availableUsers})}),I.createElement(R1.Navbar,{left:I.createElement(R1.ChatItem,Z2(Z2({},this.state.selectedDialog),{date:null,unread:0,statusColor:this.state.selectedDialog&&this.state.onlinePKs.includes(this.state.selectedDialog.id)?"lightgreen":"",subtitle:this.state.selectedDialog&&this.state.typingPKs.includes(this.state.selectedDialog.id)?"typing...":""})),right:I.createElement(R1.Button,{type:"transparent",color:"black",onClick:()=>{this.setState({usersDataLoading:!0}),ez(this.state.dialogList).then(e=>{this.setState({usersDataLoading:!1}),e.tag===0?(console.log("Fetched users:"),console.log(e.fields[0]),this.setState({availableUsers:e.fields[0]})):(console.log("Users error:"),C1.error(e.fields[0]))}),this.setState({showNewChatPopup:!0})},icon:{component:I.createElement(Xu,null),size:24}})}),I.createElement(R1.MessageList,{className:"message-list",lockable:!0,onDownload:(e,n,c)=>{console.log("onDownload from messageList"),e.onDownload()},downButtonBadge:this.state.selectedDialog&&this.state.selectedDialog.unread>0?this.state.selectedDialog.unread:"",dataSource:Ku(this.state.selectedDialog,this.state.messageList)}),I.createElement("input",{id:"selectFile",hidden:!0,type:"file",onChange:this.handleFileInputChange,ref:this.setFileInputRef}),I.createElement(R1.Input,{placeholder:"Type here to send a message.",defaultValue:"",ref:this.setTextInputRef,multiline:!0,onKeyPress:e=>{if(e.charCode!==13&&(console.log("key pressed"),this.isTyping()),e.shiftKey&&e.charCode===13)return!0;if(e.charCode===13)return this.state.socket.readyState===1&&(this.performSendingMessage(),e.preventDefault()),!1},leftButtons:I.createElement(R1.Button,{type:"transparent",color:"black",onClick:this.triggerFileRefClick,icon:{component:I.createElement(Ju,null),size:24}}),rightButtons:I.createElement(R1.Button,{text:"Send",disabled:this.state.socket.readyState!==1,onClick:()=>this.performSendingMessage()})})))}}var lz=iz;G.render(I.createElement(I.StrictMode,null,I.createElement(lz,null)),document.getElementById("root"))})()})();
+                    `))(u);return g=>f(g)}}else if(isGenericType(c))if(isTuple(c)){const s=map_1(u=>x6(t,e,n,u),getTupleElements(c));return u=>R9(mapIndexed((f,g)=>s[f](g),getTupleFields(u)))}else{const s=fullName(getGenericTypeDefinition(c));if(s==="Microsoft.FSharp.Core.FSharpOption`1[System.Object]"){const u=new Lazy(()=>hm(x6(t,e,n,getGenerics(c)[0])));return f=>f==null?Mu:u.Value(f)}else if(s==="Microsoft.FSharp.Collections.FSharpList`1[System.Object]"?!0:s==="Microsoft.FSharp.Collections.FSharpSet`1[System.Object]"){const u=x6(t,e,n,getGenerics(c)[0]);return f=>R9(map_2(u,f))}else if(s==="Microsoft.FSharp.Collections.FSharpMap`2[System.Object,System.Object]"){const u=getGenerics(c)[0],f=x6(t,e,n,getGenerics(c)[1]);if(fullName(u)==="System.String"?!0:fullName(u)==="System.Guid")return g=>fold((_,L)=>{const E=L,R=E[1],U=E[0];return _[U]=f(R),_},{},g);{let g;const _=x6(t,e,n,u);return g=L=>_(L),L=>R9(map_2(E=>{const R=E,U=R[1],W=R[0];return[g(W),f(U)]},L))}}else return yu(t,e,n,c)}else return o==="System.Boolean"?s=>s:o==="Microsoft.FSharp.Core.Unit"?lm:o==="System.String"?s=>s:o==="System.SByte"?s=>fa(s):o==="System.Byte"?s=>va(s):o==="System.Int16"?s=>da(s):o==="System.UInt16"?s=>ga(s):o==="System.Int32"?s=>s:o==="System.UInt32"?s=>s:o==="System.Double"?s=>s:o==="System.Single"?s=>s:o==="System.DateTime"?s=>um(s):o==="System.DateTimeOffset"?s=>om(s):o==="System.TimeSpan"?s=>im(s):o==="System.Guid"?s=>am(s):o==="System.Object"?s=>s:yu(t,e,n,c);else{const s=i;return u=>s.contents(u)}}function Cu(t){if(t!=null){const e=t;return map_3((n,c)=>{const o=c[0];return new FSharpRef(o)},e.Coders)}else return empty()}class fm{constructor(){}}function iX(){return class_type("Thoth.Json.Encode.Auto",void 0,fm)}function lX(t,e,n,c){const o=value_34(c).ResolveType(),i=defaultArg(t,new CaseStrategy(0)),s=defaultArg(n,!0);let u,f;const g=fullName(o);return f=toString_5(i)+g,u=defaultArg(map(_=>_.Hash,e),"")+f,Util_Cache$1__GetOrAdd_43981464(Util_CachedEncoders,u,()=>x6(Cu(e),i,s,o))}function vm(t,e,n,c){const o=defaultArg(t,new CaseStrategy(0)),i=defaultArg(n,!0),s=value_34(c).ResolveType();return x6(Cu(e),o,i,s)}function sX(t,e,n,c,o,i){const s=vm(n,c,o,i);return pa(t,s(e))}function uX(t,e){return pa(t,e)}class xu extends W2{constructor(e,n,c,o){super();this.id=e,this.url=n,this.name=c,this.size=o|0}}function Su(){return record_type("App.AppTypes.MessageModelFile",[],xu,()=>[["id",string_type],["url",string_type],["name",string_type],["size",int32_type]])}function ma(){return t=>e=>i3(n=>new xu(n.Required.Field("id",(c,o)=>k2(c,o)),n.Required.Field("url",(c,o)=>k2(c,o)),n.Required.Field("name",(c,o)=>k2(c,o)),n.Required.Field("size",j1(2,F3))),t,e)}class Iu extends W2{constructor(e,n,c,o,i,s,u,f,g,_){super();this.id=e|0,this.text=n,this.sent=c,this.edited=o,this.read=i,this.file=s,this.sender=u,this.recipient=f,this.sender_username=g,this.out=_}}function Hu(){return record_type("App.AppTypes.MessageModel",[],Iu,()=>[["id",int32_type],["text",string_type],["sent",class_type("System.DateTimeOffset")],["edited",class_type("System.DateTimeOffset")],["read",bool_type],["file",option_type(Su())],["sender",string_type],["recipient",string_type],["sender_username",string_type],["out",bool_type]])}function Fu(){return t=>e=>i3(n=>new Iu(n.Required.Field("id",j1(2,F3)),n.Required.Field("text",(c,o)=>k2(c,o)),Y2(l5(n.Required.Field("sent",j1(2,e0)))*1e3,0),Y2(l5(n.Required.Field("edited",j1(2,e0)))*1e3,0),n.Required.Field("read",(c,o)=>ha(c,o)),n.Optional.Field("file",j1(2,ma())),n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("recipient",(c,o)=>k2(c,o)),n.Required.Field("sender_username",(c,o)=>k2(c,o)),n.Required.Field("out",(c,o)=>ha(c,o))),t,e)}class Vu extends W2{constructor(e,n){super();this.has_more=e,this.data=n}}function hX(){return record_type("App.AppTypes.MessagesResponse",[],Vu,()=>[["has_more",bool_type],["data",array_type(Hu())]])}function dm(){return t=>e=>i3(n=>{let c;return new Vu(n.Required.Field("has_more",(o,i)=>ha(o,i)),n.Required.Field("data",j1(2,(c=Fu(),o=>i=>m7(j1(2,c),o,i)))))},t,e)}class Lu extends W2{constructor(e,n){super();this.pk=e,this.username=n}}function fX(){return record_type("App.AppTypes.UserInfoResponse",[],Lu,()=>[["pk",string_type],["username",string_type]])}function Bu(){return t=>e=>i3(n=>new Lu(n.Required.Field("pk",(c,o)=>k2(c,o)),n.Required.Field("username",(c,o)=>k2(c,o))),t,e)}class Eu extends W2{constructor(e,n,c,o,i,s,u){super();this.id=e|0,this.created=n,this.modified=c,this.other_user_id=o,this.unread_count=i|0,this.username=s,this.last_message=u}}function gm(){return record_type("App.AppTypes.DialogModel",[],Eu,()=>[["id",int32_type],["created",class_type("System.DateTimeOffset")],["modified",class_type("System.DateTimeOffset")],["other_user_id",string_type],["unread_count",int32_type],["username",string_type],["last_message",option_type(Hu())]])}function pm(){return t=>e=>i3(n=>{let c;return new Eu(n.Required.Field("id",j1(2,F3)),Y2(l5(n.Required.Field("created",j1(2,e0)))*1e3,0),Y2(l5(n.Required.Field("modified",j1(2,e0)))*1e3,0),n.Required.Field("other_user_id",(o,i)=>k2(o,i)),n.Required.Field("unread_count",j1(2,F3)),n.Required.Field("username",(o,i)=>k2(o,i)),n.Required.Field("last_message",j1(2,(c=Fu(),o=>i=>su(j1(2,c),o,i)))))},t,e)}class bu extends W2{constructor(e,n,c){super();this.page=e|0,this.pages=n|0,this.data=c}}function vX(){return record_type("App.AppTypes.DialogsResponse",[],bu,()=>[["page",int32_type],["pages",int32_type],["data",array_type(gm())]])}function mm(){return t=>e=>i3(n=>{let c;return new bu(n.Required.Field("page",j1(2,F3)),n.Required.Field("pages",j1(2,F3)),n.Required.Field("data",j1(2,(c=pm(),o=>i=>m7(j1(2,c),o,i)))))},t,e)}class Gu extends W2{constructor(e,n){super();this.sender=e,this.unread_count=n|0}}function dX(){return record_type("App.AppTypes.MessageTypeNewUnreadCount",[],Gu,()=>[["sender",string_type],["unread_count",int32_type]])}function zm(){return t=>e=>i3(n=>new Gu(n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("unread_count",j1(2,F3))),t,e)}class Tu extends W2{constructor(e,n,c){super();this.message_id=e,this.sender=n,this.receiver=c}}function gX(){return record_type("App.AppTypes.MessageTypeMessageRead",[],Tu,()=>[["message_id",class_type("System.Int64")],["sender",string_type],["receiver",string_type]])}function Mm(){return t=>e=>i3(n=>new Tu(n.Required.Field("message_id",j1(2,e0)),n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("receiver",(c,o)=>k2(c,o))),t,e)}class Nu extends W2{constructor(e,n,c,o,i){super();this.random_id=e,this.text=n,this.sender=c,this.receiver=o,this.sender_username=i}}function pX(){return record_type("App.AppTypes.MessageTypeTextMessage",[],Nu,()=>[["random_id",class_type("System.Int64")],["text",string_type],["sender",string_type],["receiver",string_type],["sender_username",string_type]])}function _m(){return t=>e=>i3(n=>new Nu(n.Required.Field("random_id",j1(2,e0)),n.Required.Field("text",(c,o)=>k2(c,o)),n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("receiver",(c,o)=>k2(c,o)),n.Required.Field("sender_username",(c,o)=>k2(c,o))),t,e)}class Au extends W2{constructor(e,n,c,o,i){super();this.db_id=e,this.file=n,this.sender=c,this.receiver=o,this.sender_username=i}}function mX(){return record_type("App.AppTypes.MessageTypeFileMessage",[],Au,()=>[["db_id",class_type("System.Int64")],["file",Su()],["sender",string_type],["receiver",string_type],["sender_username",string_type]])}function wm(){return t=>e=>i3(n=>new Au(n.Required.Field("db_id",j1(2,e0)),n.Required.Field("file",j1(2,ma())),n.Required.Field("sender",(c,o)=>k2(c,o)),n.Required.Field("receiver",(c,o)=>k2(c,o)),n.Required.Field("sender_username",(c,o)=>k2(c,o))),t,e)}class ku extends W2{constructor(e,n){super();this.random_id=e,this.db_id=n}}function zX(){return record_type("App.AppTypes.MessageTypeMessageIdCreated",[],ku,()=>[["random_id",class_type("System.Int64")],["db_id",class_type("System.Int64")]])}function ym(){return t=>e=>i3(n=>new ku(n.Required.Field("random_id",j1(2,e0)),n.Required.Field("db_id",j1(2,e0))),t,e)}class Ou extends W2{constructor(e){super();this.error=e}}function MX(){return record_type("App.AppTypes.MessageTypeErrorOccurred",[],Ou,()=>[["error",tuple_type(enum_type("App.AppTypes.ErrorTypes",int32_type,[["MessageParsingError",1],["TextMessageInvalid",2],["InvalidMessageReadId",3],["InvalidUserPk",4],["InvalidRandomId",5],["FileMessageInvalid",6],["FileDoesNotExist",7]]),string_type)]])}function Cm(){return t=>e=>i3(n=>new Ou(n.Required.Field("error",j1(2,vu((c,o)=>d2((i,s,u)=>n0(i,s,u),j1(2,F3),c,o),(c,o)=>k2(c,o))))),t,e)}class Pu extends W2{constructor(e){super();this.user_pk=e}}function _X(){return record_type("App.AppTypes.GenericUserPKMessage",[],Pu,()=>[["user_pk",string_type]])}function za(){return t=>e=>i3(n=>new Pu(n.Required.Field("user_pk",(c,o)=>k2(c,o))),t,e)}function M7(t,e){const n=vv(e,xr(["msg_type",wu(t)]));return pa(0,_u(n))}const xm=t=>e=>i3(n=>n.Required.Field("msg_type",(c,o)=>d2((i,s,u)=>n0(i,s,u),j1(2,F3),c,o)),t,e);class Ru extends W2{constructor(e,n,c){super();this.click=e,this.loading=n,this.download=c}}function Sm(){return record_type("App.AppTypes.MessageBoxDataStatus",[],Ru,()=>[["click",bool_type],["loading",float64_type],["download",bool_type]])}class _7 extends W2{constructor(e,n,c,o,i,s){super();this.dialog_id=e,this.message_id=n,this.out=c,this.size=o,this.uri=i,this.status=s}}function Im(){return record_type("App.AppTypes.MessageBoxData",[],_7,()=>[["dialog_id",string_type],["message_id",class_type("System.Int64")],["out",bool_type],["size",option_type(string_type)],["uri",option_type(string_type)],["status",option_type(Sm())]])}class w7 extends W2{constructor(e,n,c,o,i,s,u,f,g){super();this.position=e,this.type=n,this.text=c,this.title=o,this.status=i,this.avatar=s,this.date=u,this.data=f,this.onDownload=g}}function Hm(){return record_type("App.AppTypes.MessageBox",[],w7,()=>[["position",string_type],["type",string_type],["text",string_type],["title",string_type],["status",string_type],["avatar",string_type],["date",class_type("System.DateTimeOffset")],["data",Im()],["onDownload",option_type(lambda_type(obj_type,unit_type))]])}function Fm(t){return jt(t.data.message_id,c4(0,0,!1))>0}class D9 extends W2{constructor(e,n,c,o,i,s,u,f,g,_){super();this.id=e,this.avatar=n,this.avatarFlexible=c,this.statusColor=o,this.statusColorType=i,this.alt=s,this.title=u,this.date=f,this.subtitle=g,this.unread=_|0}}function Du(){return record_type("App.AppTypes.ChatItem",[],D9,()=>[["id",string_type],["avatar",string_type],["avatarFlexible",bool_type],["statusColor",string_type],["statusColorType",option_type(string_type)],["alt",string_type],["title",string_type],["date",class_type("System.DateTimeOffset")],["subtitle",string_type],["unread",int32_type]])}class Vm extends null{constructor(e,n,c,o,i){super();this.socketConnectionState=e|0,this.messageList=n,this.dialogList=c,this.selectedDialog=o,this.socket=i}}function wX(){return record_type("App.AppTypes.State",[],Vm,()=>[["socketConnectionState",int32_type],["messageList",array_type(Hm())],["dialogList",array_type(Du())],["selectedDialog",Du()],["socket",class_type("Browser.Types.WebSocket")]])}function yX(t){return Promise.reject(t)}function ju(t){return t.then(e=>new G1(0,e),e=>new G1(1,e))}function j9(t,e){return e.then(n=>P3(t,n))}function CX(t,e){return e.then(n=>{if(n.tag===1){const c=n.fields[0];return Promise.resolve(new FSharpResult$2(1,c))}else{const c=n.fields[0];return ju(t(c))}})}function xX(t,e){return e.then(n=>Result_MapError(t,n))}function SX(t,e){return e.then(n=>(t(n),n))}class Uu{constructor(){}}function IX(){return class_type("Promise.PromiseBuilder",void 0,Uu)}function Lm(){return new Uu}function HX(t,e,n){let c=Promise.resolve(void 0);const o=getEnumerator(e);try{for(;o["System.Collections.IEnumerator.MoveNext"]();){const i=o["System.Collections.Generic.IEnumerator`1.get_Current"]();c=c.then(()=>n(i))}}finally{o.Dispose()}return c}function Bm(t,e,n){return e()?n.then(()=>Bm(t,e,n)):Promise.resolve(void 0)}function Em(t,e,n){return e.then(c=>(n(),c),c=>{throw n(),c})}function I5(t,e){return{then:(n,c)=>{try{return e().then(n,c)}catch(o){if(g3(c,null))return Promise.reject(o);try{return Promise.resolve(c(o))}catch(i){return Promise.reject(i)}}},catch:n=>{try{return e().catch(n)}catch(c){try{return Promise.resolve(n(c))}catch(o){return Promise.reject(o)}}}}}function H5(t,e){return new Promise((n,c)=>{try{Promise.resolve(e).then(n,c)}catch(o){c(o)}})}function FX(t,e,n){return Em(t,n(e),()=>{e.Dispose()})}const j3=Lm();class bm extends null{constructor(e,...n){super();this.tag=e|0,this.fields=n}cases(){return["Accept","Accept-Charset","Accept-Encoding","Accept-Language","Accept-Datetime","Authorization","Cache-Control","Connection","Cookie","Content-Length","Content-MD5","Content-Type","Date","Expect","Forwarded","From","Host","If-Match","If-Modified-Since","If-None-Match","If-Range","If-Unmodified-Since","Max-Forwards","Origin","Pragma","Proxy-Authorization","Range","Referer","SOAPAction","TE","User-Agent","Upgrade","Via","Warning","X-Requested-With","DNT","X-Forwarded-For","X-Forwarded-Host","X-Forwarded-Proto","Front-End-Https","X-Http-Method-Override","X-ATT-DeviceId","X-Wap-Profile","Proxy-Connection","X-UIDH","X-Csrf-Token","Custom"]}}function VX(){return union_type("Fetch.Types.HttpRequestHeaders",[],bm,()=>[[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",int32_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["key",string_type],["value",obj_type]]])}class y7 extends Ze{constructor(e,...n){super();this.tag=e|0,this.fields=n}cases(){return["Method","Headers","Body","Mode","Credentials","Cache","Redirect","Referrer","ReferrerPolicy","Integrity","KeepAlive","Signal"]}}function LX(){return union_type("Fetch.Types.RequestProperties",[],y7,()=>[[["Item",string_type]],[["Item",class_type("Fetch.Types.IHttpRequestHeaders")]],[["Item",obj_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",string_type]],[["Item",bool_type]],[["Item",class_type("Fetch.Types.AbortSignal")]]])}function Gm(t){return n8(t.status)+" "+t.statusText+" for URL "+t.url}function qu(t,e){return fetch(t,kf(e,1)).then(c=>{if(c.ok)return c;{const o=Gm(c);throw new Error(o)}})}function F5(t,e){return ju(qu(t,e))}function BX(t){return result(qu(t,singleton(new y7(0,"OPTIONS"))))}var Tm=l4(5712);function Wu(t,e,n){let c=(n==null?-2128831035:w4(n))|0;for(let o=0;o<=t.length;o++)c^=t.charCodeAt(o),c=c+(c<<1)+(c<<4)+(c<<7)+(c<<8)+(c<<24);if(e)return("0000000"+(c>>>0).toString(16)).substr(-8);{let o=c>>0|0;return n8(o)}}function Nm(t){let e=Wu(t,!0,void 0);return e+Wu(e+t,!0,void 0)}const Am=Tm;function g8(t,e){const n=h5(e,20)|0,c=Nm(t),o=new Am(c,{margin:0,size:n});return"data:image/png;base64,"+o}function $u(){const t={};return $2(_i(Ch(0,2147483647)),!1,2)}function Ma(t){const e=Math.floor(Math.log(t)/Math.log(1024)),n=t/Math.pow(1024,e),c=["B","kB","MB","GB","TB"][~~e];return j6(D2("%.2f %s"))(n)(c)}const _a=new Ru(!0,0,!1);function wa(t,e,n){j9(o=>{const i=URL.createObjectURL(o),s=document.createElement("a");s.href=i,s.setAttribute("download",e),s.click(),window.setTimeout(u=>{URL.revokeObjectURL(i)},200)},H5(j3,I5(j3,()=>(console.log(O3("running onDownload for "+t)),console.log(O3(n)),F5(t,U6()).then(o=>{const i=o;if(i.tag===1){const s=i.fields[0];return Promise.resolve(new G1(1,s.message))}else return i.fields[0].blob().then(u=>{const f=u;return Promise.resolve(new G1(0,f))})}))))).then()}function km(t){return h5(w3(e=>e.out?"You: "+e.text:e.text,t),"")}function Om(t){return h5(w3(e=>e.data.out?"You: "+e.text:e.text,t),"")}function Pm(t){const e=g8(t.sender,150);return new w7("left","text",t.text,t.sender_username,"waiting",e,jr(new Date),new _7(t.sender,t.random_id,!1,void 0,void 0,void 0),void 0)}function Rm(t){const e=g8(t.sender,150);return new w7("left","file",t.file.name,t.sender_username,"waiting",e,jr(new Date),new _7(t.sender,t.db_id,!1,Ma(t.file.size),t.file.url,_a),n=>{wa(t.file.url,t.file.name,n)})}function Zu(t,e,n,c,o,i){const s=g8(n,150),u=w3(L=>_a,i),f=w3(L=>Ma(L.size),i),g=w3(L=>L.url,i),_=i!=null?"file":"text";return new w7("right",_,t,c,"waiting",s,jr(new Date),new _7(e,o,!0,f,g,u),w3(L=>E=>{wa(L.url,L.name,E)},i))}function Dm(t){return new D9(t.data.dialog_id,g8(t.data.dialog_id,void 0),!0,"lightgreen",void 0,t.title,t.title,t.date,t.text,1)}class jm extends null{constructor(e,n,c,o,i,s){super();this.addMessage=e,this.replaceMessageId=n,this.addPKToTyping=c,this.changePKOnlineStatus=o,this.setMessageIdAsRead=i,this.newUnreadCount=s}}function EX(){return record_type("App.WSHandlingCallbacks",[],jm,()=>[["addMessage",lambda_type(MessageBox$reflection(),unit_type)],["replaceMessageId",lambda_type(class_type("System.Int64"),lambda_type(class_type("System.Int64"),unit_type))],["addPKToTyping",lambda_type(string_type,unit_type)],["changePKOnlineStatus",lambda_type(string_type,lambda_type(bool_type,unit_type))],["setMessageIdAsRead",lambda_type(class_type("System.Int64"),unit_type)],["newUnreadCount",lambda_type(string_type,lambda_type(int32_type,unit_type))]])}function Um(t,e,n){const c=Bf(o=>{switch(o){case 1:return c3(D2("Received MessageTypes.WentOnline - %s"))(e),P3(i=>{n.changePKOnlineStatus(i.user_pk,!0)},p4(j1(2,za()),e));case 2:return c3(D2("Received MessageTypes.WentOffline - %s"))(e),P3(i=>{n.changePKOnlineStatus(i.user_pk,!1)},p4(j1(2,za()),e));case 3:return c3(D2("Received MessageTypes.TextMessage - %s"))(e),P3(n.addMessage,P3(i=>Pm(i),p4(j1(2,_m()),e)));case 4:return c3(D2("Received MessageTypes.FileMessage - %s"))(e),P3(n.addMessage,P3(i=>Rm(i),p4(j1(2,wm()),e)));case 5:return c3(D2("Received MessageTypes.IsTyping - %s"))(e),P3(i=>{n.addPKToTyping(i.user_pk)},p4(j1(2,za()),e));case 6:return c3(D2("Received MessageTypes.MessageRead - %s"))(e),P3(i=>{n.setMessageIdAsRead(i.message_id)},p4(j1(2,Mm()),e));case 7:{c3(D2("Received MessageTypes.ErrorOccurred - %s"))(e);const i=p4(j1(2,Cm()),e);if(i.tag===1){const s=i.fields[0];return new G1(1,s)}else{const s=i.fields[0],u=j6(D2("Error: %A, message %s"))(s.error[0])(s.error[1]);return new G1(1,u)}}case 8:return c3(D2("Received MessageTypes.MessageIdCreated - %s"))(e),P3(i=>{n.replaceMessageId(i.random_id,i.db_id)},p4(j1(2,ym()),e));case 9:return c3(D2("Received MessageTypes.NewUnreadCount - %s"))(e),P3(i=>{n.newUnreadCount(i.sender,i.unread_count)},p4(j1(2,zm()),e));default:{const i=o|0;return c3(D2("Received unhandled MessageType %A"))(i),new G1(0,void 0)}}},p4(j1(2,xm),e));if(c.tag===1){const o=c.fields[0];c3(D2("Error while processing message %s - error: %s"))(e)(o);const i=xr(["error",sm(s=>wu(s),s=>s,1,j6(D2("msg_type decoding error - %s"))(o))]);return t.send(M7(7,i)),j6(D2("Error occured - %s"))(o)}else return}function qm(t,e,n,c){c3(D2("Sending text message: '%A', user_pk:'%A'"))(e)(n);const o=$u(),i=C4([["text",e],["user_pk",n],["random_id",~~_3(o)]]);return t.send(M7(3,i)),w3(s=>Zu(e,n,s.pk,s.username,o,void 0),c)}function Wm(t,e,n,c){c3(D2("Sending file message: '%s', user_pk:'%s'"))(n.id)(e);const o=$u(),i=C4([["file_id",n.id],["user_pk",e],["random_id",~~_3(o)]]);return t.send(M7(4,i)),w3(s=>Zu(n.name,e,s.pk,s.username,o,n),c)}function $m(t){t.send(M7(5,U6()))}function ya(t,e,n){c3(D2("Sending 'read' message for message_id '%i', user_pk:'%A'"))(n)(e);const c=C4([["user_pk",e],["message_id",~~_3(n)]]);t.send(M7(6,c))}const C7="http://127.0.0.1:8000",Zm=j6(D2("%s/messages/"))(C7),Km=j6(D2("%s/dialogs/"))(C7),Qm=j6(D2("%s/self/"))(C7),Ym=j6(D2("%s/users/"))(C7),Xm=j6(D2("%s/upload/"))(C7);function Jm(t,e){return H5(j3,I5(j3,()=>{const n=new FormData;n.append("file",t[0]);const c=new y7(1,{["X-CSRFToken"]:e}),o=C4([new y7(0,"POST"),new y7(2,n),c]);return F5(Xm,o).then(i=>{const s=i;if(s.tag===1){const u=s.fields[0];return Promise.resolve(new G1(1,u.message))}else return s.fields[0].text().then(f=>{const g=f,_=p4(j1(2,ma()),g);return Promise.resolve(_)})})}))}function tz(){return H5(j3,I5(j3,()=>F5(Qm,U6()).then(t=>{const e=t;if(e.tag===1){const n=e.fields[0];return Promise.resolve(new G1(1,n.message))}else return e.fields[0].text().then(c=>{const o=c,i=p4(j1(2,Bu()),o);return Promise.resolve(i)})})))}function ez(t){const e=v5(n=>n.id,t);return j9(n=>v5(c=>new D9(c.pk,g8(c.pk,void 0),!0,"",void 0,c.username,c.username,Yl(),"",0),n.filter(c=>!Wf(c.pk,e,{Equals:(o,i)=>o===i,GetHashCode:o=>Pt(o)}))),H5(j3,I5(j3,()=>F5(Ym,U6()).then(n=>{const c=n;if(c.tag===1){const o=c.fields[0];return Promise.resolve(new G1(1,o.message))}else return c.fields[0].text().then(i=>{let s;const u=i,f=p4(j1(2,(s=Bu(),g=>_=>m7(j1(2,s),g,_))),u);return Promise.resolve(f)})}))))}function nz(){return j9(t=>Xf(e=>e.date,v5(e=>{const n=e.file!=null?"file":"text";let c;const o=[e.out,e.read];c=o[1]?"read":o[0]?"sent":"received";const i=g8(e.sender,150),s=e.out?e.recipient:e.sender,u=w3(E=>_a,e.file),f=w3(E=>Ma(E.size),e.file),g=w3(E=>E.url,e.file);let _;const L=e.file;return L==null?_=e.text:_=L.name,new w7(e.out?"right":"left",n,_,e.sender_username,c,i,e.sent,new _7(s,$2(e.id,!1,2),e.out,f,g,u),w3(E=>R=>{wa(E.url,E.name,R)},e.file))},t.data),{Compare:(e,n)=>Cf(e,n)}),H5(j3,I5(j3,()=>F5(Zm,U6()).then(t=>{const e=t;if(e.tag===1){const n=e.fields[0];return Promise.resolve(new G1(1,n.message))}else return e.fields[0].text().then(c=>{const o=c,i=p4(j1(2,dm()),o);return Promise.resolve(i)})}))))}function Ku(t,e){if(t==null)return new Array(0);{const n=t;return e.filter(c=>c.data.dialog_id===n.id)}}function cz(t,e,n,c){Ku(e,n).filter(o=>(o.status!=="read"?o.data.out===!1:!1)?Fm(o):!1).forEach(o=>{c(o.data.message_id),ya(t,e.id,o.data.message_id)})}function rz(){return j9(t=>v5(e=>new D9(e.other_user_id,g8(e.other_user_id,void 0),!0,"",void 0,e.username,e.username,h5(w3(n=>n.sent,e.last_message),e.created),km(e.last_message),e.unread_count),t.data),H5(j3,I5(j3,()=>F5(Km,U6()).then(t=>{const e=t;if(e.tag===1){const n=e.fields[0];return Promise.resolve(new G1(1,n.message))}else return e.fields[0].text().then(c=>{const o=c,i=p4(j1(2,mm()),o);return Promise.resolve(i)})}))))}var bX=l4(257),GX=l4(9718),Z2=Object.assign;const Qu=5e3,az=(t,e)=>e.date-t.date;function oz(){const t="csrftoken";let e=null;if(document.cookie&&document.cookie!==""){let n=document.cookie.split(";");for(let c=0;c<n.length;c++){let o=n[c].trim();if(o.substring(0,t.length+1)===t+"="){e=decodeURIComponent(o.substring(t.length+1));break}}}return e}class iz extends I.Component{constructor(e){super(e);this.textInput=null,this.setTextInputRef=n=>{this.textInput=n},this.clearTextInput=()=>{this.textInput&&this.textInput.clear()},this.searchInput=null,this.setSearchInputRef=n=>{this.searchInput=n},this.fileInput=null,this.setFileInputRef=n=>{this.fileInput=n},this.clearSearchInput=()=>{this.searchInput&&this.searchInput.clear()},this.state={socketConnectionState:0,showNewChatPopup:!1,newChatChosen:null,usersDataLoading:!1,availableUsers:[],messageList:[],dialogList:[],filteredDialogList:[],typingPKs:[],onlinePKs:[],selfInfo:null,selectedDialog:null,socket:new hh("ws://"+window.location.host+"/chat_ws")},this.performSendingMessage=this.performSendingMessage.bind(this),this.addMessage=this.addMessage.bind(this),this.replaceMessageId=this.replaceMessageId.bind(this),this.addPKToTyping=this.addPKToTyping.bind(this),this.changePKOnlineStatus=this.changePKOnlineStatus.bind(this),this.setMessageIdAsRead=this.setMessageIdAsRead.bind(this),this.newUnreadCount=this.newUnreadCount.bind(this),this.triggerFileRefClick=this.triggerFileRefClick.bind(this),this.handleFileInputChange=this.handleFileInputChange.bind(this),this.isTyping=Y1()(()=>{$m(this.state.socket)},Qu),this.localSearch=Y1()(()=>{let n=this.searchInput.input.value;console.log("localSearch with '"+n+"'"),!n||n.length===0?this.setState(c=>({filteredDialogList:c.dialogList})):this.setState(c=>({filteredDialogList:c.dialogList.filter(function(o){return o.title.toLowerCase().includes(n.toLowerCase())})}))},100)}componentDidMount(){nz().then(o=>{o.tag===0?(console.log("Fetched messages:"),console.log(o.fields[0]),this.setState({messageList:o.fields[0]})):(console.log("Messages error:"),C1.error(o.fields[0]))}),rz().then(o=>{o.tag===0?(console.log("Fetched dialogs:"),console.log(o.fields[0]),this.setState({dialogList:o.fields[0],filteredDialogList:o.fields[0]}),this.selectDialog(o.fields[0][0])):(console.log("Dialogs error:"),C1.error(o.fields[0]))}),tz().then(o=>{o.tag===0?(console.log("Fetched selfInfo:"),console.log(o.fields[0]),this.setState({selfInfo:o.fields[0]})):(console.log("SelfInfo error:"),C1.error(o.fields[0]))}),this.setState({socketConnectionState:this.state.socket.readyState});const e=this;let n=this.state.socket,c={autoClose:1500,hideProgressBar:!0,closeOnClick:!1,pauseOnHover:!1,pauseOnFocusLoss:!1,draggable:!1};n.onopen=function(o){C1.success("Connected!",c),e.setState({socketConnectionState:n.readyState})},n.onmessage=function(o){e.setState({socketConnectionState:n.readyState});let i=Um(n,o.data,{addMessage:e.addMessage,replaceMessageId:e.replaceMessageId,addPKToTyping:e.addPKToTyping,changePKOnlineStatus:e.changePKOnlineStatus,setMessageIdAsRead:e.setMessageIdAsRead,newUnreadCount:e.newUnreadCount});i&&C1.error(i)},n.onclose=function(o){C1.info("Disconnected...",c),e.setState({socketConnectionState:n.readyState}),console.log("websocket closed")}}selectDialog(e){console.log("Selecting dialog "+e.id),this.setState({selectedDialog:e}),this.setState(n=>({dialogList:n.dialogList.map(c=>c.id===e.id?Z2(Z2({},c),{statusColorType:"encircle"}):Z2(Z2({},c),{statusColorType:void 0}))})),this.setState(n=>({filteredDialogList:n.dialogList})),cz(this.state.socket,e,this.state.messageList,this.setMessageIdAsRead)}getSocketState(){if(this.state.socket.readyState===0)return"Connecting...";if(this.state.socket.readyState===1)return"Connected";if(this.state.socket.readyState===2)return"Disconnecting...";if(this.state.socket.readyState===3)return"Disconnected"}addPKToTyping(e){console.log("Adding "+e+" to typing pk-s");let n=this.state.typingPKs;n.push(e),this.setState({typingPKs:n});const c=this;setTimeout(()=>{console.log("Will remove "+e+" from typing pk-s");let o=c.state.typingPKs;const i=o.indexOf(e);i>-1&&o.splice(i,1),c.setState({typingPKs:o})},Qu)}changePKOnlineStatus(e,n){console.log("Setting "+e+" to "+n?"online":0);let c=this.state.onlinePKs;if(n)c.push(e);else{const o=c.indexOf(e);o>-1&&c.splice(o,1)}this.setState({onlinePKs:c}),this.setState(o=>({dialogList:o.dialogList.map(function(i){return i.id===e?n?Z2(Z2({},i),{statusColor:"lightgreen"}):Z2(Z2({},i),{statusColor:""}):i})})),this.setState(o=>({filteredDialogList:o.dialogList}))}addMessage(e){console.log("Calling addMessage for "),!e.data.out&&e.data.message_id>0&&this.state.selectedDialog&&this.state.selectedDialog.id===e.data.dialog_id&&(ya(this.state.socket,e.data.dialog_id,e.data.message_id),e.status="read");let n=this.state.messageList;n.push(e),console.log(e),this.setState({messageList:n});let c=!1;if(!e.data.out){let o=this.state.dialogList;if(!o.some(s=>s.id===e.data.dialog_id)){let s=Dm(e);o.push(s),c=!0,this.setState({dialogList:o})}}c||this.setState(o=>({dialogList:o.dialogList.map(function(i){return i.id===e.data.dialog_id?(console.log("Setting dialog "+e.data.dialog_id+" last message"),Z2(Z2({},i),{subtitle:Om(e)})):i})})),this.setState(o=>({filteredDialogList:o.dialogList}))}replaceMessageId(e,n){console.log("Replacing random id  "+e+" with db_id "+n),this.setState(c=>({messageList:c.messageList.map(function(o){if(o.data.message_id.Equals(e)){let i="";return o.data.out?i="sent":c.selectedDialog&&c.selectedDialog.id===o.data.dialog_id?(ya(c.socket,o.data.dialog_id,n),i="read"):i="received",Z2(Z2({},o),{data:Z2(Z2({},o.data),{dialog_id:o.data.dialog_id,message_id:n,out:o.data.out}),status:i})}else return o})}))}newUnreadCount(e,n){console.log("Got new unread count "+n+" for dialog "+e),this.setState(c=>({dialogList:c.dialogList.map(function(o){return o.id===e?(console.log("Setting new unread count "+n+" for dialog "+e),Z2(Z2({},o),{unread:n})):o})})),this.setState(c=>({selectedDialog:c.selectedDialog&&c.selectedDialog.id===e?Z2(Z2({},c.selectedDialog),{unread:n}):c.selectedDialog})),this.setState(c=>({filteredDialogList:c.dialogList}))}setMessageIdAsRead(e){console.log("Setting msg_id "+e+" as read"),this.setState(n=>({messageList:n.messageList.map(function(c){return c.data.message_id.Equals(e)?Z2(Z2({},c),{status:"read"}):c})}))}performSendingMessage(){if(this.state.selectedDialog){let e=this.textInput.input.value,n=this.state.selectedDialog.id;this.clearTextInput();let c=qm(this.state.socket,e,n,this.state.selfInfo);console.log("sendOutgoingTextMessage result:"),console.log(c),c&&this.addMessage(c)}}handleFileInputChange(e){console.log("Upload starting..."),console.log(e.target.files),Jm(e.target.files,oz()).then(n=>{if(n.tag===0){console.log("Uploaded file :"),console.log(n.fields[0]);let c=this.state.selectedDialog.id,o=n.fields[0],i=Wm(this.state.socket,c,o,this.state.selfInfo);console.log("sendOutgoingFileMessage result:"),console.log(i),i&&this.addMessage(i)}else console.log("File upload error"),C1.error(n.fields[0])})}triggerFileRefClick(){this.fileInput.click()}render(){return I.createElement("div",{className:"container"},I.createElement("div",{className:"chat-list"},I.createElement(R1.SideBar,{type:"light",top:I.createElement("span",{className:"chat-list"},I.createElement(R1.Input,{placeholder:"Search...",ref:this.setSearchInputRef,onKeyPress:e=>{if(e.charCode!==13&&this.localSearch(),e.charCode===13)return this.localSearch(),console.log("search invoke with"+this.searchInput.input.value),e.preventDefault(),!1},rightButtons:I.createElement("div",null,I.createElement(R1.Button,{type:"transparent",color:"black",onClick:()=>{this.localSearch(),console.log("search invoke with"+this.searchInput.input.value)},icon:{component:I.createElement(th,null),size:18}}),I.createElement(R1.Button,{type:"transparent",color:"black",icon:{component:I.createElement(eh,null),size:18},onClick:()=>this.clearSearchInput()}))}),I.createElement(R1.ChatList,{onClick:(e,n,c)=>this.selectDialog(e),dataSource:this.state.filteredDialogList.slice().sort(az)})),bottom:I.createElement(R1.Button,{type:"transparent",color:"black",disabled:!0,text:"Connection state: "+this.getSocketState()})})),I.createElement("div",{className:"right-panel"},I.createElement(c2,null),I.createElement(R1.Popup,{show:this.state.showNewChatPopup,header:"New chat",headerButtons:[{type:"transparent",color:"black",text:"close",icon:{component:I.createElement(nh,null),size:18},onClick:()=>{this.setState({showNewChatPopup:!1})}}],renderContent:()=>this.state.usersDataLoading?I.createElement("div",null,I.createElement("p",null,"Loading data...")):this.state.availableUsers.length===0?I.createElement("div",null,I.createElement("p",null,"No users available")):I.createElement(R1.ChatList,{onClick:(e,n,c)=>{this.setState({showNewChatPopup:!1}),this.selectDialog(e)},dataSource:this.state.availableUsers})}),I.createElement(R1.Navbar,{left:I.createElement(R1.ChatItem,Z2(Z2({},this.state.selectedDialog),{date:null,unread:0,statusColor:this.state.selectedDialog&&this.state.onlinePKs.includes(this.state.selectedDialog.id)?"lightgreen":"",subtitle:this.state.selectedDialog&&this.state.typingPKs.includes(this.state.selectedDialog.id)?"typing...":""})),right:I.createElement(R1.Button,{type:"transparent",color:"black",onClick:()=>{this.setState({usersDataLoading:!0}),ez(this.state.dialogList).then(e=>{this.setState({usersDataLoading:!1}),e.tag===0?(console.log("Fetched users:"),console.log(e.fields[0]),this.setState({availableUsers:e.fields[0]})):(console.log("Users error:"),C1.error(e.fields[0]))}),this.setState({showNewChatPopup:!0})},icon:{component:I.createElement(Xu,null),size:24}})}),I.createElement(R1.MessageList,{className:"message-list",lockable:!0,onDownload:(e,n,c)=>{console.log("onDownload from messageList"),e.onDownload()},downButtonBadge:this.state.selectedDialog&&this.state.selectedDialog.unread>0?this.state.selectedDialog.unread:"",dataSource:Ku(this.state.selectedDialog,this.state.messageList)}),I.createElement("input",{id:"selectFile",hidden:!0,type:"file",onChange:this.handleFileInputChange,ref:this.setFileInputRef}),I.createElement(R1.Input,{placeholder:"Type here to send a message.",defaultValue:"",ref:this.setTextInputRef,multiline:!0,onKeyPress:e=>{if(e.charCode!==13&&(console.log("key pressed"),this.isTyping()),e.shiftKey&&e.charCode===13)return!0;if(e.charCode===13)return this.state.socket.readyState===1&&(this.performSendingMessage(),e.preventDefault()),!1},leftButtons:I.createElement(R1.Button,{type:"transparent",color:"black",onClick:this.triggerFileRefClick,icon:{component:I.createElement(Ju,null),size:24}}),rightButtons:I.createElement(R1.Button,{text:"Send",disabled:this.state.socket.readyState!==1,onClick:()=>this.performSendingMessage()})})))}}var lz=iz;G.render(I.createElement(I.StrictMode,null,I.createElement(lz,null)),document.getElementById("root"))})()})();
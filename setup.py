@@ -57,6 +57,10 @@ setup(
     ],
     include_package_data=True,
     install_requires=['django-model-utils', 'channels'],
+    extras_require={
+        'orjson': ['orjson>=3.0'],
+        'msgpack': ['msgpack>=1.0.0'],
+    },
     license="MIT",
     zip_safe=False,
     keywords='django_private_chat2',
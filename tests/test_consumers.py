@@ -2,19 +2,41 @@ from django.test import TestCase
 
 from django_private_chat2.models import DialogsModel, MessageModel, UploadedFile
 from django.db import IntegrityError
+from django.db.models import Q
 from .factories import DialogsModelFactory, MessageModelFactory, UserFactory, faker
 from django.test import TestCase, Client
 from django.urls import reverse, resolve
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
 from django_private_chat2.serializers import serialize_message_model, serialize_dialog_model
+import asyncio
 import json
+import logging
+import msgpack
+import time
+from unittest import mock
 from channels.testing import HttpCommunicator, WebsocketCommunicator
 from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer
+from asgiref.sync import async_to_sync
 
-from django_private_chat2.consumers import ChatConsumer
+from django_private_chat2.consumers import ChatConsumer, group_send_many, fan_out_in_order
+from django_private_chat2.consumers.codecs import JSON_CODECS, JsonCodec, load_json_codec
+from django_private_chat2.consumers.message_types import MessageTypes, MESSAGE_VALIDATORS
+from django_private_chat2.consumers.write_behind import MessageWriteBuffer, flush_message_buffer
+from django_private_chat2.consumers.presence import InMemoryPresenceBackend, CachePresenceBackend, \
+    PresenceLockTimeout, get_presence_backend, sees_all_connections
+from django_private_chat2.consumers.outbound import OutboundQueue, get_outbound_metrics
+from django_private_chat2.consumers.rate_limit import TokenBucket, InMemoryRateLimitBackend, CacheRateLimitBackend
 from django_private_chat2.consumers.db_operations import  get_groups_to_add, get_user_by_pk, get_file_by_id, \
-    get_message_by_id, get_unread_count, mark_message_as_read, save_file_message, save_text_message
+    get_message_by_id, get_unread_count, mark_message_as_read, save_file_message, save_text_message, \
+    save_message_and_get_unread_count, mark_messages_as_read_up_to, get_dialogs_snapshot, save_messages_batch
+
+
+async def drain(communicator: WebsocketCommunicator):
+    # Skips frames (i.e. presence events) that could still be in flight from connecting
+    while not await communicator.receive_nothing(timeout=0.1):
+        await communicator.receive_from()
 
 
 class ConsumerTests(TestCase):
@@ -61,6 +83,110 @@ class ConsumerTests(TestCase):
         await database_sync_to_async(self.unread_msg.refresh_from_db)()
         self.assertTrue(self.unread_msg.read)
 
+    async def test_mark_messages_as_read_up_to(self):
+        ids = await database_sync_to_async(lambda: list(
+            MessageModel.objects.filter(sender=self.sender, recipient=self.recipient).order_by('id')
+            .values_list('id', flat=True)))()
+        res = await mark_messages_as_read_up_to(ids[0], self.recipient.pk, self.sender.pk)
+        self.assertIsNone(res)
+        res = await mark_messages_as_read_up_to(ids[0], "not a pk", self.recipient.pk)
+        self.assertIsNone(res)
+        res = await mark_messages_as_read_up_to(ids[-1], self.sender.pk, self.recipient.pk)
+        self.assertEqual(res, 0)
+        self.assertEqual(await get_unread_count(self.sender, self.recipient), 0)
+
+    async def test_mark_messages_as_read_up_to_by_user1(self):
+        # The reader is stored as the dialog's user1 and pks come from the client as strings
+        messages = await database_sync_to_async(lambda: [
+            MessageModelFactory.create(sender=self.u2, recipient=self.u1, read=False) for _ in range(3)])()
+        res = await mark_messages_as_read_up_to(messages[0].id, str(self.u2.pk), str(self.u1.pk))
+        self.assertEqual(res, 2)
+
+    async def test_message_read(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator.scope["user"] = self.recipient
+        await communicator.connect()
+        sender_communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        sender_communicator.scope["user"] = self.sender
+        await sender_communicator.connect()
+        await drain(communicator)
+        await drain(sender_communicator)
+        mid = await database_sync_to_async(lambda: MessageModel.objects.filter(sender=self.sender).first().id)()
+
+        await communicator.send_json_to({"msg_type": 6, "user_pk": str(self.sender.pk), "message_id": mid})
+        self.assertEqual(await sender_communicator.receive_json_from(),
+                         {"msg_type": 6, "message_id": mid, "sender": str(self.sender.pk),
+                          "receiver": str(self.recipient.pk)})
+        self.assertEqual(await communicator.receive_json_from(),
+                         {"msg_type": 9, "sender": str(self.sender.pk), "unread_count": 0})
+
+        await communicator.send_json_to({"msg_type": 6, "user_pk": str(self.u1.pk), "message_id": mid})
+        self.assertEqual(await communicator.receive_json_from(),
+                         {"msg_type": 7, "error": [3, f"Message with id {mid} was not sent by {self.u1.pk} "
+                                                      f"to {self.recipient.pk}"]})
+        await communicator.send_json_to({"msg_type": 6, "user_pk": "1000", "message_id": mid})
+        self.assertEqual(await communicator.receive_json_from(),
+                         {"msg_type": 7, "error": [4, "User with pk 1000 does not exist"]})
+        await communicator.disconnect()
+        await sender_communicator.disconnect()
+
+    async def test_batch(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator.scope["user"] = self.recipient
+        await communicator.connect()
+        sender_communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        sender_communicator.scope["user"] = self.sender
+        await sender_communicator.connect()
+        await drain(communicator)
+        await drain(sender_communicator)
+        ids = await database_sync_to_async(lambda: list(
+            MessageModel.objects.filter(sender=self.sender, recipient=self.recipient).order_by('id')
+            .values_list('id', flat=True)))()
+        sender_pk, recipient_pk = str(self.sender.pk), str(self.recipient.pk)
+
+        await communicator.send_json_to({"msg_type": 11, "ops": [
+            {"msg_type": 6, "user_pk": sender_pk, "message_id": ids[-1]},
+            {"msg_type": 6, "user_pk": sender_pk, "message_id": ids[0]},
+            {"msg_type": 3, "text": "hello", "user_pk": sender_pk, "random_id": -1},
+            {"msg_type": 3, "text": "hello", "user_pk": "1000", "random_id": -2},
+            {"msg_type": 6, "user_pk": str(self.u1.pk), "message_id": ids[0]},
+            {"msg_type": "x"},
+            {"msg_type": 11, "ops": []},
+        ]})
+        self.assertEqual(await sender_communicator.receive_json_from(),
+                         {"msg_type": 6, "message_id": ids[-1], "sender": sender_pk, "receiver": recipient_pk})
+        self.assertEqual(await sender_communicator.receive_json_from(),
+                         {"msg_type": 3, "random_id": -1, "text": "hello", "sender": recipient_pk,
+                          "receiver": sender_pk, "sender_username": self.recipient.username})
+        msg = await database_sync_to_async(MessageModel.objects.filter(sender=self.recipient, text="hello").get)()
+        self.assertEqual(await sender_communicator.receive_json_from(),
+                         {"msg_type": 8, "random_id": -1, "db_id": msg.id})
+        self.assertEqual(await sender_communicator.receive_json_from(),
+                         {"msg_type": 9, "sender": recipient_pk, "unread_count": 1})
+        self.assertEqual(await communicator.receive_json_from(), {"msg_type": 11, "results": [
+            None,
+            None,
+            None,
+            [4, "User with pk 1000 does not exist"],
+            [3, f"Message with id {ids[0]} was not sent by {self.u1.pk} to {recipient_pk}"],
+            [1, "msg_type is not an int"],
+            [1, "batches can't be nested"],
+        ]})
+        self.assertEqual(await communicator.receive_json_from(),
+                         {"msg_type": 9, "sender": sender_pk, "unread_count": 0})
+        self.assertEqual(await communicator.receive_json_from(), {"msg_type": 8, "random_id": -1, "db_id": msg.id})
+        self.assertEqual(await get_unread_count(self.sender, self.recipient), 0)
+
+        await communicator.send_json_to({"msg_type": 11, "ops": {}})
+        self.assertEqual(await communicator.receive_json_from(),
+                         {"msg_type": 7, "error": [1, "'ops' should be a list"]})
+        with mock.patch('django_private_chat2.consumers.chat_consumer.MAX_BATCH_OPERATIONS', 1):
+            await communicator.send_json_to({"msg_type": 11, "ops": [{"msg_type": 5}, {"msg_type": 10}]})
+            self.assertEqual(await communicator.receive_json_from(),
+                             {"msg_type": 7, "error": [1, "batch can't have more than 1 operations"]})
+        await communicator.disconnect()
+        await sender_communicator.disconnect()
+
     async def test_get_unread_count(self):
         count = await get_unread_count(self.sender, self.recipient)
         self.assertEqual(count, self.num_unread)
@@ -71,8 +197,659 @@ class ConsumerTests(TestCase):
         msg2 = await save_file_message(file=self.file, from_=self.u1, to=self.u2)
         self.assertIsNotNone(msg2)
 
+    async def test_save_message_and_get_unread_count(self):
+        res = await save_message_and_get_unread_count(self.sender, "1000", text="text")
+        self.assertIsNone(res)
+        res = await save_message_and_get_unread_count(self.sender, "not a pk", text="text")
+        self.assertIsNone(res)
+        msg, unread_count = await save_message_and_get_unread_count(self.sender, str(self.recipient.pk), text="text")
+        self.assertEqual(msg.text, "text")
+        self.assertEqual(msg.recipient_id, self.recipient.pk)
+        self.assertEqual(unread_count, self.num_unread + 1)
+        msg, unread_count = await save_message_and_get_unread_count(self.u1, str(self.u2.pk), file=self.file)
+        self.assertEqual(msg.file, self.file)
+
+    async def test_save_messages_batch(self):
+        res = await save_messages_batch([(self.sender, str(self.recipient.pk), "a", None),
+                                         (self.sender, "1000", "b", None),
+                                         (self.u1, str(self.u1.pk), "note", None),
+                                         (self.recipient, str(self.sender.pk), "c", None)])
+        self.assertIsNone(res[1])
+        # Same counts as saving the messages one by one, a dialog with oneself included
+        self.assertEqual([r[1] for r in res if r], [self.num_unread + 1, 1, 1])
+        _, unread_count = await save_message_and_get_unread_count(self.u1, str(self.u1.pk), text="note")
+        self.assertEqual(unread_count, 2)
+
     async def test_connect_basic(self):
         communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
         communicator.scope["user"] = self.u1
         connected, subprotocol = await communicator.connect()
         assert connected
+        await communicator.disconnect()
+
+    async def test_dialog_partners_cache(self):
+        u3 = await database_sync_to_async(UserFactory.create)()
+        communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator1.scope["user"] = self.u1
+        communicator3 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator3.scope["user"] = u3
+        connected, _ = await communicator1.connect()
+        self.assertTrue(connected)
+        connected, _ = await communicator3.connect()
+        self.assertTrue(connected)
+        await drain(communicator3)
+
+        # Creating a new dialog should update the cached partners of the already connected consumer,
+        # 'dialog_created' is sent once the transaction commits
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda callback: callback()):
+            await database_sync_to_async(MessageModel.objects.create)(sender=u3, recipient=self.u1, text="hi")
+        await communicator1.send_json_to({"msg_type": 5})
+        response = await communicator3.receive_json_from()
+        self.assertEqual(response, {"msg_type": 5, "user_pk": str(self.u1.pk)})
+
+        await communicator1.disconnect()
+        await communicator3.disconnect()
+
+    async def test_text_message(self):
+        communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator1.scope["user"] = self.u1
+        communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator2.scope["user"] = self.u2
+        await communicator1.connect()
+        await communicator2.connect()
+        await drain(communicator1)
+        await drain(communicator2)
+
+        await communicator1.send_json_to({"msg_type": 3, "text": "hello", "user_pk": str(self.u2.pk), "random_id": -1})
+        response = await communicator2.receive_json_from()
+        self.assertEqual(response, {"msg_type": 3, "random_id": -1, "text": "hello", "sender": str(self.u1.pk),
+                                    "receiver": str(self.u2.pk), "sender_username": self.u1.username})
+        msg = await database_sync_to_async(MessageModel.objects.filter(sender=self.u1, text="hello").get)()
+        id_created = {"msg_type": 8, "random_id": -1, "db_id": msg.id}
+        self.assertEqual(await communicator2.receive_json_from(), id_created)
+        self.assertEqual(await communicator1.receive_json_from(), id_created)
+        unread_count = await get_unread_count(self.u1, self.u2)
+        self.assertEqual(await communicator2.receive_json_from(),
+                         {"msg_type": 9, "sender": str(self.u1.pk), "unread_count": unread_count})
+
+        await communicator1.send_json_to({"msg_type": 3, "text": "hello", "user_pk": "1000", "random_id": -2})
+        response = await communicator1.receive_json_from()
+        self.assertEqual(response, {"msg_type": 7, "error": [4, "User with pk 1000 does not exist"]})
+
+        await communicator1.disconnect()
+        await communicator2.disconnect()
+
+    async def test_frame_logging(self):
+        communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator1.scope["user"] = self.u1
+        await communicator1.connect()
+        await drain(communicator1)
+
+        frame = {"msg_type": 3, "text": "very secret text", "user_pk": "1000", "random_id": -1}
+        with self.assertLogs('django_private_chat2.chat_consumer', level='DEBUG') as cm:
+            await communicator1.send_json_to(frame)
+            await communicator1.receive_json_from()
+        summary = [line for line in cm.output if 'frame user=' in line]
+        self.assertEqual(len(summary), 1)
+        self.assertIn(f"user={self.u1.pk} msg_type=3 size={len(json.dumps(frame))} error=4 ", summary[0])
+        self.assertFalse(any("very secret text" in line for line in cm.output))
+
+        with mock.patch('django_private_chat2.consumers.chat_consumer.LOG_SAMPLE_RATE', 0):
+            with self.assertLogs('django_private_chat2.chat_consumer', level='DEBUG') as cm:
+                await communicator1.send_json_to(frame)
+                await communicator1.receive_json_from()
+                logging.getLogger('django_private_chat2.chat_consumer').info("done")
+        self.assertEqual(cm.output, ['INFO:django_private_chat2.chat_consumer:done'])
+
+        await communicator1.disconnect()
+
+    async def test_initial_snapshot(self):
+        communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator2.scope["user"] = self.u2
+        await communicator2.connect()
+        communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws?snapshot=1")
+        communicator1.scope["user"] = self.u1
+        await communicator1.connect()
+
+        expected_dialogs = await database_sync_to_async(
+            lambda: [serialize_dialog_model(DialogsModel.objects.get(pk=self.dialog.pk), self.u1.pk)])()
+        self.assertEqual(await communicator1.receive_json_from(), {
+            "msg_type": 12,
+            "self": {"username": self.u1.username, "pk": str(self.u1.pk)},
+            "dialogs": expected_dialogs,
+            "online": [str(self.u2.pk)]
+        })
+        await communicator1.disconnect()
+        await communicator2.disconnect()
+
+    def test_get_dialogs_snapshot(self):
+        DialogsModelFactory.create(user1=UserFactory.create(), user2=self.u1)
+        MessageModelFactory.create(sender=self.u2, recipient=self.u1)
+        with self.assertNumQueries(1):
+            dialogs = async_to_sync(get_dialogs_snapshot)(self.u1, 10)
+        expected = [serialize_dialog_model(d, self.u1.pk) for d in
+                    DialogsModel.objects.filter(Q(user1=self.u1) | Q(user2=self.u1)).order_by('-last_activity')]
+        self.assertIsNotNone(dialogs[0]['last_message'])
+        self.assertEqual(dialogs, expected)
+        self.assertEqual(len(async_to_sync(get_dialogs_snapshot)(self.u1, 1)), 1)
+
+    async def test_update_log_resume(self):
+        communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator1.scope["user"] = self.u1
+        await communicator1.connect()
+        await drain(communicator1)
+
+        await communicator1.send_json_to({"msg_type": 13, "seq": 0})
+        self.assertEqual(await communicator1.receive_json_from(),
+                         {"msg_type": 7, "error": [1, "update log is disabled"]})
+
+        with mock.patch('django_private_chat2.consumers.chat_consumer.UPDATE_LOG_ENABLED', True):
+            await communicator1.send_json_to({"msg_type": 3, "text": "hello", "user_pk": str(self.u2.pk),
+                                              "random_id": -1})
+            id_created = await communicator1.receive_json_from()
+            msg = await database_sync_to_async(MessageModel.objects.filter(sender=self.u1, text="hello").get)()
+            self.assertEqual(id_created, {"msg_type": 8, "random_id": -1, "db_id": msg.id, "seq": 1})
+            unread_count = await get_unread_count(self.u1, self.u2)
+
+            # u2 was offline and resumes from the beginning of its log
+            communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+            communicator2.scope["user"] = self.u2
+            await communicator2.connect()
+            await drain(communicator2)
+            await communicator2.send_json_to({"msg_type": 13, "seq": 0})
+            self.assertEqual(await communicator2.receive_json_from(),
+                             {"msg_type": 3, "random_id": -1, "text": "hello", "sender": str(self.u1.pk),
+                              "receiver": str(self.u2.pk), "sender_username": self.u1.username, "seq": 1})
+            self.assertEqual(await communicator2.receive_json_from(),
+                             {"msg_type": 8, "random_id": -1, "db_id": msg.id, "seq": 2})
+            self.assertEqual(await communicator2.receive_json_from(),
+                             {"msg_type": 9, "sender": str(self.u1.pk), "unread_count": unread_count, "seq": 3})
+            self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 13, "seq": 3})
+
+            await communicator2.send_json_to({"msg_type": 13, "seq": 2})
+            self.assertEqual((await communicator2.receive_json_from())["seq"], 3)
+            self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 13, "seq": 3})
+            await communicator2.send_json_to({"msg_type": 13, "seq": 10})
+            self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 14, "seq": 3})
+            await communicator2.disconnect()
+        await communicator1.disconnect()
+
+    async def test_update_log_message_to_self_in_order(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator.scope["user"] = self.u1
+        await communicator.connect()
+        await drain(communicator)
+        with mock.patch('django_private_chat2.consumers.chat_consumer.UPDATE_LOG_ENABLED', True):
+            await communicator.send_json_to({"msg_type": 3, "text": "note", "user_pk": str(self.u1.pk),
+                                             "random_id": -1})
+            frames = [await communicator.receive_json_from() for _ in range(4)]
+        # new text message, message id created twice (as sender & recipient) and the unread count
+        self.assertEqual([(f["msg_type"], f["seq"]) for f in frames], [(3, 1), (8, 2), (8, 3), (9, 4)])
+        await communicator.disconnect()
+
+    async def test_msgpack_subprotocol(self):
+        communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws", subprotocols=["msgpack", "json"])
+        communicator1.scope["user"] = self.u1
+        communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator2.scope["user"] = self.u2
+        connected, subprotocol = await communicator1.connect()
+        self.assertEqual(subprotocol, "msgpack")
+        connected, subprotocol = await communicator2.connect()
+        self.assertIsNone(subprotocol)
+        await drain(communicator1)
+        await drain(communicator2)
+
+        await communicator1.send_to(bytes_data=msgpack.packb({"msg_type": 5}))
+        self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 5, "user_pk": str(self.u1.pk)})
+        await communicator2.send_json_to({"msg_type": 5})
+        response = await communicator1.receive_from()
+        self.assertEqual(msgpack.unpackb(response), {"msg_type": 5, "user_pk": str(self.u2.pk)})
+
+        await communicator1.send_to(bytes_data=b"\xc1")
+        response = msgpack.unpackb(await communicator1.receive_from())
+        self.assertEqual(response["msg_type"], 7)
+        self.assertEqual(response["error"][0], 1)
+        await communicator1.disconnect()
+        await communicator2.disconnect()
+
+    async def test_preencoded_events(self):
+        communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator1.scope["user"] = self.u1
+        communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator2.scope["user"] = self.u2
+        communicator2_msgpack = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws", subprotocols=["msgpack"])
+        communicator2_msgpack.scope["user"] = self.u2
+        for c in (communicator1, communicator2, communicator2_msgpack):
+            await c.connect()
+        for c in (communicator1, communicator2, communicator2_msgpack):
+            await drain(c)
+        expected = {"msg_type": 3, "random_id": -1, "text": "hello", "sender": str(self.u1.pk),
+                    "receiver": str(self.u2.pk), "sender_username": self.u1.username}
+        with mock.patch('django_private_chat2.consumers.chat_consumer.PREENCODE_EVENTS', True):
+            await communicator1.send_json_to({"msg_type": 3, "text": "hello", "user_pk": str(self.u2.pk),
+                                              "random_id": -1})
+            self.assertEqual(await communicator2.receive_json_from(), expected)
+            self.assertEqual(msgpack.unpackb(await communicator2_msgpack.receive_from()), expected)
+        for c in (communicator1, communicator2, communicator2_msgpack):
+            await c.disconnect()
+
+    async def test_typing_coalescing(self):
+        communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator1.scope["user"] = self.u1
+        communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator2.scope["user"] = self.u2
+        await communicator1.connect()
+        await communicator2.connect()
+        await drain(communicator2)
+        with mock.patch('django_private_chat2.consumers.chat_consumer.TYPING_COALESCE_MS', 50):
+            for _ in range(3):
+                await communicator1.send_json_to({"msg_type": 5})
+            response = await communicator2.receive_json_from()
+            self.assertEqual(response, {"msg_type": 5, "user_pk": str(self.u1.pk)})
+            self.assertTrue(await communicator2.receive_nothing(timeout=0.2))
+
+            await communicator1.send_json_to({"msg_type": 10})
+            response = await communicator2.receive_json_from()
+            self.assertEqual(response, {"msg_type": 10, "user_pk": str(self.u1.pk)})
+
+            # A stop event cancels the pending start, so nothing reaches the partner
+            await communicator1.send_json_to({"msg_type": 5})
+            await communicator1.send_json_to({"msg_type": 10})
+            self.assertTrue(await communicator2.receive_nothing(timeout=0.2))
+
+        await communicator1.disconnect()
+        await communicator2.disconnect()
+
+    async def test_group_send_many(self):
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, message):
+                if group == "broken":
+                    raise ConnectionError("channel layer unavailable")
+                sent.append((group, message))
+
+        groups = [str(i) for i in range(20)] + ["broken"]
+        res = await group_send_many(Layer(), groups, {"type": "is_typing"}, concurrency=3)
+        self.assertEqual(res.sent, 20)
+        self.assertEqual([g for g, _ in res.failed], ["broken"])
+        self.assertIsInstance(res.failed[0][1], ConnectionError)
+        self.assertEqual(sorted(g for g, _ in sent), sorted(groups[:-1]))
+
+    async def test_fan_out_in_order(self):
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, message):
+                await asyncio.sleep(0.01 if message["n"] == 0 else 0)
+                if group == "broken":
+                    raise ConnectionError("channel layer unavailable")
+                sent.append((group, message["n"]))
+
+        sends = [("1", {"n": 0}), ("2", {"n": 1}), ("1", {"n": 2}), ("broken", {"n": 3}), ("broken", {"n": 4})]
+        res = await fan_out_in_order(Layer(), sends)
+        self.assertEqual(res.sent, 3)
+        self.assertEqual([g for g, _ in res.failed], ["broken"])
+        self.assertEqual([n for g, n in sent if g == "1"], [0, 2])
+
+    async def test_presence_multiple_connections(self):
+        communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator2.scope["user"] = self.u2
+        await communicator2.connect()
+        tabs = []
+        for _ in range(2):
+            tab = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+            tab.scope["user"] = self.u1
+            await tab.connect()
+            tabs.append(tab)
+        # Only the first connection makes the user go online
+        response = await communicator2.receive_json_from()
+        self.assertEqual(response, {"msg_type": 1, "user_pk": str(self.u1.pk)})
+        self.assertTrue(await communicator2.receive_nothing(timeout=0.2))
+
+        # ... and only the last one makes the user go offline
+        await tabs[0].disconnect()
+        self.assertTrue(await communicator2.receive_nothing(timeout=0.2))
+        await tabs[1].disconnect()
+        response = await communicator2.receive_json_from()
+        self.assertEqual(response, {"msg_type": 2, "user_pk": str(self.u1.pk)})
+        await communicator2.disconnect()
+
+    async def test_presence_only_to_online_partners(self):
+        u3 = await database_sync_to_async(UserFactory.create)()
+        await database_sync_to_async(DialogsModelFactory.create)(user1=self.u1, user2=u3)
+        communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator2.scope["user"] = self.u2
+        await communicator2.connect()
+        await drain(communicator2)
+
+        backend = get_presence_backend()
+        with mock.patch('django_private_chat2.consumers.chat_consumer.group_send_many',
+                        wraps=group_send_many) as send_many, \
+                mock.patch.object(backend, 'get_online', wraps=backend.get_online) as get_online:
+            communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+            communicator1.scope["user"] = self.u1
+            await communicator1.connect()
+            self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 1, "user_pk": str(self.u1.pk)})
+            await communicator1.send_json_to({"msg_type": 5})
+            self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 5, "user_pk": str(self.u1.pk)})
+            await communicator2.disconnect()
+            await communicator1.disconnect()
+        # u3 has no open connections and isn't sent anything
+        self.assertEqual([set(c.args[1]) for c in send_many.call_args_list],
+                         [{str(self.u2.pk)}, {str(self.u2.pk)}, {str(self.u1.pk)}, set()])
+        # Online partners are read on connecting & disconnecting, the typing frame uses the set kept up to date
+        # by presence events
+        self.assertEqual(get_online.call_count, 3)
+
+    async def test_presence_subscription_topology(self):
+        with mock.patch('django_private_chat2.consumers.chat_consumer.PRESENCE_TOPOLOGY', 'subscription'), \
+                mock.patch('django_private_chat2.consumers.chat_consumer.group_send_many') as send_many:
+            communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+            communicator2.scope["user"] = self.u2
+            await communicator2.connect()
+            await drain(communicator2)
+            communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+            communicator1.scope["user"] = self.u1
+            await communicator1.connect()
+            self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 1, "user_pk": str(self.u1.pk)})
+            await communicator1.send_json_to({"msg_type": 5})
+            self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 5, "user_pk": str(self.u1.pk)})
+            await communicator2.send_json_to({"msg_type": 5})
+            self.assertEqual(await communicator1.receive_json_from(), {"msg_type": 5, "user_pk": str(self.u2.pk)})
+            await communicator1.disconnect()
+            self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 2, "user_pk": str(self.u1.pk)})
+            self.assertTrue(await communicator2.receive_nothing())
+            await communicator2.disconnect()
+        # Every broadcast went to a single presence group
+        send_many.assert_not_called()
+
+
+class PresenceBackendTests(TestCase):
+    async def _check_backend(self, backend):
+        self.assertEqual(await backend.add("1", "a"), 1)
+        self.assertEqual(await backend.add("1", "b"), 2)
+        self.assertEqual(await backend.add("2", "c"), 1)
+        self.assertEqual(await backend.get_online(["1", "2", "3"]), {"1", "2"})
+        self.assertEqual(await backend.get_online(["2"]), {"2"})
+        self.assertEqual(await backend.remove("1", "a"), 1)
+        self.assertEqual(await backend.remove("1", "b"), 0)
+        self.assertEqual(await backend.get_online(["1", "2", "3"]), {"2"})
+        await backend.remove("2", "c")
+
+    async def test_in_memory_backend(self):
+        await self._check_backend(InMemoryPresenceBackend())
+
+    async def test_cache_backend(self):
+        await self._check_backend(CachePresenceBackend())
+
+    async def test_cache_backend_concurrent_add(self):
+        # Connections of one user registered at the same time by several processes are all kept
+        backends = [CachePresenceBackend() for _ in range(4)]
+        live = CachePresenceBackend._live
+
+        def slow_live(backend, user_pk):
+            # Widens the window between reading and storing the channels
+            channels = live(backend, user_pk)
+            time.sleep(0.01)
+            return channels
+
+        with mock.patch.object(CachePresenceBackend, '_live', slow_live):
+            await asyncio.gather(*[backends[i % 4].add("1", f"channel_{i}") for i in range(8)])
+        self.assertEqual(len(backends[0]._live("1")), 8)
+        for i in range(8):
+            await backends[0].remove("1", f"channel_{i}")
+
+    async def test_cache_backend_lock(self):
+        backend = CachePresenceBackend()
+        lock_key = f"{backend._key('1')}:lock"
+        backend.cache.add(lock_key, "other", timeout=60)
+        with mock.patch.object(CachePresenceBackend, 'lock_timeout', 0.05):
+            with self.assertRaises(PresenceLockTimeout):
+                await backend.add("1", "a")
+        # The lock taken by someone else is left alone
+        self.assertEqual(backend.cache.get(lock_key), "other")
+        backend.cache.delete(lock_key)
+        self.assertEqual(await backend.add("1", "a"), 1)
+        self.assertIsNone(backend.cache.get(lock_key))
+        await backend.remove("1", "a")
+
+    def test_per_process_backend_with_shared_layer(self):
+        in_memory_layer = InMemoryChannelLayer()
+        self.assertTrue(sees_all_connections(InMemoryPresenceBackend(), in_memory_layer))
+        self.assertTrue(sees_all_connections(CachePresenceBackend(), object()))
+        with mock.patch('django_private_chat2.consumers.presence._warned_per_process', False), \
+                self.assertLogs('django_private_chat2.presence', level=logging.WARNING) as logs:
+            self.assertFalse(sees_all_connections(InMemoryPresenceBackend(), object()))
+            self.assertFalse(sees_all_connections(InMemoryPresenceBackend(), object()))
+        self.assertEqual(len(logs.records), 1)
+
+    async def test_ttl(self):
+        backend = InMemoryPresenceBackend(ttl=0)
+        await backend.add("1", "a")
+        self.assertEqual(await backend.get_online(["1"]), set())
+        self.assertEqual(await backend.add("1", "b"), 1)
+
+
+class RateLimitTests(TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=3, updated=0)
+        self.assertTrue(all(bucket.consume(0) for _ in range(3)))
+        self.assertFalse(bucket.consume(0))
+        self.assertTrue(bucket.consume(0.5))
+        self.assertFalse(bucket.consume(0.5))
+        self.assertTrue(bucket.consume(100))
+        self.assertEqual(bucket.tokens, 2)
+
+    async def _check_backend(self, backend):
+        self.assertTrue(await backend.consume("1:3", 0, 2))
+        self.assertTrue(await backend.consume("1:3", 0, 2))
+        self.assertFalse(await backend.consume("1:3", 0, 2))
+        self.assertTrue(await backend.consume("2:3", 0, 2))
+
+    async def test_in_memory_backend(self):
+        await self._check_backend(InMemoryRateLimitBackend())
+
+    async def test_cache_backend(self):
+        await self._check_backend(CacheRateLimitBackend())
+
+    async def test_consumer_rate_limits(self):
+        u1 = await database_sync_to_async(UserFactory.create)()
+        communicators = []
+        with mock.patch('django_private_chat2.consumers.rate_limit.RATE_LIMITS', {MessageTypes.IsTyping: (0, 2)}), \
+                mock.patch('django_private_chat2.consumers.rate_limit.USER_RATE_LIMITS',
+                           {MessageTypes.TypingStopped: (0, 1)}), \
+                mock.patch('django_private_chat2.consumers.rate_limit._backend', InMemoryRateLimitBackend()):
+            for _ in range(2):
+                communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+                communicator.scope["user"] = u1
+                await communicator.connect()
+                communicators.append(communicator)
+            c1, c2 = communicators
+            for _ in range(2):
+                await c1.send_json_to({"msg_type": 5})
+            await c1.send_json_to({"msg_type": 5})
+            self.assertEqual(await c1.receive_json_from(),
+                             {"msg_type": 7, "error": [8, "Rate limit exceeded for IsTyping"]})
+            # per connection limit, the other connection has its own bucket
+            await c2.send_json_to({"msg_type": 11, "ops": [{"msg_type": 5}, {"msg_type": 5}, {"msg_type": 5}]})
+            self.assertEqual(await c2.receive_json_from(), {"msg_type": 11, "results": [
+                None, None, [8, "Rate limit exceeded for IsTyping"]]})
+            # per user limit is shared by both connections
+            await c1.send_json_to({"msg_type": 10})
+            self.assertTrue(await c1.receive_nothing())
+            await c2.send_json_to({"msg_type": 10})
+            self.assertEqual(await c2.receive_json_from(),
+                             {"msg_type": 7, "error": [8, "Rate limit exceeded for TypingStopped"]})
+        for communicator in communicators:
+            await communicator.disconnect()
+
+
+class OutboundQueueTests(TestCase):
+    async def test_policies(self):
+        sent = []
+        unblock = asyncio.Event()
+
+        async def send(frame):
+            await unblock.wait()
+            sent.append(frame)
+
+        queue = OutboundQueue(send, size=4, high_water_mark=2, slow_close_seconds=60)
+        self.assertTrue(queue.put("a"))
+        await asyncio.sleep(0)  # "a" is being written, the writer waits
+        self.assertTrue(queue.put("unread 1", coalesce_key="u"))
+        self.assertTrue(queue.put("typing", ephemeral=True))
+        self.assertTrue(queue.put("unread 2", coalesce_key="u"))
+        self.assertTrue(queue.put("b"))
+        self.assertEqual(queue.depth, 3)
+        self.assertTrue(queue.put("typing", ephemeral=True))
+        self.assertEqual((queue.dropped, queue.coalesced, queue.max_depth), (1, 1, 3))
+        self.assertEqual(get_outbound_metrics()['depth'], 3)
+
+        unblock.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.assertEqual(sent, ["a", "unread 2", "typing", "b"])
+        self.assertEqual(queue.depth, 0)
+
+        unblock.clear()
+        for frame in "cdef":
+            self.assertTrue(queue.put(frame))
+        self.assertFalse(queue.put("g"))
+        self.assertTrue(queue.overflowed)
+        self.assertEqual(queue.depth, 0)
+        queue.close()
+
+    async def test_slow_close(self):
+        queue = OutboundQueue(lambda frame: asyncio.sleep(60), size=10, high_water_mark=1, slow_close_seconds=0)
+        self.assertTrue(queue.put("a"))
+        await asyncio.sleep(0)
+        self.assertTrue(queue.put("b"))
+        self.assertFalse(queue.put("c"))
+        queue.close()
+
+    async def test_consumer_with_outbound_queue(self):
+        u1, u2 = await database_sync_to_async(UserFactory.create_batch)(2)
+        await database_sync_to_async(DialogsModelFactory.create)(user1=u1, user2=u2)
+        with mock.patch('django_private_chat2.consumers.chat_consumer.OUTBOUND_QUEUE_SIZE', 10):
+            communicator1 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+            communicator1.scope["user"] = u1
+            communicator2 = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+            communicator2.scope["user"] = u2
+            await communicator1.connect()
+            await communicator2.connect()
+            await drain(communicator1)
+            await drain(communicator2)
+            await communicator1.send_json_to({"msg_type": 5})
+            self.assertEqual(await communicator2.receive_json_from(), {"msg_type": 5, "user_pk": str(u1.pk)})
+            await communicator1.send_json_to({"msg_type": 100})
+            self.assertEqual((await communicator1.receive_json_from())["msg_type"], 7)
+            await communicator1.disconnect()
+            await communicator2.disconnect()
+
+    async def test_unread_count_with_seq_is_not_coalesced(self):
+        consumer = ChatConsumer()
+        with mock.patch.object(ChatConsumer, 'forward_event') as forward_event:
+            await consumer.new_unread_count({"type": "new_unread_count", "sender": "1", "unread_count": 2})
+            await consumer.new_unread_count({"type": "new_unread_count", "sender": "1", "unread_count": 3, "seq": 7})
+        self.assertEqual([c.kwargs['coalesce_key'] for c in forward_event.call_args_list],
+                         [('new_unread_count', "1"), None])
+
+
+class MessageValidationTests(TestCase):
+    def test_every_message_type_has_a_handler(self):
+        self.assertEqual(set(ChatConsumer.handlers), set(MessageTypes))
+
+    def test_text_message(self):
+        validate = MESSAGE_VALIDATORS[MessageTypes.TextMessage]
+        self.assertIsNone(validate({"text": "hi", "user_pk": "1", "random_id": -1}))
+        self.assertEqual(validate({"user_pk": "1", "random_id": -1}), (1, "'text' not present in data"))
+        self.assertEqual(validate({"text": "hi", "random_id": -1}), (1, "'user_pk' not present in data"))
+        self.assertEqual(validate({"text": "", "user_pk": "1", "random_id": -1}), (2, "'text' should not be blank"))
+        self.assertEqual(validate({"text": 5, "user_pk": "1", "random_id": -1}), (2, "'text' should be a string"))
+        self.assertEqual(validate({"text": "a" * 65536, "user_pk": "1", "random_id": -1}), (2, "'text' is too long"))
+        self.assertEqual(validate({"text": "hi", "user_pk": 1, "random_id": -1}), (4, "'user_pk' should be a string"))
+        self.assertEqual(validate({"text": "hi", "user_pk": "1", "random_id": "1"}),
+                         (5, "'random_id' should be an int"))
+        self.assertEqual(validate({"text": "hi", "user_pk": "1", "random_id": 1}),
+                         (5, "'random_id' should be negative"))
+
+    def test_file_message(self):
+        validate = MESSAGE_VALIDATORS[MessageTypes.FileMessage]
+        self.assertIsNone(validate({"file_id": "f", "user_pk": "1", "random_id": -1}))
+        self.assertEqual(validate({"file_id": "", "user_pk": "1", "random_id": -1}),
+                         (6, "'file_id' should not be blank"))
+        self.assertEqual(validate({"file_id": "f", "user_pk": "1"}), (1, "'random_id' not present in data"))
+
+    def test_message_read(self):
+        validate = MESSAGE_VALIDATORS[MessageTypes.MessageRead]
+        self.assertIsNone(validate({"user_pk": "1", "message_id": 1}))
+        self.assertEqual(validate({"user_pk": "1", "message_id": "1"}), (5, "'message_id' should be an int"))
+        self.assertEqual(validate({"user_pk": "1", "message_id": 0}), (3, "'message_id' should be > 0"))
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self) -> None:
+        self.u1, self.u2, self.u3 = UserFactory.create_batch(3)
+
+    async def test_batched_save(self):
+        buffer = MessageWriteBuffer(batch_size=10, flush_interval_ms=10, max_queue_size=2)
+        results = await asyncio.gather(
+            buffer.save(self.u1, str(self.u2.pk), text="1"),
+            buffer.save(self.u1, str(self.u2.pk), text="2"),
+            buffer.save(self.u1, "1000", text="3"),
+            buffer.save(self.u1, str(self.u3.pk), text="4"),
+        )
+        await buffer.close()
+        self.assertIsNone(results[2])
+        ids = [res[0].id for res in results if res]
+        self.assertEqual(len(set(ids)), 3)
+        self.assertTrue(all(ids))
+        self.assertEqual(results[1][1], 2)
+        self.assertEqual(results[3][1], 1)
+        texts = await database_sync_to_async(
+            lambda: sorted(MessageModel.objects.filter(sender=self.u1).values_list('text', flat=True)))()
+        self.assertEqual(texts, ["1", "2", "4"])
+        dialogs = await database_sync_to_async(lambda: DialogsModel.objects.filter(user1=self.u1).count())()
+        self.assertEqual(dialogs, 2)
+
+    async def test_consumer_write_behind(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/chat_ws")
+        communicator.scope["user"] = self.u1
+        await communicator.connect()
+        with mock.patch('django_private_chat2.consumers.chat_consumer.MESSAGE_WRITE_BEHIND', True):
+            await communicator.send_json_to({"msg_type": 3, "text": "hi", "user_pk": str(self.u2.pk), "random_id": -1})
+            response = await communicator.receive_json_from()
+        msg = await database_sync_to_async(MessageModel.objects.filter(sender=self.u1, text="hi").get)()
+        self.assertEqual(response, {"msg_type": 8, "random_id": -1, "db_id": msg.id})
+        await communicator.disconnect()
+        await flush_message_buffer()
+
+    async def test_close_flushes(self):
+        buffer = MessageWriteBuffer(batch_size=100, flush_interval_ms=10000)
+        task = asyncio.ensure_future(buffer.save(self.u1, str(self.u2.pk), text="1"))
+        await asyncio.sleep(0.05)
+        self.assertFalse(task.done())
+        await buffer.close()
+        msg, unread_count = await task
+        self.assertIsNotNone(msg.id)
+        with self.assertRaises(RuntimeError):
+            await buffer.save(self.u1, str(self.u2.pk), text="2")
+
+
+class JsonCodecTests(TestCase):
+    def test_codecs(self):
+        for name in JSON_CODECS:
+            try:
+                codec = load_json_codec(name)
+            except ImportError:
+                continue
+            data = {"msg_type": MessageTypes.TextMessage, "text": "Привет", "random_id": -1}
+            self.assertEqual(json.loads(codec.dumps(data)), {"msg_type": 3, "text": "Привет", "random_id": -1})
+            self.assertEqual(codec.loads(json.dumps(data)), {"msg_type": 3, "text": "Привет", "random_id": -1})
+            with self.assertRaises(codec.decode_errors):
+                codec.loads("{not json")
+
+    def test_auto(self):
+        self.assertIn(load_json_codec('auto').name, JSON_CODECS)
+        self.assertIsInstance(load_json_codec('django_private_chat2.consumers.codecs.JsonCodec'), JsonCodec)
@@ -8,15 +8,35 @@ test_django_private_chat2
 Tests for `django_private_chat2` models module.
 """
 
+from django.apps import apps
 from django.test import TestCase
 
-from django_private_chat2.models import DialogsModel, MessageModel, UploadedFile
+from django_private_chat2.models import DialogsModel, MessageModel, UploadedFile, UpdateLogModel, KnownDialogsCache, \
+    known_dialogs, get_known_dialogs_metrics
 from django.forms.models import model_to_dict
 
 from django.db import IntegrityError
+from django.db.models.query import QuerySet
+from django.core.management import call_command
+from io import StringIO
+from unittest import mock
+import json
+from importlib import import_module
+from contextlib import contextmanager
 from .factories import DialogsModelFactory, MessageModelFactory, UserFactory, faker
 
 
+@contextmanager
+def run_on_commit_callbacks():
+    # Collects transaction.on_commit callbacks and runs them on exit, like captureOnCommitCallbacks(execute=True)
+    # which is only available on Django 3.2+
+    callbacks = []
+    with mock.patch('django.db.transaction.on_commit', side_effect=callbacks.append):
+        yield callbacks
+    for callback in callbacks:
+        callback()
+
+
 class UploadedFileModelTests(TestCase):
     def setUp(self) -> None:
         self.file = UploadedFile.objects.create(uploaded_by=UserFactory.create(), file="LICENSE")
@@ -42,8 +62,55 @@ class MessageAndDialogModelTests(TestCase):
     def test_dialog_unique(self):
         u1, u2 = UserFactory.create(), UserFactory.create()
         DialogsModelFactory.create(user1=u1, user2=u2)
-        DialogsModelFactory.create(user1=u2, user2=u1)
-        self.assertRaises(IntegrityError, DialogsModelFactory.create, user2=u1, user1=u2)
+        self.assertRaises(IntegrityError, DialogsModelFactory.create, user1=u2, user2=u1)
+
+    def test_dialog_canonical_order(self):
+        u1, u2 = UserFactory.create(), UserFactory.create()
+        dialog = DialogsModelFactory.create(user1=u2, user2=u1, user1_unread_count=3)
+        self.assertEqual((dialog.user1_id, dialog.user2_id), (u1.pk, u2.pk))
+        self.assertEqual(dialog.unread_count_for(u2.pk), 3)
+        self.assertEqual(DialogsModel.canonical_pair(u2, str(u1.pk)), (u1.pk, u2.pk))
+        self.assertEqual(DialogsModel.dialog_exists(u2, u1), dialog)
+
+    def test_create_if_not_exists(self):
+        u1, u2 = UserFactory.create(), UserFactory.create()
+        # SELECT, then INSERT in a savepoint
+        with self.assertNumQueries(4):
+            self.assertTrue(DialogsModel.create_if_not_exists(u2, u1))
+        with self.assertNumQueries(1):
+            self.assertFalse(DialogsModel.create_if_not_exists(u1.pk, u2.pk))
+        self.assertEqual(list(DialogsModel.objects.filter(user2=u1).values_list('user1_id', 'user2_id')), [])
+
+    def test_create_if_not_exists_race(self):
+        u1, u2 = UserFactory.create(), UserFactory.create()
+        DialogsModel.create_if_not_exists(u1, u2)
+        real_get = QuerySet.get
+        calls = []
+
+        def get(qs, *args, **kwargs):
+            # The first lookup runs before another process commits the dialog
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise DialogsModel.DoesNotExist
+            return real_get(qs, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'get', get):
+            self.assertFalse(DialogsModel.create_if_not_exists(u2, u1))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(DialogsModel.objects.filter(user1=u1, user2=u2).count(), 1)
+
+    def test_canonicalize_dialogs_migration(self):
+        migration = import_module('django_private_chat2.migrations.0005a_canonicalize_data')
+        u1, u2, u3 = UserFactory.create(), UserFactory.create(), UserFactory.create()
+        MessageModelFactory.create_batch(2, sender=u1, recipient=u2, read=False)
+        MessageModelFactory.create(sender=u2, recipient=u1, read=False)
+        # Rows stored the old way, bypassing save(): a duplicate in the other direction and a reversed dialog
+        DialogsModel.objects.bulk_create([DialogsModel(user1=u2, user2=u1, user1_unread_count=5),
+                                          DialogsModel(user1=u3, user2=u1, user1_unread_count=1)])
+        migration.canonicalize_dialogs(apps, None)
+        self.assertEqual(sorted(DialogsModel.objects.filter(user2__in=[u1, u2, u3])
+                                .values_list('user1_id', 'user2_id', 'user1_unread_count', 'user2_unread_count')),
+                         [(u1.pk, u2.pk, 1, 2), (u1.pk, u3.pk, 0, 1)])
 
     def test_get_dialogs_for_user(self):
         u1, u2 = UserFactory.create(), UserFactory.create()
@@ -76,10 +143,164 @@ class MessageAndDialogModelTests(TestCase):
         after = DialogsModel.objects.count()
         self.assertEqual(after, before + 1)
 
+    def test_unread_counters(self):
+        sender, recipient = UserFactory.create(), UserFactory.create()
+        MessageModelFactory.create_batch(3, sender=sender, recipient=recipient, read=False)
+        MessageModelFactory.create(sender=sender, recipient=recipient, read=True)
+        MessageModelFactory.create(sender=recipient, recipient=sender, read=False)
+        dialog = DialogsModel.dialog_exists(sender, recipient)
+        self.assertEqual(dialog.unread_count_for(recipient.pk), 3)
+        self.assertEqual(dialog.unread_count_for(sender.pk), 1)
+
+        DialogsModel.update_unread_count(sender, recipient, -2)
+        self.assertEqual(MessageModel.get_unread_count_for_dialog_with_user(sender, recipient), 1)
+        self.assertEqual(MessageModel.get_unread_count_for_dialog_with_user(recipient, sender), 1)
+        DialogsModel.update_unread_count(sender, recipient, -5)
+        self.assertEqual(MessageModel.get_unread_count_for_dialog_with_user(sender, recipient), 0)
+
+    def test_last_message(self):
+        sender, recipient = UserFactory.create(), UserFactory.create()
+        dialog = DialogsModelFactory.create(user1=sender, user2=recipient)
+        self.assertIsNone(dialog.last_message)
+        first = MessageModelFactory.create(sender=sender, recipient=recipient)
+        last = MessageModelFactory.create(sender=recipient, recipient=sender)
+        dialog.refresh_from_db()
+        self.assertEqual((dialog.last_message, dialog.last_activity), (last, last.created))
+        batch = MessageModel.bulk_create_messages([MessageModel(sender=sender, recipient=recipient, text=str(i))
+                                                   for i in range(3)])
+        dialog.refresh_from_db()
+        self.assertEqual(dialog.last_message, batch[-1])
+        # An older message committed after a newer one doesn't replace it
+        DialogsModel.add_messages(sender, recipient, first, 0)
+        dialog.refresh_from_db()
+        self.assertEqual((dialog.last_message, dialog.last_activity), (batch[-1], batch[-1].created))
+        batch[-1].delete()
+        dialog.refresh_from_db()
+        self.assertEqual(dialog.last_message, batch[-2])
+        for m in (batch[0], batch[1], last):
+            m.delete()
+        first.delete(soft=False)
+        dialog.refresh_from_db()
+        self.assertEqual((dialog.last_message, dialog.last_activity), (None, dialog.created))
+
+    def test_delete_unread_message(self):
+        sender, recipient = UserFactory.create(), UserFactory.create()
+        messages = MessageModelFactory.create_batch(3, sender=sender, recipient=recipient, read=False)
+        messages[0].delete()
+        self.assertEqual(MessageModel.get_unread_count_for_dialog_with_user(sender, recipient), 2)
+        messages[0].delete(soft=False)
+        messages[1].delete(soft=False)
+        self.assertEqual(MessageModel.get_unread_count_for_dialog_with_user(sender, recipient), 1)
+        self.assertEqual(DialogsModel.reconcile_unread_counts(), 0)
+
+    def test_reconcile_unread_counters(self):
+        sender, recipient = UserFactory.create(), UserFactory.create()
+        MessageModelFactory.create_batch(3, sender=sender, recipient=recipient, read=False)
+        DialogsModel.objects.update(user1_unread_count=100, user2_unread_count=100)
+        out = StringIO()
+        call_command('reconcile_unread_counters', stdout=out)
+        self.assertIn("dialog(s) fixed", out.getvalue())
+        self.assertEqual(MessageModel.get_unread_count_for_dialog_with_user(sender, recipient), 3)
+        self.assertEqual(MessageModel.get_unread_count_for_dialog_with_user(recipient, sender), 0)
+        self.assertEqual(DialogsModel.reconcile_unread_counts(), 0)
+
+    def test_reconcile_self_dialog(self):
+        user = UserFactory.create()
+        MessageModelFactory.create_batch(2, sender=user, recipient=user, read=False)
+        self.assertEqual(DialogsModel.reconcile_unread_counts(), 0)
+        self.assertEqual(MessageModel.get_unread_count_for_dialog_with_user(user, user), 2)
+
     def tearDown(self):
         pass
 
 
+class DialogCreatedNotificationTests(TestCase):
+    def test_sent_on_commit(self):
+        known_dialogs.clear()
+        u1, u2, u3 = UserFactory.create_batch(3)
+        with mock.patch('django_private_chat2.models.notify_dialog_created') as notify:
+            with run_on_commit_callbacks():
+                self.assertTrue(DialogsModel.create_if_not_exists(u1, u2))
+                DialogsModel.create_many_if_not_exist([(u3.pk, u1.pk), (u2.pk, u1.pk)])
+                notify.assert_not_called()
+        self.assertEqual(sorted(c.args for c in notify.call_args_list),
+                         sorted([DialogsModel.canonical_pair(u1, u2), DialogsModel.canonical_pair(u1, u3)]))
+
+
+class KnownDialogsCacheTests(TestCase):
+    def setUp(self) -> None:
+        known_dialogs.clear()
+        self.sender, self.recipient = UserFactory.create(), UserFactory.create()
+
+    def test_save_skips_known_dialogs(self):
+        with run_on_commit_callbacks():
+            MessageModelFactory.create(sender=self.sender, recipient=self.recipient)
+        self.assertEqual(get_known_dialogs_metrics(), {'hits': 0, 'misses': 1, 'size': 1, 'max_size': 10000})
+        with mock.patch.object(DialogsModel, 'create_if_not_exists') as create_if_not_exists:
+            MessageModelFactory.create(sender=self.recipient, recipient=self.sender)
+        create_if_not_exists.assert_not_called()
+        self.assertEqual(known_dialogs.hits, 1)
+
+    def test_delete_invalidates(self):
+        with run_on_commit_callbacks():
+            MessageModelFactory.create(sender=self.sender, recipient=self.recipient)
+        DialogsModel.objects.filter(user1=self.sender).delete()
+        self.assertEqual(len(known_dialogs), 0)
+        MessageModelFactory.create(sender=self.sender, recipient=self.recipient)
+        self.assertIsNotNone(DialogsModel.dialog_exists(self.sender, self.recipient))
+
+    def test_dialog_deleted_by_another_process(self):
+        pair = DialogsModel.canonical_pair(self.sender, self.recipient)
+        # Still known to this process, post_delete only ran in the other one
+        known_dialogs.add([pair])
+        message = MessageModelFactory.create(sender=self.sender, recipient=self.recipient, read=False)
+        dialog = DialogsModel.dialog_exists(self.sender, self.recipient)
+        self.assertEqual((dialog.last_message_id, dialog.unread_count_for(self.recipient)), (message.id, 1))
+        self.assertFalse(known_dialogs.check(pair))
+
+    def test_bounded(self):
+        cache = KnownDialogsCache(max_size=2)
+        cache.add([(1, 2), (1, 3)])
+        self.assertTrue(cache.check((1, 2)))
+        cache.add([(1, 4)])
+        self.assertEqual((cache.check((1, 3)), cache.check((1, 2)), cache.check((1, 4))), (False, True, True))
+
+    def tearDown(self) -> None:
+        known_dialogs.clear()
+
+
+class UpdateLogModelTests(TestCase):
+    def setUp(self) -> None:
+        self.user = UserFactory.create()
+
+    def test_append(self):
+        self.assertEqual(UpdateLogModel.append(self.user.pk, {"msg_type": 9}), 1)
+        self.assertEqual(UpdateLogModel.append(self.user.pk, {"msg_type": 6}), 2)
+        self.assertEqual(UpdateLogModel.append(UserFactory.create().pk, {"msg_type": 9}), 1)
+        self.assertIsNone(UpdateLogModel.append(100000, {"msg_type": 9}))
+        self.assertIsNone(UpdateLogModel.append("not a pk", {"msg_type": 9}))
+
+    def test_get_updates_since(self):
+        self.assertEqual(UpdateLogModel.get_updates_since(self.user.pk, 0), (0, []))
+        for i in range(3):
+            UpdateLogModel.append(self.user.pk, {"msg_type": 9, "unread_count": i})
+        current, updates = UpdateLogModel.get_updates_since(self.user.pk, 1)
+        self.assertEqual(current, 3)
+        self.assertEqual([json.loads(u) for u in updates], [{"msg_type": 9, "unread_count": 1, "seq": 2},
+                                                            {"msg_type": 9, "unread_count": 2, "seq": 3}])
+        self.assertEqual(UpdateLogModel.get_updates_since(self.user.pk, 3), (3, []))
+        self.assertEqual(UpdateLogModel.get_updates_since(self.user.pk, 4), (3, None))
+
+    def test_trim(self):
+        with mock.patch('django_private_chat2.models.UPDATE_LOG_MAX_ENTRIES', 20):
+            for i in range(25):
+                UpdateLogModel.append(self.user.pk, {"msg_type": 9})
+        # trimmed every 2 updates, the last time at 24
+        self.assertEqual(UpdateLogModel.objects.filter(user=self.user).count(), 21)
+        self.assertEqual(UpdateLogModel.get_updates_since(self.user.pk, 3), (25, None))
+        self.assertEqual(len(UpdateLogModel.get_updates_since(self.user.pk, 4)[1]), 21)
+
+
 class TestCaseDialogsModelGenerated(TestCase):
 
     def test_create(self):
@@ -4,7 +4,9 @@ from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
 from django_private_chat2.models import DialogsModel, MessageModel
 from django_private_chat2.serializers import serialize_message_model, serialize_dialog_model
+from django_private_chat2.views import DialogsModelList
 import json
+from unittest import mock
 from .factories import DialogsModelFactory, MessageModelFactory, UserFactory, faker
 
 
@@ -42,6 +44,23 @@ class ViewsTests(TestCase):
         dialog = list(filter(lambda x: x.id == d['id'], dialogs))[0]
         self.assertEqual(d, serialize_dialog_model(dialog, self.user1.id))
 
+    def test_dialogs_view_num_queries(self):
+        for dialog in DialogsModelFactory.create_batch(30, user1=self.user1):
+            MessageModelFactory.create(sender=dialog.user2, recipient=self.user1)
+        # session, user, count, page - regardless of the page size
+        for page_size in (1, 10, 30):
+            with mock.patch.object(DialogsModelList, 'paginate_by', page_size), self.assertNumQueries(4):
+                response = self.client1.get(reverse('django_private_chat2:dialogs_list'), follow=True)
+            self.assertEqual(len(json.loads(response.content)['data']), page_size)
+
+    def test_dialogs_view_ordered_by_activity(self):
+        dialogs = DialogsModelFactory.create_batch(3, user1=self.user1)
+        message = MessageModelFactory.create(sender=dialogs[0].user2, recipient=self.user1)
+        response = self.client1.get(reverse('django_private_chat2:dialogs_list'), follow=True)
+        content = json.loads(response.content)
+        self.assertEqual([d['id'] for d in content['data']], [dialogs[0].id, dialogs[2].id, dialogs[1].id])
+        self.assertEqual(content['data'][0]['last_message']['id'], message.id)
+
     def test_messages_view(self):
         messages1 = MessageModelFactory.create_batch(250, sender=self.user1, recipient=self.user2)
         messages2 = MessageModelFactory.create_batch(250, sender=self.user2, recipient=self.user1)
@@ -49,13 +68,13 @@ class ViewsTests(TestCase):
         response = self.client1.get(reverse('django_private_chat2:all_messages_list'), follow=True)
         content = json.loads(response.content)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(content['pages'], 500 / settings.MESSAGES_PAGINATION)
+        self.assertTrue(content['has_more'])
         self.assertEqual(len(content['data']), settings.MESSAGES_PAGINATION)
 
         response = self.client2.get(reverse('django_private_chat2:all_messages_list'), follow=True)
         content2 = json.loads(response.content)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(content2['pages'], 500 / settings.MESSAGES_PAGINATION)
+        self.assertTrue(content2['has_more'])
         self.assertEqual(len(content2['data']), settings.MESSAGES_PAGINATION)
 
         for m in messages2:
@@ -74,5 +93,34 @@ class ViewsTests(TestCase):
         for m in messages2:
             self.assertIn(serialize_message_model(m, self.user1.id), content['data'])
 
+    def test_messages_view_cursors(self):
+        messages = MessageModelFactory.create_batch(7, sender=self.user1, recipient=self.user2)
+        ids = sorted((m.id for m in messages), reverse=True)
+        url = reverse('django_private_chat2:messages_list', kwargs={"dialog_with": self.user2.id})
+
+        def get(**params):
+            # session, user and one query per direction
+            with self.assertNumQueries(4):
+                content = json.loads(self.client1.get(url, params).content)
+            return [m['id'] for m in content['data']], content['has_more']
+
+        self.assertEqual(get(limit=3), (ids[:3], True))
+        self.assertEqual(get(limit=3, before=ids[2]), (ids[3:6], True))
+        self.assertEqual(get(limit=3, before=ids[5]), (ids[6:], False))
+        self.assertEqual(get(limit=3, after=ids[3]), (ids[:3], False))
+        self.assertEqual(get(limit=2, after=ids[6]), (ids[4:6], True))
+        self.assertEqual(self.client1.get(url, {"before": "x"}).status_code, 400)
+        self.assertEqual(self.client1.get(url, {"before": 1, "after": 2}).status_code, 400)
+
+    def test_messages_view_to_self(self):
+        to_self = MessageModelFactory.create(sender=self.user1, recipient=self.user1)
+        sent = MessageModelFactory.create(sender=self.user1, recipient=self.user2)
+        received = MessageModelFactory.create(sender=self.user2, recipient=self.user1)
+        content = json.loads(self.client1.get(reverse('django_private_chat2:all_messages_list')).content)
+        self.assertEqual([m['id'] for m in content['data']], [received.id, sent.id, to_self.id])
+        content = json.loads(self.client1.get(reverse('django_private_chat2:messages_list',
+                                                      kwargs={"dialog_with": self.user1.id})).content)
+        self.assertEqual([m['id'] for m in content['data']], [to_self.id])
+
     def tearDown(self):
         pass